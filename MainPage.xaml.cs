@@ -17,6 +17,7 @@ public partial class MainPage : ContentPage, INotifyPropertyChanged
 {
     private string _selectedImagePath = "";
     public static string ImagePathFromArgs = "";
+    public static string TraceIdFromArgs = "";
     private Point startPoint;
     private Point endPoint;
     private bool isDrawing = false;
@@ -27,6 +28,7 @@ public partial class MainPage : ContentPage, INotifyPropertyChanged
     private double imageWidth = 0;
     private double imageHeight = 0;
     private readonly HttpClient httpClient = new HttpClient();
+    private const string Midi3DServerUrl = "http://127.0.0.1:8000";
     private bool isImageLoading = false;
     private ComfyUIService comfyUIService = new ComfyUIService();
     private bool isComfyUIProcessing = false;
@@ -88,6 +90,12 @@ public partial class MainPage : ContentPage, INotifyPropertyChanged
             LoadImageFromPath(ImagePathFromArgs);
         }
 
+        // 如果从命令行传入了trace ID，则所有发往服务器的请求都带上它，服务器的span会记录在同一条追踪下
+        if (!string.IsNullOrEmpty(TraceIdFromArgs))
+        {
+            httpClient.DefaultRequestHeaders.Add("X-Trace-Id", TraceIdFromArgs);
+        }
+
         // 初始化绑定上下文
         BindingContext = this;
     }
@@ -1057,7 +1065,8 @@ public partial class MainPage : ContentPage, INotifyPropertyChanged
         try
         {
             // 准备要发送的数据
-            var imageData = Convert.ToBase64String(File.ReadAllBytes(selectedImagePath));
+            var uploadStart = DateTimeOffset.UtcNow;
+            var imageBytes = File.ReadAllBytes(selectedImagePath);
             var boundingBoxes = selections.Select(s => new BoundingBox
             {
                 x1 = (int)s.X1,
@@ -1066,17 +1075,27 @@ public partial class MainPage : ContentPage, INotifyPropertyChanged
                 y2 = (int)s.Y2
             }).ToList();
 
-            var payload = new
+            // 按服务器 /process 的表单字段发送：图片文件、分割模式和框坐标（原图像素）
+            var mimeType = Path.GetExtension(selectedImagePath).ToLowerInvariant() switch
             {
-                image_data = imageData,
-                bounding_boxes = boundingBoxes
+                ".jpg" or ".jpeg" => "image/jpeg",
+                ".webp" => "image/webp",
+                _ => "image/png"
             };
+            using var content = new MultipartFormDataContent();
+            var fileContent = new ByteArrayContent(imageBytes);
+            fileContent.Headers.ContentType = new MediaTypeHeaderValue(mimeType);
+            content.Add(fileContent, "file", Path.GetFileName(selectedImagePath));
+            content.Add(new StringContent("box"), "seg_mode");
+            content.Add(new StringContent(JsonSerializer.Serialize(boundingBoxes)), "boxes_json");
 
             // 发送到服务器
-            string jsonPayload = JsonSerializer.Serialize(payload);
-            var content = new StringContent(jsonPayload, Encoding.UTF8, "application/json");
-
-            var response = await httpClient.PostAsync("http://127.0.0.1:8000/process_image", content);
+            var response = await httpClient.PostAsync($"{Midi3DServerUrl}/process", content);
+            WriteTraceSpan("upload", uploadStart, DateTimeOffset.UtcNow, new Dictionary<string, object>
+            {
+                ["bytes"] = imageBytes.Length,
+                ["status_code"] = (int)response.StatusCode
+            });
 
             if (response.IsSuccessStatusCode)
             {
@@ -1134,17 +1153,37 @@ public partial class MainPage : ContentPage, INotifyPropertyChanged
         }
     }
 
+    // 输出span到控制台（供Blender插件写入追踪文件），时间为Unix秒，与插件和服务器的span对齐
+    private static void WriteTraceSpan(string name, DateTimeOffset start, DateTimeOffset end, Dictionary<string, object>? attributes = null)
+    {
+        if (string.IsNullOrEmpty(TraceIdFromArgs))
+            return;
+
+        var span = new
+        {
+            name,
+            service = "selector",
+            start = start.ToUnixTimeMilliseconds() / 1000.0,
+            end = end.ToUnixTimeMilliseconds() / 1000.0,
+            attributes = attributes ?? new Dictionary<string, object>()
+        };
+        Console.WriteLine($"MIDI3D_SPAN:{JsonSerializer.Serialize(span)}");
+    }
+
     private async Task PollMidi3DTaskStatus(string taskId)
     {
-        string statusUrl = $"http://127.0.0.1:8000/task_status/{taskId}";
+        string statusUrl = $"{Midi3DServerUrl}/status/{taskId}";
         bool taskCompleted = false;
         string modelUrl = "";
+        var pollStart = DateTimeOffset.UtcNow;
+        int pollCount = 0;
 
         while (!taskCompleted)
         {
             try
             {
                 var response = await httpClient.GetAsync(statusUrl);
+                pollCount++;
                 if (response.IsSuccessStatusCode)
                 {
                     var content = await response.Content.ReadAsStringAsync();
@@ -1161,21 +1200,16 @@ public partial class MainPage : ContentPage, INotifyPropertyChanged
                         switch (status)
                         {
                             case "completed":
-                                if (statusObject.ContainsKey("result") && statusObject["result"] is JsonElement resultElement)
+                                // model_url是相对路径，例如 /download/{task_id}
+                                if (statusObject.ContainsKey("model_url") && statusObject["model_url"] is JsonElement urlElement
+                                    && urlElement.ValueKind == JsonValueKind.String)
                                 {
-                                    var resultDict = JsonSerializer.Deserialize<Dictionary<string, string>>(resultElement.GetRawText());
-                                    if (resultDict != null && resultDict.ContainsKey("model_url"))
-                                    {
-                                        modelUrl = resultDict["model_url"];
-                                        taskCompleted = true;
-                                        MainThread.BeginInvokeOnMainThread(() =>
-                                        {
-                                            // 移除了对StatusMessage的所有引用
-                                        });
-                                    }
+                                    modelUrl = $"{Midi3DServerUrl}{urlElement.GetString()}";
+                                    taskCompleted = true;
                                 }
                                 break;
 
+                            case "error":
                             case "failed":
                                 MainThread.BeginInvokeOnMainThread(() =>
                                 {
@@ -1186,9 +1220,11 @@ public partial class MainPage : ContentPage, INotifyPropertyChanged
                                 return;
 
                             default:
-                                if (statusObject.ContainsKey("progress"))
+                                // 排队中的任务progress为null
+                                if (statusObject.ContainsKey("progress") && statusObject["progress"] is JsonElement progressElement
+                                    && progressElement.ValueKind == JsonValueKind.Number)
                                 {
-                                    double progress = double.Parse(statusObject["progress"].ToString());
+                                    double progress = progressElement.GetDouble();
                                     MainThread.BeginInvokeOnMainThread(() =>
                                     {
                                         Midi3DProgressBar.Progress = progress;
@@ -1229,8 +1265,16 @@ public partial class MainPage : ContentPage, INotifyPropertyChanged
             }
 
             // 等待一段时间再轮询
-            await Task.Delay(1000);
+            if (!taskCompleted)
+            {
+                await Task.Delay(1000);
+            }
         }
+        WriteTraceSpan("poll_status", pollStart, DateTimeOffset.UtcNow, new Dictionary<string, object>
+        {
+            ["attempts"] = pollCount,
+            ["completed"] = taskCompleted
+        });
 
         // 下载模型文件
         if (!string.IsNullOrEmpty(modelUrl))
@@ -1251,11 +1295,16 @@ public partial class MainPage : ContentPage, INotifyPropertyChanged
                 string fileName = $"model_{taskId}.glb";
                 string filePath = Path.Combine(outputDir, fileName);
 
+                var downloadStart = DateTimeOffset.UtcNow;
                 var response = await httpClient.GetAsync(modelUrl);
                 if (response.IsSuccessStatusCode)
                 {
                     var fileBytes = await response.Content.ReadAsByteArrayAsync();
                     await File.WriteAllBytesAsync(filePath, fileBytes);
+                    WriteTraceSpan("download", downloadStart, DateTimeOffset.UtcNow, new Dictionary<string, object>
+                    {
+                        ["bytes"] = fileBytes.Length
+                    });
 
                     MainThread.BeginInvokeOnMainThread(() =>
                     {
@@ -21,10 +21,24 @@ namespace blender_selecter
     		builder.Logging.AddDebug();
 #endif
 
-            // 如果有命令行参数，则认为是图片路径
-            if (args.Length > 0)
+            // --trace-id 参数由Blender插件生成，请求服务器时带上，用于端到端追踪
+            var positionalArgs = new List<string>();
+            for (int i = 0; i < args.Length; i++)
             {
-                string imagePath = args[0];
+                if (args[i] == "--trace-id" && i + 1 < args.Length)
+                {
+                    MainPage.TraceIdFromArgs = args[++i];
+                }
+                else
+                {
+                    positionalArgs.Add(args[i]);
+                }
+            }
+
+            // 如果有其他命令行参数，则认为是图片路径
+            if (positionalArgs.Count > 0)
+            {
+                string imagePath = positionalArgs[0];
                 if (File.Exists(imagePath))
                 {
                     // 将图片路径传递给MainPage
@@ -27,10 +27,10 @@ namespace blender_selecter.WinUI
         protected override void OnLaunched(Microsoft.UI.Xaml.LaunchActivatedEventArgs args)
         {
             string[] commandLineArgs = Environment.GetCommandLineArgs();
-            // 第二个元素（索引为1）是图片路径参数
+            // 第二个元素（索引为1）是图片路径参数，之后可能跟着 --trace-id 参数
             if (commandLineArgs.Length > 1)
             {
-                Args = new string[] { commandLineArgs[1] };
+                Args = commandLineArgs[1..];
             }
             else
             {
@@ -0,0 +1,187 @@
+import argparse
+import json
+import math
+import os
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# test.jpg 中4个物体的边界框（与 backend_test.py 相同）
+DEFAULT_BOXES = [
+    {"x1": 803, "y1": 388, "x2": 962, "y2": 747},
+    {"x1": 623, "y1": 531, "x2": 788, "y2": 767},
+    {"x1": 247, "y1": 365, "x2": 577, "y2": 759},
+    {"x1": 54, "y1": 428, "x2": 224, "y2": 753},
+]
+
+
+def percentile(values, q):
+    """最近秩百分位数"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(q / 100 * len(ordered)) - 1)]
+
+
+def summarize(values):
+    return {
+        "count": len(values),
+        "mean": sum(values) / len(values) if values else None,
+        "p50": percentile(values, 50),
+        "p99": percentile(values, 99),
+        "max": max(values) if values else None,
+    }
+
+
+def start_stub_server(profile, port, tasks_per_node):
+    cmd = [sys.executable, os.path.join(BACKEND_DIR, "stub_backend.py"), "--profile", profile, "--port", str(port)]
+    if tasks_per_node is not None:
+        cmd += ["--tasks-per-node", str(tasks_per_node)]
+    return subprocess.Popen(cmd, cwd=BACKEND_DIR)
+
+
+def wait_until_ready(url, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if requests.get(f"{url}/", timeout=1).status_code == 200:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"Server at {url} did not become ready within {timeout}s")
+
+
+class LoadRunner:
+    """Submits reconstructions from several client threads and times each endpoint"""
+
+    def __init__(self, url, image_bytes, boxes, poll_interval, task_timeout):
+        self.url = url
+        self.image_bytes = image_bytes
+        self.boxes_json = json.dumps(boxes)
+        self.poll_interval = poll_interval
+        self.task_timeout = task_timeout
+        self.lock = threading.Lock()
+        self.latencies = {"process": [], "status": [], "download": [], "completion": [], "end_to_end": []}
+        self.errors = []
+
+    def timed(self, endpoint, func):
+        start = time.perf_counter()
+        response = func()
+        with self.lock:
+            self.latencies[endpoint].append(time.perf_counter() - start)
+        response.raise_for_status()
+        return response
+
+    def run_task(self, index):
+        session = requests.Session()
+        start = time.perf_counter()
+        try:
+            response = self.timed("process", lambda: session.post(
+                f"{self.url}/process",
+                files={"file": ("test.jpg", self.image_bytes, "image/jpeg")},
+                data={"seg_mode": "box", "boxes_json": self.boxes_json, "polygon_refinement": "true"},
+            ))
+            task_id = response.json()["task_id"]
+            submitted = time.perf_counter()
+
+            while True:
+                status = self.timed("status", lambda: session.get(f"{self.url}/status/{task_id}")).json()
+                if status["status"] == "completed":
+                    break
+                if status["status"] == "error":
+                    raise RuntimeError(status["message"])
+                if time.perf_counter() - start > self.task_timeout:
+                    raise TimeoutError(f"Task {task_id} did not finish within {self.task_timeout}s")
+                time.sleep(self.poll_interval)
+            completed = time.perf_counter()
+
+            self.timed("download", lambda: session.get(f"{self.url}{status['model_url']}"))
+            with self.lock:
+                self.latencies["completion"].append(completed - submitted)
+                self.latencies["end_to_end"].append(time.perf_counter() - start)
+        except Exception as e:
+            with self.lock:
+                self.errors.append(f"request {index}: {e}")
+
+    def run(self, num_requests, concurrency):
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            list(executor.map(self.run_task, range(num_requests)))
+        wall = time.perf_counter() - start
+
+        completed = len(self.latencies["end_to_end"])
+        return {
+            "requests": num_requests,
+            "concurrency": concurrency,
+            "completed": completed,
+            "errors": len(self.errors),
+            "error_messages": self.errors[:10],
+            "wall_seconds": wall,
+            "throughput_per_minute": completed / wall * 60 if wall > 0 else None,
+            "latency_seconds": {endpoint: summarize(values) for endpoint, values in self.latencies.items()},
+        }
+
+
+def print_report(report):
+    print(f"{report['completed']}/{report['requests']} tasks completed at concurrency {report['concurrency']} "
+          f"in {report['wall_seconds']:.1f}s ({report['throughput_per_minute']:.1f} tasks/min), {report['errors']} errors")
+    print(f"{'endpoint':<12} {'count':>6} {'mean':>10} {'p50':>10} {'p99':>10} {'max':>10}")
+    for endpoint, stats in report["latency_seconds"].items():
+        if not stats["count"]:
+            continue
+        cells = " ".join(f"{stats[key] * 1000:8.1f}ms" for key in ("mean", "p50", "p99", "max"))
+        print(f"{endpoint:<12} {stats['count']:>6} {cells}")
+    for message in report["error_messages"]:
+        print(f"  error: {message}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load-test /process, /status and /download, by default against a stub-model server")
+    parser.add_argument("--url", help="Test an already running server instead of starting stub_backend.py")
+    parser.add_argument("--profile", default="fast", help="Stub profile for the started server (see stub_backend.PROFILES)")
+    parser.add_argument("--port", type=int, default=8765, help="Port of the started stub server")
+    parser.add_argument("--tasks-per-node", type=int, help="Concurrent tasks per NUMA node on the started stub server")
+    parser.add_argument("--requests", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4])
+    parser.add_argument("--image", default=os.path.join(BACKEND_DIR, "test.jpg"))
+    parser.add_argument("--boxes", help="Bounding boxes as JSON, in the boxes_json format of /process")
+    parser.add_argument("--poll-interval", type=float, default=0.1)
+    parser.add_argument("--task-timeout", type=float, default=600)
+    parser.add_argument("--json", help="Write the reports as JSON to this file")
+    args = parser.parse_args()
+
+    server = None
+    url = args.url
+    if url is None:
+        server = start_stub_server(args.profile, args.port, args.tasks_per_node)
+        url = f"http://127.0.0.1:{args.port}"
+
+    try:
+        wait_until_ready(url, timeout=60)
+        with open(args.image, "rb") as f:
+            image_bytes = f.read()
+        boxes = json.loads(args.boxes) if args.boxes else DEFAULT_BOXES
+
+        reports = []
+        for concurrency in args.concurrency:
+            runner = LoadRunner(url, image_bytes, boxes, args.poll_interval, args.task_timeout)
+            report = runner.run(args.requests, concurrency)
+            report["profile"] = args.profile if server is not None else None
+            print_report(report)
+            print()
+            reports.append(report)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(reports, f, indent=2)
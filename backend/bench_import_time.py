@@ -0,0 +1,100 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# 在子进程中测量：导入服务模块、首次响应 / 、以及后台导入整个ML依赖的耗时
+# 后台导入期间反复调用 / 、/memory 和 /metrics 的处理函数，它们不应等待导入完成
+TIMING_SCRIPT = """
+import asyncio, json, threading, time
+start = time.perf_counter()
+import fastapi_server
+imported = time.perf_counter()
+asyncio.run(fastapi_server.root())
+ready = time.perf_counter()
+probes = {{"/": [], "/memory": [], "/metrics": []}}
+if {warm}:
+    handlers = {{"/": fastapi_server.root, "/memory": fastapi_server.get_memory, "/metrics": fastapi_server.get_metrics}}
+    warmer = threading.Thread(target=fastapi_server.warm_ml_stack)
+    warmer.start()
+    while warmer.is_alive():
+        for path, handler in handlers.items():
+            probe_start = time.perf_counter()
+            asyncio.run(handler())
+            probes[path].append(time.perf_counter() - probe_start)
+        time.sleep(0.01)
+    warmer.join()
+warmed = time.perf_counter()
+print("TIMINGS " + json.dumps({{
+    "import_s": imported - start,
+    "first_response_s": ready - start,
+    "ml_stack_s": (warmed - ready) if {warm} else None,
+    "probes_during_warmup": {{path: {{"count": len(values), "max_s": max(values, default=None)}} for path, values in probes.items()}},
+}}))
+"""
+
+
+def run_subprocess(warm):
+    """以 -X importtime 运行计时脚本，返回 (计时结果, importtime 原始输出)"""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", TIMING_SCRIPT.format(warm=warm)],
+        cwd=BACKEND_DIR,
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"Timing subprocess failed:\n{result.stderr[-2000:]}")
+    timings_line = next(line for line in result.stdout.splitlines() if line.startswith("TIMINGS "))
+    return json.loads(timings_line[len("TIMINGS "):]), result.stderr
+
+
+def parse_importtime(stderr):
+    """解析 -X importtime 输出，按顶层包汇总累计耗时（毫秒）"""
+    packages = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        fields = line[len("import time:"):].split("|")
+        if len(fields) != 3 or not fields[1].strip().isdigit():
+            continue  # 表头
+        name = fields[2]
+        # 缩进为1的条目是被直接导入的模块，其累计耗时已包含所有子模块
+        if len(name) - len(name.lstrip()) > 1:
+            continue
+        top = name.strip().split(".")[0]
+        packages[top] = packages.get(top, 0.0) + int(fields[1]) / 1000
+    return sorted(packages.items(), key=lambda item: item[1], reverse=True)
+
+
+def print_report(report, top):
+    timings = report["timings"]
+    print(f"import fastapi_server: {timings['import_s'] * 1000:8.1f}ms")
+    print(f"first response from /: {timings['first_response_s'] * 1000:8.1f}ms")
+    if timings["ml_stack_s"] is not None:
+        print(f"ML stack (background): {timings['ml_stack_s'] * 1000:8.1f}ms")
+        print("\nSlowest handler response while the ML stack was importing:")
+        for path, probe in timings["probes_during_warmup"].items():
+            if probe["count"]:
+                print(f"  {path:<10} {probe['max_s'] * 1000:8.1f}ms over {probe['count']} calls")
+    print(f"\nTop {top} top-level imports by cumulative time:")
+    for name, ms in report["packages"][:top]:
+        print(f"  {name:<32} {ms:8.1f}ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Report where API server startup time goes")
+    parser.add_argument("--no-warm", action="store_true", help="Only measure API startup, not the lazy ML stack import")
+    parser.add_argument("--top", type=int, default=15)
+    parser.add_argument("--json", help="Write the report as JSON to this file")
+    args = parser.parse_args()
+
+    timings, stderr = run_subprocess(warm=not args.no_warm)
+    report = {"timings": timings, "packages": parse_importtime(stderr)}
+    print_report(report, args.top)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
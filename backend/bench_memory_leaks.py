@@ -0,0 +1,210 @@
+import argparse
+import collections
+import gc
+import inspect
+import json
+import os
+import sys
+import time
+import types
+import uuid
+import weakref
+
+import psutil
+
+import fastapi_server
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# test.jpg 中4个物体的边界框（与 backend_test.py 相同）
+DEFAULT_BOXES = [[803, 388, 962, 747], [623, 531, 788, 767], [247, 365, 577, 759], [54, 428, 224, 753]]
+
+
+class ModelTracker:
+    """Keeps weak references to everything the model registry loads, to find models that outlive their unload"""
+
+    def __init__(self, registry):
+        self.refs = []
+        for entry in registry.entries.values():
+            entry.loader = self.wrap(entry.name, entry.loader)
+            if entry.host_loader is not None:
+                entry.host_loader = self.wrap(entry.name, entry.host_loader)
+            if entry.to_device is not None:
+                entry.to_device = self.wrap(entry.name, entry.to_device)
+
+    def wrap(self, name, func):
+        def tracked(*args, **kwargs):
+            models = func(*args, **kwargs)
+            for obj in models if isinstance(models, tuple) else (models,):
+                try:
+                    self.refs.append((name, weakref.ref(obj)))
+                except TypeError:
+                    pass  # 不支持弱引用的对象（如None）
+            return models
+        return tracked
+
+    def survivors(self):
+        """仍然存活的已加载对象，同一对象只报告一次"""
+        found = {}
+        for name, ref in self.refs:
+            obj = ref()
+            if obj is not None:
+                found.setdefault(id(obj), (name, obj))
+        self.refs = [(name, ref) for name, ref in self.refs if ref() is not None]
+        return list(found.values())
+
+
+def memory_mb():
+    """当前进程RSS和设备已分配内存（MB），未使用CUDA时设备内存为None"""
+    rss = psutil.Process().memory_info().rss / 1024**2
+    device = None
+    if fastapi_server.torch.is_loaded() and fastapi_server.torch.cuda.is_available():
+        device = fastapi_server.torch.cuda.memory_allocated() / 1024**2
+    return rss, device
+
+
+def type_counts():
+    return collections.Counter(type(obj).__qualname__ for obj in gc.get_objects())
+
+
+def describe_reference(referrer, target):
+    """描述referrer通过哪个字段引用了target"""
+    if isinstance(referrer, dict):
+        fields = "/".join(str(key) for key, value in referrer.items() if value is target)
+        # 属性字典和模块全局变量按所属对象描述
+        owner = next((o for o in gc.get_referrers(referrer) if getattr(o, "__dict__", None) is referrer), None)
+        if isinstance(owner, types.ModuleType):
+            return f"global {owner.__name__}.{fields}"
+        if owner is not None:
+            return f"{type(owner).__qualname__}.{fields}"
+        return f"dict[{fields}]"
+    if isinstance(referrer, (list, tuple)):
+        indices = [str(i) for i, value in enumerate(referrer) if value is target][:3]
+        return f"{type(referrer).__name__}[{', '.join(indices)}] (len {len(referrer)})"
+    if inspect.isfunction(referrer):
+        return f"function {referrer.__qualname__}"
+    if type(referrer).__name__ == "cell":
+        return "closure cell"
+    return type(referrer).__qualname__
+
+
+def referrer_tree(obj, depth, ignore, width=5, indent="    "):
+    """obj的引用者树（忽略栈帧和本工具自身持有的引用），返回文本行"""
+    lines = []
+    ignore = ignore | {id(obj)}
+    referrers = [r for r in gc.get_referrers(obj) if id(r) not in ignore and not inspect.isframe(r)]
+    for referrer in referrers[:width]:
+        lines.append(f"{indent}<- {describe_reference(referrer, obj)}")
+        if depth > 1:
+            lines.extend(referrer_tree(referrer, depth - 1, ignore | {id(referrers)}, width, indent + "    "))
+    if len(referrers) > width:
+        lines.append(f"{indent}   ... {len(referrers) - width} more")
+    return lines
+
+
+def run_task(image, boxes):
+    task_id = f"leakcheck-{uuid.uuid4()}"
+    fastapi_server.update_task_status(task_id, "queued", "Task queued for processing", submitted_at=time.time())
+    fastapi_server.process_image_to_3d(task_id, image, "box", boxes, polygon_refinement=True)
+    # 服务器有意保留每个任务的状态记录，取出后删除，避免计入对象增长
+    status = fastapi_server.task_statuses.pop(task_id)
+    if status["status"] != "completed":
+        raise RuntimeError(f"Task {task_id} did not complete: {status['message']}")
+
+
+def run_check(args):
+    if args.backend == "stub":
+        import stub_backend
+        stub_backend.install(args.profile)
+
+    tracker = ModelTracker(fastapi_server.model_registry)
+    with open(args.image, "rb") as f:
+        image, scale = fastapi_server.ingest_image(f.read())
+    boxes = fastapi_server.scale_boxes([json.loads(args.boxes) if args.boxes else DEFAULT_BOXES], scale, image.size)
+
+    # 预热任务填充缓存、导入依赖和分配器内存池，之后的内存作为基线
+    for _ in range(args.warmup):
+        run_task(image, boxes)
+    gc.collect()
+    baseline_rss, baseline_device = memory_mb()
+    counts_before = type_counts()
+    print(f"Baseline after {args.warmup} warm-up task(s): RSS {baseline_rss:.0f}MB"
+          + (f", device {baseline_device:.0f}MB" if baseline_device is not None else ""))
+
+    rows = []
+    for index in range(args.tasks):
+        start = time.perf_counter()
+        run_task(image, boxes)
+        gc.collect()
+        rss, device = memory_mb()
+        survivors = tracker.survivors()
+        row = {
+            "task": index + 1,
+            "seconds": round(time.perf_counter() - start, 2),
+            "rss_mb": round(rss, 1),
+            "rss_growth_mb": round(rss - baseline_rss, 1),
+            "device_mb": round(device, 1) if device is not None else None,
+            "device_growth_mb": round(device - baseline_device, 1) if device is not None else None,
+            "surviving_models": [f"{name}: {type(obj).__qualname__}" for name, obj in survivors],
+        }
+        row["ok"] = (row["rss_growth_mb"] <= args.tolerance_mb
+                     and (device is None or row["device_growth_mb"] <= args.device_tolerance_mb)
+                     and not survivors)
+        rows.append(row)
+        device_text = f" device {row['device_growth_mb']:+.1f}MB" if device is not None else ""
+        print(f"task {row['task']:>3}: {row['seconds']:6.2f}s  RSS {row['rss_mb']:8.1f}MB ({row['rss_growth_mb']:+.1f}MB)"
+              f"{device_text}  {'ok' if row['ok'] else 'LEAK'}")
+
+        for name, obj in survivors:
+            print(f"  {name} model {type(obj).__qualname__} survived its unload, referenced by:")
+            for line in referrer_tree(obj, args.referrer_depth, {id(survivors)} | {id(item) for item in survivors}):
+                print(line)
+        del survivors
+
+    # 对象数量增长最多的类型，用于定位没有被模型追踪覆盖的泄漏
+    growth = type_counts()
+    growth.subtract(counts_before)
+    top_growth = [(name, count) for name, count in growth.most_common(args.top) if count > 0]
+    if top_growth:
+        print(f"\nObject types that grew over {args.tasks} tasks:")
+        for name, count in top_growth:
+            print(f"  {name:<40} +{count}")
+
+    return {
+        "backend": args.backend,
+        "profile": args.profile if args.backend == "stub" else None,
+        "baseline_rss_mb": round(baseline_rss, 1),
+        "baseline_device_mb": round(baseline_device, 1) if baseline_device is not None else None,
+        "tolerance_mb": args.tolerance_mb,
+        "device_tolerance_mb": args.device_tolerance_mb,
+        "tasks": rows,
+        "type_growth": dict(top_growth),
+        "leak_warning": fastapi_server.memory_sampler.leak_warning,
+        "passed": all(row["ok"] for row in rows),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run consecutive full tasks and check that memory returns to baseline after each")
+    parser.add_argument("--backend", choices=["stub", "real"], default="stub",
+                        help="stub: stub_backend models (no GPU needed); real: the configured MIDI-3D models")
+    parser.add_argument("--profile", default="fast", help="Stub profile (see stub_backend.PROFILES)")
+    parser.add_argument("--tasks", type=int, default=10)
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument("--tolerance-mb", type=float, default=64, help="Allowed RSS growth over the baseline")
+    parser.add_argument("--device-tolerance-mb", type=float, default=16, help="Allowed CUDA memory growth over the baseline")
+    parser.add_argument("--image", default=os.path.join(BACKEND_DIR, "test.jpg"))
+    parser.add_argument("--boxes", help="Bounding boxes as a JSON list of [x1, y1, x2, y2] in image pixels")
+    parser.add_argument("--referrer-depth", type=int, default=3)
+    parser.add_argument("--top", type=int, default=15, help="Object types to list by growth")
+    parser.add_argument("--output", help="Write the JSON report to this file")
+    args = parser.parse_args()
+
+    report = run_check(args)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    print(f"\n{'PASSED' if report['passed'] else 'FAILED'}: "
+          f"{sum(row['ok'] for row in report['tasks'])}/{len(report['tasks'])} tasks returned to baseline")
+    sys.exit(0 if report["passed"] else 1)
@@ -0,0 +1,97 @@
+import argparse
+import time
+
+import numpy as np
+import torch
+
+import fastapi_server
+from fastapi_server import refine_masks_parallel
+from scripts.grounding_sam import refine_masks
+
+
+def make_synthetic_masks(num_masks, height, width, seed=0):
+    """生成模拟SAM输出的掩码：每个框3个候选掩码，形状为 (N, 3, H, W) 的布尔张量"""
+    rng = np.random.default_rng(seed)
+    ys, xs = np.ogrid[:height, :width]
+    masks = np.zeros((num_masks, 3, height, width), dtype=bool)
+
+    for i in range(num_masks):
+        cx, cy = rng.uniform(0.1, 0.9) * width, rng.uniform(0.1, 0.9) * height
+        ax, ay = rng.uniform(0.03, 0.2) * width, rng.uniform(0.03, 0.2) * height
+        ellipse = ((xs - cx) / ax) ** 2 + ((ys - cy) / ay) ** 2 <= 1.0
+
+        # 加入噪声孔洞和毛刺，让轮廓提取有实际工作量
+        noise = rng.random((height, width)) < 0.02
+        for k in range(3):
+            jitter = rng.uniform(0.9, 1.1)
+            candidate = ((xs - cx) / (ax * jitter)) ** 2 + ((ys - cy) / ay) ** 2 <= 1.0
+            masks[i, k] = (candidate | (ellipse & noise)) & ~(ellipse & np.roll(noise, 7, axis=1))
+
+    return torch.from_numpy(masks)
+
+
+def time_call(func, repeats):
+    """返回多次调用中的最短耗时（秒）和最后一次的结果"""
+    best = float("inf")
+    result = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def run_benchmark(mask_counts, height, width, workers, repeats):
+    fastapi_server.POLYGON_REFINEMENT_WORKERS = workers
+    rows = []
+
+    for num_masks in mask_counts:
+        masks = make_synthetic_masks(num_masks, height, width, seed=num_masks)
+
+        serial_time, serial_result = time_call(lambda: refine_masks(masks, True), repeats)
+        row = {"masks": num_masks, "serial_s": serial_time}
+
+        for pool in ("serial", "thread", "process"):
+            fastapi_server.POLYGON_REFINEMENT_POOL = pool
+            fastapi_server._polygon_refinement_executor = None
+            pool_time, pool_result = time_call(lambda: refine_masks_parallel(masks, True), repeats)
+
+            # 校验结果与原始串行实现一致
+            identical = all(np.array_equal(a > 0, b > 0) for a, b in zip(serial_result, pool_result))
+            row[f"{pool}_s"] = pool_time
+            row[f"{pool}_speedup"] = serial_time / pool_time
+            row[f"{pool}_identical"] = identical
+
+            executor = fastapi_server._polygon_refinement_executor
+            if executor is not None:
+                executor.shutdown()
+
+        rows.append(row)
+
+    return rows
+
+
+def print_rows(rows, height, width, workers):
+    print(f"Polygon refinement benchmark ({width}x{height}, {workers} workers)")
+    header = f"{'masks':>6} {'baseline':>10} " + " ".join(f"{pool:>18}" for pool in ("serial", "thread", "process"))
+    print(header)
+    for row in rows:
+        cells = []
+        for pool in ("serial", "thread", "process"):
+            mark = "" if row[f"{pool}_identical"] else " !"
+            cells.append(f"{row[f'{pool}_s'] * 1000:8.1f}ms x{row[f'{pool}_speedup']:4.1f}{mark}")
+        print(f"{row['masks']:>6} {row['serial_s'] * 1000:8.1f}ms " + " ".join(f"{c:>18}" for c in cells))
+    print("baseline = scripts.grounding_sam.refine_masks; '!' marks results that differ from it")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark serial vs parallel polygon refinement on synthetic masks")
+    parser.add_argument("--masks", type=int, nargs="+", default=[1, 4, 16, 32])
+    parser.add_argument("--height", type=int, default=1080)
+    parser.add_argument("--width", type=int, default=1920)
+    parser.add_argument("--workers", type=int, default=fastapi_server.POLYGON_REFINEMENT_WORKERS)
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    results = run_benchmark(args.masks, args.height, args.width, args.workers, args.repeats)
+    print_rows(results, args.height, args.width, args.workers)
@@ -0,0 +1,131 @@
+import argparse
+import json
+import time
+
+import numpy as np
+import torch
+import trimesh
+from PIL import Image
+from scipy.spatial import cKDTree
+
+import fastapi_server
+from fastapi_server import ChunkedWeightLoader, load_midi_model
+from quantized_linear import Int8Linear
+from scripts.inference_midi import run_midi
+
+
+def module_bytes(pipe):
+    """管线各模块的权重与缓冲区占用的字节数"""
+    total = 0
+    for module in fastapi_server.pipeline_modules(pipe):
+        for tensor in list(module.parameters()) + list(module.buffers()):
+            total += tensor.numel() * tensor.element_size()
+    return total
+
+
+def check_layers(pipe, min_params, seed):
+    """逐层对比：相同的随机输入下，原精度线性层与int8线性层输出的相对误差和余弦相似度"""
+    generator = torch.Generator(device="cpu").manual_seed(seed)
+    rows = []
+    for module in fastapi_server.pipeline_modules(pipe):
+        for name, layer in module.named_modules():
+            if not isinstance(layer, torch.nn.Linear) or layer.weight.numel() < min_params:
+                continue
+            x = torch.randn(64, layer.in_features, generator=generator).to(layer.weight.device, layer.weight.dtype)
+            with torch.no_grad():
+                reference = layer(x).float()
+                quantized = Int8Linear.from_linear(layer)(x).float()
+            rel_error = ((quantized - reference).norm() / reference.norm().clamp(min=1e-8)).item()
+            cosine = torch.nn.functional.cosine_similarity(quantized.flatten(), reference.flatten(), dim=0).item()
+            rows.append({"layer": f"{type(module).__name__}.{name}", "rel_error": rel_error, "cosine": cosine})
+    return rows
+
+
+def generate_scene(pipe, rgb_image, seg_image, steps, seed):
+    start = time.perf_counter()
+    with torch.no_grad():
+        with fastapi_server.inference_autocast():
+            scene = run_midi(
+                pipe,
+                rgb_image,
+                seg_image,
+                seed=seed,
+                num_inference_steps=steps,
+                guidance_scale=7.0,
+                do_image_padding=True,
+            )
+    return scene, time.perf_counter() - start
+
+
+def scene_points(scene, samples, seed):
+    mesh = trimesh.util.concatenate(scene.dump())
+    points, _ = trimesh.sample.sample_surface(mesh, samples, seed=seed)
+    return points, float(np.linalg.norm(mesh.extents))
+
+
+def chamfer_distance(points_a, points_b):
+    """对称倒角距离（平均最近点距离）"""
+    dist_ab, _ = cKDTree(points_b).query(points_a)
+    dist_ba, _ = cKDTree(points_a).query(points_b)
+    return float(dist_ab.mean() + dist_ba.mean()) / 2
+
+
+def run_check(image_path, seg_path, steps, seed, samples, min_params):
+    rgb_image = Image.open(image_path).convert("RGB")
+    seg_image = Image.open(seg_path).convert("RGB")
+
+    fastapi_server.WEIGHT_QUANTIZATION = None
+    pipe = load_midi_model()
+    # 参考运行使用服务器的推理精度（GPU上为fp16，CPU上为bf16或fp32）
+    reference_dtype = str(fastapi_server.get_dtype()).replace("torch.", "")
+    report = {"seed": seed, "steps": steps, "min_params": min_params, "reference_dtype": reference_dtype}
+
+    layers = check_layers(pipe, min_params, seed)
+    report["layers"] = {
+        "count": len(layers),
+        "mean_rel_error": float(np.mean([r["rel_error"] for r in layers])) if layers else None,
+        "max_rel_error": max(layers, key=lambda r: r["rel_error"]) if layers else None,
+        "min_cosine": min(layers, key=lambda r: r["cosine"]) if layers else None,
+    }
+
+    reference_bytes = module_bytes(pipe)
+    reference_scene, reference_seconds = generate_scene(pipe, rgb_image, seg_image, steps, seed)
+
+    # 原地量化同一份权重，保证两次运行只差在量化上
+    ChunkedWeightLoader(quantize="int8").quantize_model(pipe, min_params=min_params)
+    int8_bytes = module_bytes(pipe)
+    int8_scene, int8_seconds = generate_scene(pipe, rgb_image, seg_image, steps, seed)
+
+    reference_points, diagonal = scene_points(reference_scene, samples, seed)
+    int8_points, _ = scene_points(int8_scene, samples, seed)
+    chamfer = chamfer_distance(reference_points, int8_points)
+
+    report["scene"] = {
+        "reference_objects": len(reference_scene.geometry),
+        "int8_objects": len(int8_scene.geometry),
+        "chamfer": chamfer,
+        "chamfer_relative": chamfer / diagonal if diagonal > 0 else None,
+        "reference_seconds": reference_seconds,
+        "int8_seconds": int8_seconds,
+    }
+    report["weights_mb"] = {reference_dtype: reference_bytes / 1024**2, "int8": int8_bytes / 1024**2}
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare int8 weight-only quantized MIDI against the server's inference dtype on a fixed seed")
+    parser.add_argument("--image", required=True, help="RGB input image")
+    parser.add_argument("--seg", required=True, help="Segmentation overlay for the image, as passed to run_midi")
+    parser.add_argument("--steps", type=int, default=fastapi_server.DEFAULT_MIDI_STEPS)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--samples", type=int, default=20000, help="Surface points sampled for the chamfer distance")
+    parser.add_argument("--min-params", type=int, default=fastapi_server.QUANTIZE_MIN_PARAMS)
+    parser.add_argument("--output", help="Write the JSON report to this file")
+    args = parser.parse_args()
+
+    result = run_check(args.image, args.seg, args.steps, args.seed, args.samples, args.min_params)
+    text = json.dumps(result, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
@@ -0,0 +1,288 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import psutil
+import torch
+
+import fastapi_server
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+DTYPES = {"float32": torch.float32, "float16": torch.float16, "bfloat16": torch.bfloat16}
+DEFAULT_METHODS = ["chunked:100", "chunked:500", "chunked:500:nogc", "torch_load", "mmap", "parallel:4"]
+
+
+def tensor_sizes(total_elements, count, distribution, rng):
+    """各张量的元素数量，总和约为total_elements"""
+    if distribution == "uniform":
+        weights = np.ones(count)
+    elif distribution == "lognormal":
+        weights = rng.lognormal(0.0, 1.5, count)
+    elif distribution == "transformer":
+        # 每层一个大权重矩阵加两个小向量（偏置、归一化），接近真实模型中张量数量和大小的分布
+        weights = np.where(np.arange(count) % 3 == 0, 1.0, 1e-3)
+    else:
+        raise ValueError(f"Unknown distribution: {distribution}")
+    return np.maximum(1, (weights / weights.sum() * total_elements).astype(np.int64))
+
+
+def generate_checkpoint(directory, size_mb, count, distribution, checkpoint_dtype, model_dtype, shards, seed):
+    """写出单文件检查点 model.pt、同样张量的分片 shard_*.pt，以及描述它们的 manifest.json"""
+    os.makedirs(directory, exist_ok=True)
+    dtype = DTYPES[checkpoint_dtype]
+    element_size = torch.empty(0, dtype=dtype).element_size()
+    rng = np.random.default_rng(seed)
+    generator = torch.Generator().manual_seed(seed)
+
+    state_dict = {}
+    checksum = 0.0
+    for i, numel in enumerate(tensor_sizes(size_mb * 1024 * 1024 // element_size, count, distribution, rng)):
+        tensor = torch.randn(int(numel), generator=generator).to(dtype)
+        state_dict[f"t{i:05d}"] = tensor
+        checksum += tensor.to(DTYPES[model_dtype]).double().sum().item()
+    torch.save(state_dict, os.path.join(directory, "model.pt"))
+
+    # 按大小把张量均衡分配到各分片，供并行加载使用
+    shard_keys = [[] for _ in range(shards)]
+    shard_bytes = [0] * shards
+    for key in sorted(state_dict, key=lambda k: state_dict[k].numel(), reverse=True):
+        target = shard_bytes.index(min(shard_bytes))
+        shard_keys[target].append(key)
+        shard_bytes[target] += state_dict[key].numel() * element_size
+    for index, keys in enumerate(shard_keys):
+        torch.save({key: state_dict[key] for key in keys}, os.path.join(directory, f"shard_{index}.pt"))
+
+    manifest = {
+        "size_mb": size_mb,
+        "tensors": {key: list(tensor.shape) for key, tensor in state_dict.items()},
+        "distribution": distribution,
+        "checkpoint_dtype": checkpoint_dtype,
+        "model_dtype": model_dtype,
+        "checksum": checksum,
+        "shards": shards,
+        "seed": seed,
+    }
+    with open(os.path.join(directory, "manifest.json"), "w") as f:
+        json.dump(manifest, f)
+    return manifest
+
+
+def checkpoint_files(directory, manifest):
+    return [os.path.join(directory, "model.pt")] + [
+        os.path.join(directory, f"shard_{i}.pt") for i in range(manifest["shards"])
+    ]
+
+
+def evict_page_cache(paths):
+    """让内核丢弃这些文件的页缓存，下一次加载从磁盘读取"""
+    for path in paths:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+
+
+def build_model(manifest):
+    """与检查点形状相同的目标模块，权重已写入，保证其内存计入加载前的基线"""
+    dtype = DTYPES[manifest["model_dtype"]]
+    return torch.nn.ParameterDict({
+        key: torch.nn.Parameter(torch.empty(shape, dtype=dtype).fill_(0), requires_grad=False)
+        for key, shape in manifest["tensors"].items()
+    })
+
+
+def load_chunked(model, directory, manifest, chunk_size_mb, collect_per_chunk=True):
+    loader = fastapi_server.ChunkedWeightLoader(chunk_size_mb=chunk_size_mb, collect_per_chunk=collect_per_chunk)
+    with contextlib.redirect_stdout(io.StringIO()):
+        loader.load_model_chunked(model, os.path.join(directory, "model.pt"), "cpu", DTYPES[manifest["model_dtype"]])
+
+
+def load_plain(model, directory, manifest):
+    state_dict = torch.load(os.path.join(directory, "model.pt"), map_location="cpu")
+    model.load_state_dict(state_dict)
+
+
+def load_mmap(model, directory, manifest):
+    # 张量按需从映射的文件中读取，load_state_dict逐个复制并转换精度
+    state_dict = torch.load(os.path.join(directory, "model.pt"), map_location="cpu", mmap=True, weights_only=True)
+    model.load_state_dict(state_dict)
+
+
+def load_parallel(model, directory, manifest, workers):
+    params = dict(model.named_parameters())
+
+    def load_shard(index):
+        shard = torch.load(os.path.join(directory, f"shard_{index}.pt"), map_location="cpu", mmap=True, weights_only=True)
+        with torch.no_grad():
+            for key, tensor in shard.items():
+                params[key].copy_(tensor)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(load_shard, range(manifest["shards"])))
+
+
+def run_method(method, directory):
+    """在当前进程中执行一种加载方式，返回计时、内存和读取字节数"""
+    with open(os.path.join(directory, "manifest.json")) as f:
+        manifest = json.load(f)
+    name, *options = method.split(":")
+
+    model = build_model(manifest)
+    process = psutil.Process()
+    baseline_rss = process.memory_info().rss
+    io_start = process.io_counters()
+    start = time.perf_counter()
+
+    if name == "chunked":
+        load_chunked(model, directory, manifest, int(options[0]), collect_per_chunk="nogc" not in options)
+    elif name == "torch_load":
+        load_plain(model, directory, manifest)
+    elif name == "mmap":
+        load_mmap(model, directory, manifest)
+    elif name == "parallel":
+        load_parallel(model, directory, manifest, int(options[0]) if options else os.cpu_count())
+    else:
+        raise ValueError(f"Unknown method: {method}")
+
+    wall = time.perf_counter() - start
+    io_end = process.io_counters()
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    checksum = sum(param.double().sum().item() for param in model.parameters())
+    return {
+        "method": method,
+        "wall_seconds": wall,
+        "peak_rss_mb": peak_rss / 1024**2,
+        "peak_over_baseline_mb": (peak_rss - baseline_rss) / 1024**2,
+        # read_bytes为实际从存储读取的字节（页缓存命中时为0），read_chars为read()系统调用返回的字节（不含mmap缺页读取）
+        "read_bytes_mb": io_end.read_bytes / 1024**2 - io_start.read_bytes / 1024**2,
+        "read_chars_mb": (getattr(io_end, "read_chars", 0) - getattr(io_start, "read_chars", 0)) / 1024**2,
+        "verified": abs(checksum - manifest["checksum"]) <= 1e-6 * max(1.0, abs(manifest["checksum"])),
+    }
+
+
+def run_in_subprocess(method, directory):
+    """每次加载在新进程中执行，峰值RSS互不影响"""
+    result = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--worker", method, "--checkpoint-dir", directory],
+        cwd=BACKEND_DIR,
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        return {"method": method, "error": result.stderr.strip().splitlines()[-1] if result.stderr.strip() else "failed"}
+    line = next(line for line in result.stdout.splitlines() if line.startswith("RESULT "))
+    return json.loads(line[len("RESULT "):])
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=BACKEND_DIR, capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def summarize(method, runs):
+    ok = [run for run in runs if "error" not in run]
+    if not ok:
+        return {"method": method, "error": runs[-1]["error"], "runs": runs}
+    walls = sorted(run["wall_seconds"] for run in ok)
+    return {
+        "method": method,
+        "wall_seconds_min": walls[0],
+        "wall_seconds_median": walls[len(walls) // 2],
+        "peak_rss_mb": max(run["peak_rss_mb"] for run in ok),
+        "peak_over_baseline_mb": max(run["peak_over_baseline_mb"] for run in ok),
+        "read_bytes_mb": ok[-1]["read_bytes_mb"],
+        "read_chars_mb": ok[-1]["read_chars_mb"],
+        "verified": all(run["verified"] for run in ok),
+        "runs": runs,
+    }
+
+
+def print_results(report):
+    manifest = report["checkpoint"]
+    print(f"Weight loading: {manifest['size_mb']}MB {manifest['checkpoint_dtype']} checkpoint, "
+          f"{manifest['tensors']} tensors ({manifest['distribution']}) -> {manifest['model_dtype']}, "
+          f"{'cold' if report['cold_cache'] else 'warm'} page cache")
+    print(f"{'method':<20} {'min':>9} {'median':>9} {'peak RSS':>10} {'over base':>10} {'disk read':>10} {'read()':>10}")
+    for row in report["results"]:
+        if "error" in row:
+            print(f"{row['method']:<20} error: {row['error']}")
+            continue
+        mark = "" if row["verified"] else "  ! weights differ"
+        print(f"{row['method']:<20} {row['wall_seconds_min']:8.2f}s {row['wall_seconds_median']:8.2f}s "
+              f"{row['peak_rss_mb']:8.0f}MB {row['peak_over_baseline_mb']:8.0f}MB "
+              f"{row['read_bytes_mb']:8.0f}MB {row['read_chars_mb']:8.0f}MB{mark}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare checkpoint loading strategies on synthetic checkpoints")
+    parser.add_argument("--size-mb", type=int, default=1024, help="Checkpoint size")
+    parser.add_argument("--tensors", type=int, default=600, help="Number of tensors in the checkpoint")
+    parser.add_argument("--distribution", choices=["uniform", "lognormal", "transformer"], default="transformer")
+    parser.add_argument("--checkpoint-dtype", choices=list(DTYPES), default="float32")
+    parser.add_argument("--model-dtype", choices=list(DTYPES), default="float16")
+    parser.add_argument("--shards", type=int, default=8, help="Shards written for the parallel loader")
+    parser.add_argument("--methods", nargs="+", default=DEFAULT_METHODS,
+                        help="chunked:<MB>[:nogc], torch_load, mmap or parallel:<workers>")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--cold", action="store_true", help="Evict the checkpoint from the page cache before every run")
+    parser.add_argument("--checkpoint-dir", help="Reuse or create the synthetic checkpoint in this directory")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write the JSON report to this file instead of stdout")
+    parser.add_argument("--worker", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        print("RESULT " + json.dumps(run_method(args.worker, args.checkpoint_dir)))
+        sys.exit(0)
+
+    directory = args.checkpoint_dir or tempfile.mkdtemp(prefix="midi3d_weights_")
+    manifest_path = os.path.join(directory, "manifest.json")
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        print(f"Reusing checkpoint in {directory}")
+    else:
+        print(f"Generating a {args.size_mb}MB checkpoint in {directory}...")
+        manifest = generate_checkpoint(directory, args.size_mb, args.tensors, args.distribution,
+                                       args.checkpoint_dtype, args.model_dtype, args.shards, args.seed)
+
+    results = []
+    for method in args.methods:
+        runs = []
+        for _ in range(args.repeats):
+            if args.cold:
+                evict_page_cache(checkpoint_files(directory, manifest))
+            runs.append(run_in_subprocess(method, directory))
+        results.append(summarize(method, runs))
+
+    report = {
+        "git_commit": git_commit(),
+        "torch_version": torch.__version__,
+        "timestamp": time.time(),
+        "cold_cache": args.cold,
+        "repeats": args.repeats,
+        "checkpoint": dict(manifest, tensors=len(manifest["tensors"])),
+        "results": results,
+    }
+    print_results(report)
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+    else:
+        print(text)
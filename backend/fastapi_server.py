@@ -1,3 +1,9 @@
+from __future__ import annotations
+
+import copy
+import functools
+import importlib
+import importlib.util
 import json
 import os
 import uuid
@@ -6,44 +12,166 @@ import gc
 import psutil
 import io
 import base64
+import bisect
+import hashlib
+import inspect
+import itertools
+import platform
+import queue
+import re
+import struct
+import sys
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from collections import OrderedDict, deque
+from contextlib import contextmanager, nullcontext
 import numpy as np
-import torch
-import trimesh
-from PIL import Image
-from fastapi import FastAPI, File, Form, UploadFile, HTTPException, BackgroundTasks
-from fastapi.responses import FileResponse, JSONResponse
+from PIL import Image, ImageOps
+from fastapi import FastAPI, File, Form, Header, UploadFile, HTTPException, BackgroundTasks
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.concurrency import run_in_threadpool
 from pydantic import BaseModel
 from typing import Optional, List, Any
 
-# Import MIDI-3D components
-from midi.pipelines.pipeline_midi import MIDIPipeline
-from scripts.grounding_sam import detect, plot_segmentation, prepare_model, segment
-from scripts.image_to_textured_scene import (
-    prepare_ig2mv_pipeline,
-    prepare_texture_pipeline,
-    run_i2tex,
-)
-from scripts.inference_midi import run_midi
-from huggingface_hub import snapshot_download
+try:
+    import resource  # 仅Unix，用于读取进程的峰值RSS
+except ImportError:
+    resource = None
+
+class LazyModule:
+    """Stand-in for a heavy module that imports it on first attribute access
 
-def initialize_globals():
-    global object_detector, sam_processor, sam_segmentator, pipe, ig2mv_pipe, texture_pipe
-    object_detector = None
-    sam_processor = None
-    sam_segmentator = None
-    pipe = None
-    ig2mv_pipe = None
-    texture_pipe = None
+    Its own method names must not clash with attributes of the wrapped modules (torch.load, trimesh.load).
+    """
 
-initialize_globals()
+    def __init__(self, name: str):
+        self.__dict__["_name"] = name
+        self.__dict__["_module"] = None
+
+    def import_now(self):
+        if self._module is None:
+            self.__dict__["_module"] = importlib.import_module(self._name)
+        return self._module
+
+    def is_loaded(self) -> bool:
+        # 只在import_module返回后才算已加载：导入进行中模块已在sys.modules里，此时访问属性会等待导入锁
+        return self._module is not None
+
+    def override(self, module) -> None:
+        """Serve attributes from module instead of importing the real one (stub backends)"""
+        self.__dict__["_module"] = module
+
+    def __getattr__(self, attr):
+        return getattr(self.import_now(), attr)
+
+# ML stack and MIDI-3D components - 首次使用时才导入，API启动后可立即响应（见warm_ml_stack）
+torch = LazyModule("torch")
+trimesh = LazyModule("trimesh")
+huggingface_hub = LazyModule("huggingface_hub")
+pipeline_midi = LazyModule("midi.pipelines.pipeline_midi")
+grounding_sam = LazyModule("scripts.grounding_sam")
+image_to_textured_scene = LazyModule("scripts.image_to_textured_scene")
+inference_midi = LazyModule("scripts.inference_midi")
+quantized_linear = LazyModule("quantized_linear")
+
+def cpu_supports_bf16() -> bool:
+    """Whether the CPU has native bf16 kernels (AVX512-BF16/AMX) through oneDNN"""
+    try:
+        return torch.backends.mkldnn.is_available() and bool(torch.ops.mkldnn._is_mkldnn_bf16_supported())
+    except (AttributeError, RuntimeError):
+        return False
+
+def select_dtype(device: str, cpu_dtype: str = "auto") -> torch.dtype:
+    """fp16 on CUDA; on CPU fp16 is slow or missing kernels, so bf16 where supported, else fp32"""
+    if device == "cuda":
+        return torch.float16
+    if cpu_dtype == "bf16" or (cpu_dtype == "auto" and cpu_supports_bf16()):
+        return torch.bfloat16
+    return torch.float32
+
+@functools.lru_cache(maxsize=None)
+def get_device() -> str:
+    """"cuda" when available, else "cpu"; the first call imports torch"""
+    return "cuda" if torch.cuda.is_available() else "cpu"
+
+@functools.lru_cache(maxsize=None)
+def get_dtype() -> torch.dtype:
+    """Inference dtype of the selected device"""
+    return select_dtype(get_device(), CPU_DTYPE)
 
 # Constants
 TMP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tmp")
-DTYPE = torch.float16
-DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
+CPU_DTYPE = "auto"  # CPU后端的精度："auto"（支持时用bf16，否则fp32）、"bf16" 或 "fp32"
+WARM_ML_STACK_ON_STARTUP = True  # 启动后在后台线程导入ML依赖，首个任务不必等待
+CPU_INTRA_OP_THREADS = None  # 每个任务的计算线程数，None表示NUMA节点核心数除以每节点并发任务数
+CPU_INTER_OP_THREADS = 2
+MAX_TASKS_PER_NUMA_NODE = 1  # CPU后端每个NUMA节点同时运行的任务数上限
+CPU_TEXTURING = False  # MV-Adapter纹理烘焙依赖nvdiffrast（CUDA），CPU后端默认只输出未贴图的场景
 REPO_ID = "VAST-AI/MIDI-3D"
 CHUNK_SIZE_MB = 500
+WEIGHT_QUANTIZATION = None  # None 或 "int8"：大线性层权重以int8存储，使用时反量化
+QUANTIZE_MIN_PARAMS = 1_000_000  # 权重元素数不少于该值的线性层才量化
+TIMING_PROFILE_PATH = os.path.join(TMP_DIR, "timing_profile.json")
+WORKING_MAX_SIDE = 1920  # 输入图像的工作分辨率（长边像素），与Blender插件的渲染分辨率一致
+EXIF_ORIENTATION_TAG = 0x0112
+SAM_EMBEDDING_CACHE_MB = 256  # SAM图像嵌入缓存上限，vit-base每张图约4MB
+DETECTOR_TEXT_CACHE_MB = 64  # Grounding DINO文本编码缓存上限
+SEGMENTATION_BATCH_SIZE = 8  # 分割阶段单次批处理的最大图像数
+SEGMENTATION_BATCH_WINDOW_SECONDS = 0.05  # 收集同批任务的等待时间
+POLYGON_REFINEMENT_POOL = "thread"  # 多边形优化的执行方式："thread"、"process" 或 "serial"
+POLYGON_REFINEMENT_WORKERS = min(8, os.cpu_count() or 1)
+PREFETCH_NEXT_STAGE = True  # 当前阶段计算时在后台把下一阶段的权重读入锁页内存
+OFFLOAD_MODE = "none"  # "none"：整个模型放在设备上；"stream"：大模块留在主机内存，推理时逐块传到设备（小显存机器）
+STREAM_MIN_BLOCK_PARAMS = 5_000_000  # 参数量不少于该值的模块才逐块传输
+SHARE_STATUS_ACROSS_WORKERS = False  # fork_server多进程运行时置为True，任务状态写入文件供其他worker查询
+TASK_STATUS_DIR = os.path.join(TMP_DIR, "status")
+MEMORY_SAMPLE_INTERVAL_SECONDS = 0.05  # 后台内存采样间隔
+MEMORY_SAMPLE_CAPACITY = 6000  # 环形缓冲区的采样数，按20Hz约保留5分钟
+MEMORY_LEAK_WINDOW = 5  # 连续多少次清理后的基线持续上升时报警
+MEMORY_LEAK_DRIFT_MB = 256  # 窗口内基线累计上升超过该值时报警
+TRACE_EXPORT_PATH = os.path.join(TMP_DIR, "traces.jsonl")  # 任务追踪span的导出文件（每行一个JSON），None表示不导出
+TRACE_ID_PATTERN = re.compile(r"^[0-9A-Za-z-]{8,64}$")  # 客户端传入的trace_id格式
+PREVIEW_MAX_SIDE = 1024  # 预览分割的工作分辨率，与SAM的输入尺寸一致
+PREVIEW_KEEP_WARM_SECONDS = 120  # 最近有预览请求时，完整流程不卸载分割模型
+
+# Deadline-driven quality selection
+MIDI_STEP_CHOICES = (35, 30, 25, 20, 15, 10)  # 可选的MIDI推理步数，从高质量到低质量
+DEFAULT_MIDI_STEPS = 35
+MAX_QUEUE_DEPTH_BUCKET = 4  # 队列深度超过该值时按该值估算
+
+# 各阶段的默认耗时（秒），在没有实测数据时使用
+DEFAULT_STAGE_SECONDS = {
+    "load_grounding_sam": 10.0,
+    "segment": 3.0,
+    "load_midi": 40.0,
+    "midi_step": 1.5,
+    "midi_export": 5.0,
+    "load_mv_adapter": 40.0,
+    "texture_full": 90.0,  # 每个物体
+    "texture_fast": 45.0,  # 每个物体
+    "cleanup": 5.0,
+}
+
+# 纹理质量预设，仅传递run_i2tex实际支持的参数；None表示跳过纹理生成
+TEXTURE_PRESETS = {
+    "full": {},
+    "fast": {"num_inference_steps": 25, "uv_size": 2048},
+    "none": None,
+}
+TEXTURE_PRESET_SCORES = {"full": 1.0, "fast": 0.7, "none": 0.0}
+
+# 网格优化和LOD：请求通过optimize_mesh/lod_ratios开启，lod_ratios为各LOD相对优化后面数的比例
+MAX_MESH_LODS = 4
+MESH_LOD_MIN_FACES = 64  # 简化后每个物体至少保留的面数
+MESH_DECIMATION_BACKENDS = ("fast_simplification", "open3d")  # trimesh的二次误差简化依赖其一（新版本用前者）
+
+# 贴图压缩：请求通过compress_textures/texture_max_size/atlas_textures开启
+TEXTURE_JPEG_QUALITY = 85  # 默认JPEG质量；带透明通道的贴图保持PNG
+TEXTURE_ATLAS_MAX_SIZE = 4096  # 合并后图集的最大边长（像素）
+TEXTURE_ATLAS_FILL = 0.5  # 按图集面积的该比例分组，给装箱留出余量
+TEXTURE_IMAGE_SLOTS = ("baseColorTexture", "metallicRoughnessTexture", "normalTexture", "emissiveTexture",
+                       "occlusionTexture", "image")
 
 # Ensure tmp directory exists
 os.makedirs(TMP_DIR, exist_ok=True)
@@ -60,31 +188,38 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Model containers
-object_detector = None
-sam_processor = None
-sam_segmentator = None
-pipe = None
-ig2mv_pipe = None
-texture_pipe = None
-
-# Model loading status
-models_loaded = {
-    "grounding_sam": False,
-    "midi": False,
-    "mv_adapter": False,
-}
-
 # Response models
 class ProcessStatus(BaseModel):
     status: str
     message: str
     progress: Optional[float] = None
     model_url: Optional[str] = None
+    deadline_seconds: Optional[float] = None
+    chosen_settings: Optional[dict] = None
+    predicted_seconds: Optional[float] = None
+    actual_seconds: Optional[float] = None
+    memory_peaks: Optional[dict] = None
+    trace_id: Optional[str] = None
+    lods: Optional[List[dict]] = None
 
 class ProcessResponse(BaseModel):
     task_id: str
     status_url: str
+    trace_id: Optional[str] = None
+
+class BatchResponse(BaseModel):
+    batch_id: str
+    status_url: str
+    task_ids: List[str]
+
+class BatchStatus(BaseModel):
+    batch_id: str
+    status: str
+    progress: float
+    total: int
+    completed: int
+    failed: int
+    tasks: List[dict]
 
 # Request models
 class BoundingBox(BaseModel):
@@ -102,13 +237,19 @@ class SegmentationRequest(BaseModel):
 
 # In-memory storage for task statuses (in production, use a database)
 task_statuses = {}
+batch_statuses = {}
+last_preview_at = 0.0
 
 class ChunkedWeightLoader:
     """Manages chunked loading of model weights to minimize RAM usage"""
 
-    def __init__(self, chunk_size_mb: int = CHUNK_SIZE_MB):
+    def __init__(self, chunk_size_mb: int = CHUNK_SIZE_MB, quantize: Optional[str] = None, collect_per_chunk: bool = True):
+        if quantize not in (None, "int8"):
+            raise ValueError(f"Unsupported weight quantization: {quantize}")
         self.chunk_size_mb = chunk_size_mb
         self.chunk_size_bytes = chunk_size_mb * 1024 * 1024
+        self.quantize = quantize
+        self.collect_per_chunk = collect_per_chunk  # 每个块加载后执行gc.collect和empty_cache（见bench_weight_loading.py）
 
     def estimate_tensor_size(self, tensor: torch.Tensor) -> int:
         """Estimate the size of a tensor in bytes"""
@@ -138,13 +279,24 @@ class ChunkedWeightLoader:
 
         return chunks
 
-    def load_model_chunked(self, model, state_dict_path: str, device: str = DEVICE, dtype: torch.dtype = DTYPE) -> None:
+    def load_model_chunked(self, model, state_dict_path: str, device: Optional[str] = None, dtype: Optional[torch.dtype] = None) -> None:
         """Load model weights in chunks to minimize RAM usage"""
+        device = device or get_device()
+        dtype = dtype or get_dtype()
         print(f"Loading model weights in chunks of {self.chunk_size_mb}MB...")
 
         # Load state dict on CPU first
         print("Loading state dict to CPU...")
-        full_state_dict = torch.load(state_dict_path, map_location='cpu')
+        full_state_dict = None
+        if self.quantize:
+            # 量化时内存映射文件，块被使用时才读入内存，浮点权重不会整体驻留
+            try:
+                full_state_dict = torch.load(state_dict_path, map_location='cpu', mmap=True)
+            except RuntimeError:
+                # 旧格式（非zip）的checkpoint不支持mmap
+                pass
+        if full_state_dict is None:
+            full_state_dict = torch.load(state_dict_path, map_location='cpu')
 
         # Split into chunks
         chunks = self.split_state_dict(full_state_dict)
@@ -159,7 +311,9 @@ class ChunkedWeightLoader:
             print(f"Loading chunk {i+1}/{len(chunks)}...")
 
             # Load chunk to device with correct dtype
-            chunk = {k: v.to(device=device, dtype=dtype) if v.is_floating_point() else v.to(device) 
+            # 量化时块留在CPU，Int8Linear加载时逐层量化，设备上不出现浮点权重副本
+            chunk_device = "cpu" if self.quantize else device
+            chunk = {k: v.to(device=chunk_device, dtype=dtype) if v.is_floating_point() else v.to(chunk_device)
                     for k, v in chunk.items()}
 
             # Load into model
@@ -167,21 +321,774 @@ class ChunkedWeightLoader:
 
             # Clear chunk from RAM
             del chunk
-            gc.collect()
+            if self.collect_per_chunk:
+                gc.collect()
 
-            if torch.cuda.is_available():
-                torch.cuda.empty_cache()
+                if torch.cuda.is_available():
+                    torch.cuda.empty_cache()
 
             print(f"Chunk {i+1} loaded successfully")
 
         print("All chunks loaded successfully")
 
+    def quantize_model(self, model, min_params: int = QUANTIZE_MIN_PARAMS) -> int:
+        """Replace the large linear layers of a module or pipeline with int8 storage
+
+        The VAE of a pipeline is left alone, it is kept in float32 for stability.
+        Returns the number of layers replaced.
+        """
+        if self.quantize is None:
+            return 0
+        if isinstance(model, torch.nn.Module):
+            modules = [model]
+        else:
+            components = getattr(model, "components", None) or {}
+            modules = [m for name, m in components.items() if name != "vae" and isinstance(m, torch.nn.Module)]
+
+        replaced = 0
+        saved_bytes = 0
+
+        def visit(parent):
+            nonlocal replaced, saved_bytes
+            for name, child in list(parent.named_children()):
+                if isinstance(child, torch.nn.Linear) and child.weight.numel() >= min_params:
+                    saved_bytes += child.weight.numel() * (child.weight.element_size() - 1)
+                    setattr(parent, name, quantized_linear.Int8Linear.from_linear(child))
+                    replaced += 1
+                else:
+                    visit(child)
+
+        for module in modules:
+            visit(module)
+        print(f"Quantized {replaced} linear layers to {self.quantize}, saving {saved_bytes / 1024**2:.0f}MB")
+        return replaced
+
+def get_hardware_key() -> str:
+    """Identify the current hardware so timings are not mixed across machines"""
+    if torch.cuda.is_available():
+        return f"cuda:{torch.cuda.get_device_name(0)}"
+    return f"cpu:{platform.processor() or platform.machine()}:{os.cpu_count()}"
+
+class TimingProfile:
+    """Measured per-stage timings keyed by hardware and queue depth, persisted across restarts"""
+
+    def __init__(self, path: str = TIMING_PROFILE_PATH, smoothing: float = 0.3):
+        self.path = path
+        self.smoothing = smoothing
+        self._hardware = None
+        self.lock = threading.Lock()
+        self.timings = self._load()
+
+    @property
+    def hardware(self) -> str:
+        # 首次查询时才识别硬件，避免导入模块时就加载torch
+        if self._hardware is None:
+            self._hardware = get_hardware_key()
+        return self._hardware
+
+    def _load(self) -> dict:
+        if not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Warning: Could not read timing profile {self.path}: {e}")
+            return {}
+
+    def _save(self) -> None:
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.timings, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+    @staticmethod
+    def _bucket(queue_depth: int) -> int:
+        return max(0, min(queue_depth, MAX_QUEUE_DEPTH_BUCKET))
+
+    def record(self, stage: str, seconds: float, queue_depth: int = 0) -> None:
+        """Fold a measurement into the exponential moving average for this stage"""
+        key = f"{stage}@{self._bucket(queue_depth)}"
+        with self.lock:
+            table = self.timings.setdefault(self.hardware, {})
+            previous = table.get(key)
+            if previous is None:
+                table[key] = seconds
+            else:
+                table[key] = previous + self.smoothing * (seconds - previous)
+            try:
+                self._save()
+            except OSError as e:
+                print(f"Warning: Could not save timing profile: {e}")
+
+    def lookup(self, stage: str, queue_depth: int = 0) -> float:
+        """Expected seconds for a stage, scaled from the idle timing if this depth was never measured"""
+        bucket = self._bucket(queue_depth)
+        with self.lock:
+            table = self.timings.get(self.hardware, {})
+            measured = table.get(f"{stage}@{bucket}")
+            if measured is not None:
+                return measured
+            base = table.get(f"{stage}@0", DEFAULT_STAGE_SECONDS[stage])
+        # 并发任务共享同一设备，耗时大致按活跃任务数线性增长
+        return base * (1 + bucket)
+
+    def is_measured(self, stage: str) -> bool:
+        with self.lock:
+            return f"{stage}@0" in self.timings.get(self.hardware, {})
+
+timing_profile = TimingProfile()
+
+def get_queue_depth(exclude_task_id: str = None) -> int:
+    """Number of other tasks that are queued or running"""
+    return sum(
+        1 for task_id, status in list(task_statuses.items())
+        if task_id != exclude_task_id and status["status"] in ("queued", "processing")
+    )
+
+def predict_texture_seconds(preset: str, num_objects: int, queue_depth: int = 0) -> float:
+    """Expected seconds for loading MV-Adapter and texturing all objects with a preset"""
+    if TEXTURE_PRESETS[preset] is None:
+        return 0.0
+    return (timing_profile.lookup("load_mv_adapter", queue_depth)
+            + num_objects * timing_profile.lookup(f"texture_{preset}", queue_depth))
+
+def predict_task_seconds(steps: int, preset: str, num_objects: int, queue_depth: int = 0) -> float:
+    """Expected end-to-end seconds for a task with the given settings"""
+    return (timing_profile.lookup("load_grounding_sam", queue_depth)
+            + timing_profile.lookup("segment", queue_depth)
+            + timing_profile.lookup("load_midi", queue_depth)
+            + steps * timing_profile.lookup("midi_step", queue_depth)
+            + timing_profile.lookup("midi_export", queue_depth)
+            + predict_texture_seconds(preset, num_objects, queue_depth)
+            + timing_profile.lookup("cleanup", queue_depth))
+
+@functools.lru_cache(maxsize=None)
+def degraded_texture_presets(run_i2tex) -> tuple:
+    """Presets whose settings run_i2tex accepts none of, so they would silently run as "full" """
+    degraded = tuple(
+        preset for preset, kwargs in TEXTURE_PRESETS.items()
+        if kwargs and not supported_kwargs(run_i2tex, kwargs)
+    )
+    for preset in degraded:
+        print(f"Warning: run_i2tex accepts none of the {preset!r} texture preset settings, not offering it")
+    return degraded
+
+def available_texture_presets() -> list:
+    """Texture presets this backend can run"""
+    if get_device() == "cpu" and not CPU_TEXTURING:
+        return ["none"]
+    degraded = degraded_texture_presets(image_to_textured_scene.run_i2tex)
+    return [preset for preset in TEXTURE_PRESETS if preset not in degraded]
+
+def choose_quality_settings(deadline_seconds: float, num_objects: int, queue_depth: int = 0) -> dict:
+    """Pick the highest quality MIDI steps and texture preset predicted to finish within the deadline"""
+    candidates = []
+    for steps in MIDI_STEP_CHOICES:
+        for preset in available_texture_presets():
+            predicted = predict_task_seconds(steps, preset, num_objects, queue_depth)
+            score = steps / MIDI_STEP_CHOICES[0] + TEXTURE_PRESET_SCORES[preset]
+            candidates.append((predicted <= deadline_seconds, score, -predicted, steps, preset, predicted))
+
+    # 优先选择能满足截止时间的最高质量组合；都不满足时选择最快的组合
+    fitting = [c for c in candidates if c[0]]
+    if fitting:
+        _, _, _, steps, preset, predicted = max(fitting)
+    else:
+        _, _, _, steps, preset, predicted = min(candidates, key=lambda c: c[5])
+
+    return {
+        "num_inference_steps": steps,
+        "texture_preset": preset,
+        "predicted_seconds": round(predicted, 1),
+        "deadline_feasible": bool(fitting),
+        "queue_depth": queue_depth,
+    }
+
+def choose_texture_preset(remaining_seconds: float, num_objects: int, queue_depth: int = 0) -> str:
+    """Re-plan texturing once the real object count and remaining budget are known"""
+    for preset in sorted(available_texture_presets(), key=TEXTURE_PRESET_SCORES.get, reverse=True):
+        cost = predict_texture_seconds(preset, num_objects, queue_depth) + timing_profile.lookup("cleanup", queue_depth)
+        if cost <= remaining_seconds:
+            return preset
+    return "none"
+
+def supported_kwargs(func, kwargs: dict) -> dict:
+    """Keep only the keyword arguments that func actually accepts"""
+    try:
+        parameters = inspect.signature(func).parameters
+    except (TypeError, ValueError):
+        return {}
+    if any(p.kind == inspect.Parameter.VAR_KEYWORD for p in parameters.values()):
+        return dict(kwargs)
+    return {k: v for k, v in kwargs.items() if k in parameters}
+
+def ingest_image(content: bytes, max_side: int = WORKING_MAX_SIDE):
+    """Decode an uploaded image once, apply EXIF orientation and normalize it to the working resolution
+
+    Returns the RGB image together with the (x, y) scale factors from the uploaded
+    image's oriented coordinates to the working image's coordinates.
+    """
+    image = Image.open(io.BytesIO(content))
+    width, height = image.size
+
+    # EXIF方向5-8会交换宽高，框坐标是相对于旋转后的图像
+    orientation = image.getexif().get(EXIF_ORIENTATION_TAG, 1)
+    if orientation in (5, 6, 7, 8):
+        width, height = height, width
+
+    ratio = min(1.0, max_side / max(width, height))
+    target_size = (max(1, round(width * ratio)), max(1, round(height * ratio)))
+
+    # JPEG可以在解码时直接按1/2、1/4、1/8降采样，避免解码完整分辨率
+    if image.format == "JPEG" and ratio < 1.0:
+        draft_size = target_size if orientation not in (5, 6, 7, 8) else target_size[::-1]
+        image.draft("RGB", draft_size)
+
+    image = ImageOps.exif_transpose(image).convert("RGB")
+    if image.size != target_size:
+        image = image.resize(target_size, Image.LANCZOS)
+
+    return image, (target_size[0] / width, target_size[1] / height)
+
+def scale_boxes(boxes: List[List[List[int]]], scale: tuple, image_size: tuple) -> List[List[List[int]]]:
+    """Rescale nested [[x1, y1, x2, y2], ...] boxes to the working image and clamp them to its bounds"""
+    sx, sy = scale
+    width, height = image_size
+    return [
+        [
+            [
+                min(max(int(round(x1 * sx)), 0), width - 1),
+                min(max(int(round(y1 * sy)), 0), height - 1),
+                min(max(int(round(x2 * sx)), 0), width - 1),
+                min(max(int(round(y2 * sy)), 0), height - 1),
+            ]
+            for x1, y1, x2, y2 in image_boxes
+        ]
+        for image_boxes in boxes
+    ]
+
+class BoundedCache:
+    """Thread-safe LRU cache bounded by total size in bytes, with hit/miss statistics"""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, nbytes: int) -> None:
+        if nbytes > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.total_bytes -= self.entries.pop(key)[1]
+            self.entries[key] = (value, nbytes)
+            self.total_bytes += nbytes
+            while self.total_bytes > self.max_bytes:
+                _, (_, evicted_bytes) = self.entries.popitem(last=False)
+                self.total_bytes -= evicted_bytes
+                self.evictions += 1
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+            self.total_bytes = 0
+
+    def stats(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "size_mb": round(self.total_bytes / 1024**2, 2),
+                "max_mb": round(self.max_bytes / 1024**2, 2),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+            }
+
+sam_embedding_cache = BoundedCache(SAM_EMBEDDING_CACHE_MB * 1024 * 1024)
+detector_text_cache = BoundedCache(DETECTOR_TEXT_CACHE_MB * 1024 * 1024)
+
+def normalize_labels(labels: str) -> List[str]:
+    """Trim, lowercase and dedupe comma separated labels into a canonical sorted list
+
+    Sorting makes "Chair, table" and "table,chair" share detector text cache entries.
+    """
+    return sorted({label.strip().lower() for label in labels.split(",") if label.strip()})
+
+def _tensor_cache_key(value):
+    if isinstance(value, torch.Tensor):
+        return (tuple(value.shape), str(value.dtype), value.detach().cpu().numpy().tobytes())
+    return value
+
+def _move_output(output, device):
+    """Move every tensor of a text backbone output (ModelOutput or tuple) to device"""
+    if isinstance(output, torch.Tensor):
+        return output.to(device)
+    if isinstance(output, tuple):
+        return type(output)(_move_output(v, device) for v in output)
+    if isinstance(output, dict):
+        return type(output)(**{k: _move_output(v, device) for k, v in output.items()})
+    return output
+
+def _output_nbytes(output) -> int:
+    if isinstance(output, torch.Tensor):
+        return output.numel() * output.element_size()
+    if isinstance(output, tuple):
+        return sum(_output_nbytes(v) for v in output)
+    if isinstance(output, dict):
+        return sum(_output_nbytes(v) for v in output.values())
+    return 0
+
+def install_text_embedding_cache(detector) -> bool:
+    """Wrap the Grounding DINO text backbone so repeated prompts skip the BERT forward pass
+
+    The cache is keyed by the tokenized text inputs, so every detect() call with a
+    label that was seen before only pays for the image branch and the fusion layers.
+    """
+    model = getattr(detector, "model", None)
+    backbone = getattr(getattr(model, "model", None), "text_backbone", None)
+    if backbone is None:
+        print("Warning: Grounding DINO text backbone not found, text embedding cache disabled")
+        return False
+
+    model_name = getattr(model.config, "_name_or_path", "grounding-dino")
+    original_forward = backbone.forward
+
+    def cached_forward(*args, **kwargs):
+        key = (model_name,
+               tuple(_tensor_cache_key(v) for v in args),
+               tuple(sorted((k, _tensor_cache_key(v)) for k, v in kwargs.items())))
+        cached = detector_text_cache.get(key)
+        if cached is not None:
+            return _move_output(cached, backbone.device)
+        output = original_forward(*args, **kwargs)
+        # 缓存保存在CPU上，检测模型卸载后仍然有效
+        cpu_output = _move_output(output, "cpu")
+        detector_text_cache.put(key, cpu_output, _output_nbytes(cpu_output))
+        return output
+
+    backbone.forward = cached_forward
+    return True
+
+def image_digest(image: Image.Image) -> str:
+    """Content hash of a decoded image, independent of how it was encoded on upload"""
+    digest = hashlib.blake2b(image.tobytes(), digest_size=16)
+    digest.update(f"{image.mode}:{image.size}".encode())
+    return digest.hexdigest()
+
+def detect_batch(detector, images: list, label_lists: list, detect_threshold: float) -> list:
+    """Run Grounding DINO on several images in one pipeline call, returning DetectionResult lists"""
+    inputs = [
+        {
+            "image": image,
+            "candidate_labels": [label if label.endswith(".") else label + "." for label in labels],
+        }
+        for image, labels in zip(images, label_lists)
+    ]
+    outputs = detector(inputs, threshold=detect_threshold, batch_size=len(inputs))
+    if len(inputs) == 1 and outputs and isinstance(outputs[0], dict):
+        outputs = [outputs]
+    return [[grounding_sam.DetectionResult.from_dict(result) for result in output] for output in outputs]
+
+def binarize_masks(masks: torch.Tensor) -> List[np.ndarray]:
+    """Collapse SAM's three candidate masks per box into one uint8 mask per box
+
+    Equivalent to refine_masks() without polygon refinement: the mean of the
+    candidates is positive exactly when any candidate is set. The reduction runs
+    on the masks' device so only one plane per box is copied to the host.
+    """
+    return list(masks.bool().any(dim=1).to(torch.uint8).cpu().numpy())
+
+def refine_mask_polygon(mask: np.ndarray) -> np.ndarray:
+    """Replace a mask by the filled polygon of its largest contour
+
+    Contours are traced on a one-pixel-padded crop around the mask instead of the
+    full frame, which gives the same polygon for a fraction of the work.
+    """
+    rows = np.flatnonzero(mask.any(axis=1))
+    cols = np.flatnonzero(mask.any(axis=0))
+    if rows.size == 0:
+        return mask
+
+    height, width = mask.shape
+    y0, y1 = max(rows[0] - 1, 0), min(rows[-1] + 2, height)
+    x0, x1 = max(cols[0] - 1, 0), min(cols[-1] + 2, width)
+    crop = np.ascontiguousarray(mask[y0:y1, x0:x1])
+
+    refined = np.zeros_like(mask)
+    refined[y0:y1, x0:x1] = grounding_sam.polygon_to_mask(grounding_sam.mask_to_polygon(crop), crop.shape)
+    return refined
+
+_polygon_refinement_executor = None
+_polygon_refinement_executor_lock = threading.Lock()
+
+def get_polygon_refinement_executor():
+    """Shared pool for polygon refinement, created on first use"""
+    global _polygon_refinement_executor
+    with _polygon_refinement_executor_lock:
+        if _polygon_refinement_executor is None:
+            if POLYGON_REFINEMENT_POOL == "process":
+                _polygon_refinement_executor = ProcessPoolExecutor(max_workers=POLYGON_REFINEMENT_WORKERS)
+            else:
+                # OpenCV releases the GIL in findContours/fillPoly, so threads scale well
+                _polygon_refinement_executor = ThreadPoolExecutor(
+                    max_workers=POLYGON_REFINEMENT_WORKERS, thread_name_prefix="polygon-refinement"
+                )
+        return _polygon_refinement_executor
+
+def refine_polygons(masks: List[np.ndarray]) -> List[np.ndarray]:
+    """Polygon-refine many masks at once across the configured pool"""
+    if POLYGON_REFINEMENT_POOL == "serial" or len(masks) < 2:
+        return [refine_mask_polygon(mask) for mask in masks]
+    return list(get_polygon_refinement_executor().map(refine_mask_polygon, masks))
+
+def refine_masks_parallel(masks: torch.Tensor, polygon_refinement: bool = False) -> List[np.ndarray]:
+    """Drop-in replacement for refine_masks() that refines polygons in parallel"""
+    binary_masks = binarize_masks(masks)
+    if polygon_refinement:
+        return refine_polygons(binary_masks)
+    return binary_masks
+
+def segment_batch(processor, segmentator, images: list, boxes_per_image: list, polygon_refinement: list) -> list:
+    """Segment several images with SAM in one forward pass, reusing cached image embeddings
+
+    boxes_per_image holds a [[x1, y1, x2, y2], ...] list per image. Box lists are padded
+    to the same length by repeating the last box, and the padded masks are dropped
+    again before refinement. Returns one list of refined masks per image.
+    """
+    max_boxes = max(len(boxes) for boxes in boxes_per_image)
+    padded_boxes = [boxes + [boxes[-1]] * (max_boxes - len(boxes)) for boxes in boxes_per_image]
+
+    inputs = processor(images=images, input_boxes=padded_boxes, return_tensors="pt").to(segmentator.device, segmentator.dtype)
+    pixel_values = inputs.pop("pixel_values")
+
+    # 只对缓存中没有的图像运行ViT图像编码器
+    model_name = segmentator.config._name_or_path
+    cache_keys = [(model_name, image_digest(image)) for image in images]
+    embeddings = [sam_embedding_cache.get(key) for key in cache_keys]
+    missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+    if missing:
+        computed = segmentator.get_image_embeddings(pixel_values[missing])
+        for i, embedding in zip(missing, computed):
+            embeddings[i] = embedding.unsqueeze(0)
+            # 缓存保存在CPU上，分割模型卸载后仍然有效且不占用显存
+            cpu_embedding = embeddings[i].detach().to("cpu")
+            sam_embedding_cache.put(cache_keys[i], cpu_embedding, cpu_embedding.numel() * cpu_embedding.element_size())
+    image_embeddings = torch.cat([e.to(segmentator.device, segmentator.dtype) for e in embeddings])
+
+    outputs = segmentator(
+        image_embeddings=image_embeddings,
+        input_boxes=inputs["input_boxes"],
+    )
+    masks = processor.post_process_masks(
+        masks=outputs.pred_masks,
+        original_sizes=inputs["original_sizes"],
+        reshaped_input_sizes=inputs["reshaped_input_sizes"],
+    )
+
+    results = [binarize_masks(image_masks[:len(boxes)]) for image_masks, boxes in zip(masks, boxes_per_image)]
+
+    # 将所有需要多边形优化的掩码一次性提交到线程池，而不是逐张图像处理
+    to_refine = [(i, j) for i, refine in enumerate(polygon_refinement) if refine for j in range(len(results[i]))]
+    if to_refine:
+        refined = refine_polygons([results[i][j] for i, j in to_refine])
+        for (i, j), mask in zip(to_refine, refined):
+            results[i][j] = mask
+
+    return results
+
+def encode_mask_rle(mask) -> dict:
+    """Run-length encode a binary mask in column-major order (COCO-style uncompressed RLE)
+
+    counts alternates between runs of 0 and 1 and always starts with a run of 0.
+    """
+    mask = np.asarray(mask).astype(bool)
+    flat = mask.ravel(order="F")
+    if flat.size == 0:
+        return {"size": list(mask.shape), "counts": []}
+    changes = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    counts = np.diff(np.concatenate(([0], changes, [flat.size]))).tolist()
+    if flat[0]:
+        counts = [0] + counts
+    return {"size": list(mask.shape), "counts": counts}
+
+def decode_mask_rle(rle: dict) -> np.ndarray:
+    """Inverse of encode_mask_rle"""
+    height, width = rle["size"]
+    values = np.zeros(len(rle["counts"]), dtype=bool)
+    values[1::2] = True
+    flat = np.repeat(values, rle["counts"])
+    return flat.reshape((height, width), order="F")
+
+class CompactSegmentation:
+    """Per-instance bit-packed masks with their boxes, labels and scores
+
+    Replaces the rendered RGB segmentation map as the hand-off between stages. The
+    colour map that MIDI and MV-Adapter expect is rendered lazily by render() and
+    cached, masks cost 1 bit per pixel on disk and in memory, and per-instance
+    digests make reruns cheap to compare.
+    """
+
+    def __init__(self, size: tuple, packed_masks: list, boxes: list, labels: list, scores: list):
+        self.size = tuple(size)  # (width, height)
+        self.packed_masks = packed_masks
+        self.boxes = boxes
+        self.labels = labels
+        self.scores = scores
+        self._rendered = None
+
+    def __len__(self) -> int:
+        return len(self.packed_masks)
+
+    @classmethod
+    def from_detections(cls, detections: list, size: tuple, boxes: Optional[list] = None) -> "CompactSegmentation":
+        """Pack the masks of segment() results; boxes are taken from the prompts when given"""
+        packed_masks, instance_boxes, labels, scores = [], [], [], []
+        for index, detection in enumerate(detections):
+            mask = np.asarray(detection.mask) > 0
+            packed_masks.append(np.packbits(mask.ravel()))
+            if boxes is not None:
+                box = boxes[index]
+            elif getattr(detection, "box", None) is not None:
+                box = [detection.box.xmin, detection.box.ymin, detection.box.xmax, detection.box.ymax]
+            else:
+                ys, xs = np.nonzero(mask)
+                box = [xs.min(), ys.min(), xs.max(), ys.max()] if xs.size else [0, 0, 0, 0]
+            instance_boxes.append([int(v) for v in box])
+            labels.append(getattr(detection, "label", None))
+            score = getattr(detection, "score", None)
+            scores.append(float(score) if score is not None else None)
+        return cls(size, packed_masks, instance_boxes, labels, scores)
+
+    def mask(self, index: int) -> np.ndarray:
+        width, height = self.size
+        return np.unpackbits(self.packed_masks[index], count=width * height).reshape(height, width).astype(bool)
+
+    def masks(self) -> list:
+        return [self.mask(i) for i in range(len(self))]
+
+    def to_detections(self) -> list:
+        """Rebuild DetectionResult objects for functions from scripts.grounding_sam"""
+        detections = []
+        for i in range(len(self)):
+            detection = grounding_sam.DetectionResult()
+            detection.mask = self.mask(i).astype(np.uint8)
+            detection.label = self.labels[i]
+            detection.score = self.scores[i]
+            detections.append(detection)
+        return detections
+
+    def render(self, rgb_image: Image.Image) -> Image.Image:
+        """Colour segmentation map as produced by plot_segmentation, rendered on first use"""
+        if self._rendered is None:
+            self._rendered = grounding_sam.plot_segmentation(rgb_image, self.to_detections())
+        return self._rendered
+
+    def digests(self) -> list:
+        return [hashlib.blake2b(packed.tobytes(), digest_size=8).hexdigest() for packed in self.packed_masks]
+
+    def diff(self, other: "CompactSegmentation") -> dict:
+        """Compare two segmentations of the same image instance by instance"""
+        mine, theirs = self.digests(), other.digests()
+        changed = [i for i in range(min(len(mine), len(theirs))) if mine[i] != theirs[i]]
+        return {
+            "same_size": self.size == other.size,
+            "unchanged": min(len(mine), len(theirs)) - len(changed),
+            "changed": changed,
+            "added": list(range(len(theirs), len(mine))),
+            "removed": list(range(len(mine), len(theirs))),
+        }
+
+    def to_json(self) -> dict:
+        """Client-facing form with column-major RLE masks"""
+        return {
+            "image_size": list(self.size),
+            "instances": [
+                {
+                    "label": self.labels[i],
+                    "score": self.scores[i],
+                    "box": self.boxes[i],
+                    "mask": encode_mask_rle(self.mask(i)),
+                }
+                for i in range(len(self))
+            ],
+        }
+
+    def save(self, path: str) -> None:
+        np.savez_compressed(
+            path,
+            size=np.array(self.size),
+            lengths=np.array([packed.size for packed in self.packed_masks], dtype=np.int64),
+            packed=np.concatenate(self.packed_masks) if self.packed_masks else np.zeros(0, dtype=np.uint8),
+            meta=np.array(json.dumps({"boxes": self.boxes, "labels": self.labels, "scores": self.scores})),
+        )
+
+    @classmethod
+    def load(cls, path: str) -> "CompactSegmentation":
+        with np.load(path) as data:
+            offsets = np.cumsum(data["lengths"])[:-1]
+            packed_masks = np.split(data["packed"], offsets) if data["lengths"].size else []
+            meta = json.loads(str(data["meta"]))
+            size = tuple(int(v) for v in data["size"])
+        return cls(size, packed_masks, meta["boxes"], meta["labels"], meta["scores"])
+
+class SegmentationJob:
+    """One image waiting for detection and segmentation"""
+
+    def __init__(self, image: Image.Image, boxes: Optional[list] = None, labels: Optional[List[str]] = None,
+                 detect_threshold: float = 0.3, polygon_refinement: bool = True):
+        self.image = image
+        self.boxes = boxes  # [[x1, y1, x2, y2], ...]，label模式下为None
+        self.labels = labels  # 规范化后的标签列表，仅label模式使用
+        self.detect_threshold = detect_threshold
+        self.polygon_refinement = polygon_refinement
+        self.future = Future()
+
+def run_segmentation_jobs(jobs: list) -> None:
+    """Detect and segment a group of jobs with batched forward passes and resolve their futures"""
+    # 批处理期间持有分割模型的租约，完整流程无法在推理中途卸载它们
+    with model_registry.lease("grounding_sam") as (object_detector, sam_processor, sam_segmentator):
+        with torch.no_grad():
+            # 每个任务一组DetectionResult，box模式直接由框构造
+            detections = [None] * len(jobs)
+            label_jobs = {}
+            for i, job in enumerate(jobs):
+                if job.boxes is not None:
+                    detections[i] = [grounding_sam.DetectionResult() for _ in job.boxes]
+                else:
+                    label_jobs.setdefault(job.detect_threshold, []).append(i)
+
+            for threshold, indices in label_jobs.items():
+                results = detect_batch(
+                    object_detector, [jobs[i].image for i in indices], [jobs[i].labels for i in indices], threshold
+                )
+                for i, result in zip(indices, results):
+                    detections[i] = result
+
+            to_segment = [i for i in range(len(jobs)) if detections[i]]
+            if to_segment:
+                boxes_per_image = [
+                    jobs[i].boxes if jobs[i].boxes is not None else grounding_sam.get_boxes(detections[i])[0]
+                    for i in to_segment
+                ]
+                masks = segment_batch(
+                    sam_processor, sam_segmentator,
+                    [jobs[i].image for i in to_segment],
+                    boxes_per_image,
+                    [jobs[i].polygon_refinement for i in to_segment],
+                )
+                for i, image_masks in zip(to_segment, masks):
+                    for detection, mask in zip(detections[i], image_masks):
+                        detection.mask = mask
+
+    for job, job_detections in zip(jobs, detections):
+        job.future.set_result(CompactSegmentation.from_detections(job_detections, job.image.size, job.boxes))
+
+class SegmentationBatcher:
+    """Collects segmentation jobs from concurrent tasks and runs them as batches
+
+    The worker takes the first waiting job, then keeps collecting for up to
+    window_seconds or until max_batch_size jobs are gathered. If a batch fails,
+    its jobs are retried one by one so a single bad input only fails its own task.
+    """
+
+    def __init__(self, max_batch_size: int = SEGMENTATION_BATCH_SIZE, window_seconds: float = SEGMENTATION_BATCH_WINDOW_SECONDS):
+        self.max_batch_size = max_batch_size
+        self.window_seconds = window_seconds
+        self.queue = queue.Queue()
+        self.worker = None
+        self.lock = threading.Lock()
+
+    def pending(self) -> int:
+        return self.queue.qsize()
+
+    def enqueue(self, job: SegmentationJob) -> Future:
+        """Queue a job without waiting; the returned future resolves to a CompactSegmentation"""
+        with self.lock:
+            if self.worker is None or not self.worker.is_alive():
+                self.worker = threading.Thread(target=self._run, name="segmentation-batcher", daemon=True)
+                self.worker.start()
+        self.queue.put(job)
+        return job.future
+
+    def submit(self, job: SegmentationJob) -> "CompactSegmentation":
+        """Queue a job and block until its batch has been processed"""
+        return self.enqueue(job).result()
+
+    def _collect(self) -> list:
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.window_seconds
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self) -> None:
+        while True:
+            batch = self._collect()
+            if len(batch) > 1:
+                print(f"Segmenting a batch of {len(batch)} images")
+            try:
+                run_segmentation_jobs(batch)
+                continue
+            except Exception as e:
+                if len(batch) == 1:
+                    batch[0].future.set_exception(e)
+                    continue
+                print(f"Warning: Batched segmentation failed ({e}), retrying jobs one by one")
+
+            for job in batch:
+                try:
+                    run_segmentation_jobs([job])
+                except Exception as e:
+                    job.future.set_exception(e)
+
+segmentation_batcher = SegmentationBatcher()
+
+def run_segmentation_preview(rgb_image: Image.Image, boxes=None, labels: Optional[str] = None,
+                             detect_threshold: float = 0.3, polygon_refinement: bool = False) -> "CompactSegmentation":
+    """Run only detection and segmentation, keeping Grounding SAM loaded between calls"""
+    global last_preview_at
+
+    last_preview_at = time.time()
+    # 预览直接执行而不进入批处理队列，避免等待批处理窗口
+    job = SegmentationJob(
+        rgb_image,
+        boxes=boxes[0] if boxes is not None else None,
+        labels=normalize_labels(labels) if boxes is None else None,
+        detect_threshold=detect_threshold,
+        polygon_refinement=polygon_refinement,
+    )
+    run_segmentation_jobs([job])
+    return job.future.result()
+
 def get_memory_info():
     """Get comprehensive memory usage information"""
     info = {}
 
-    # GPU Memory
-    if torch.cuda.is_available():
+    # GPU Memory - torch尚未导入时不可能有显存占用
+    if torch.is_loaded() and torch.cuda.is_available():
         allocated = torch.cuda.memory_allocated() / 1024**3  # GB
         reserved = torch.cuda.memory_reserved() / 1024**3   # GB
         info["gpu"] = {
@@ -217,7 +1124,7 @@ def aggressive_cleanup():
         gc.collect()
         time.sleep(0.1)  # Give time for GC to work
 
-    if torch.cuda.is_available():
+    if torch.is_loaded() and torch.cuda.is_available():
         # Multiple rounds of CUDA cache clearing
         for _ in range(5):
             torch.cuda.empty_cache()
@@ -266,431 +1173,1737 @@ def clear_model_attributes(model):
             pass
 
 def load_grounding_sam():
-    """Load Grounding SAM models on demand - Gradio style"""
-    global object_detector, sam_processor, sam_segmentator, models_loaded
-
-    if not models_loaded["grounding_sam"]:
-        print("Loading Grounding SAM models...")
-        print(f"Memory before loading:\n{get_memory_info()}")
-        
-        try:
-            # 直接使用Gradio的加载方式，不进行复杂的GPU移动
-            object_detector, sam_processor, sam_segmentator = prepare_model(
-                device=DEVICE,
-                detector_id="IDEA-Research/grounding-dino-tiny",
-                segmenter_id="facebook/sam-vit-base",
-            )
-            
-            # 验证加载结果
-            if object_detector is None or sam_processor is None or sam_segmentator is None:
-                raise RuntimeError("One or more models failed to load (returned None)")
-            
-            models_loaded["grounding_sam"] = True
-            
-            print(f"Memory after loading:\n{get_memory_info()}")
-            print("Grounding SAM models loaded successfully.")
-            
-        except Exception as e:
-            print(f"Error loading Grounding SAM models: {e}")
-            import traceback
-            traceback.print_exc()
-            
-            # 重置状态
-            object_detector = None
-            sam_processor = None
-            sam_segmentator = None
-            models_loaded["grounding_sam"] = False
-            raise RuntimeError(f"Failed to load Grounding SAM models: {str(e)}")
+    """Load Grounding SAM models - Gradio style; returns (object_detector, sam_processor, sam_segmentator)"""
+    print("Loading Grounding SAM models...")
+    print(f"Memory before loading:\n{get_memory_info()}")
 
+    try:
+        # 直接使用Gradio的加载方式，不进行复杂的GPU移动
+        object_detector, sam_processor, sam_segmentator = grounding_sam.prepare_model(
+            device=get_device(),
+            detector_id="IDEA-Research/grounding-dino-tiny",
+            segmenter_id="facebook/sam-vit-base",
+        )
 
-def load_midi_model():
-    """Load MIDI model on demand with chunked loading"""
-    global pipe, models_loaded
+        # 验证加载结果
+        if object_detector is None or sam_processor is None or sam_segmentator is None:
+            raise RuntimeError("One or more models failed to load (returned None)")
 
-    if not models_loaded["midi"]:
-        print("Loading MIDI model with chunked weight loading...")
+        install_text_embedding_cache(object_detector)
 
-        local_dir = "pretrained_weights/MIDI-3D"
-        if not os.path.exists(local_dir):
-            snapshot_download(repo_id=REPO_ID, local_dir=local_dir)
+        print(f"Memory after loading:\n{get_memory_info()}")
+        print("Grounding SAM models loaded successfully.")
 
-        # Initialize chunked loader
-        chunked_loader = ChunkedWeightLoader(chunk_size_mb=CHUNK_SIZE_MB)
+    except Exception as e:
+        print(f"Error loading Grounding SAM models: {e}")
+        import traceback
+        traceback.print_exc()
+        raise RuntimeError(f"Failed to load Grounding SAM models: {str(e)}")
 
-        # Create pipeline without loading weights
-        print("Creating pipeline structure...")
-        pipe = MIDIPipeline.from_pretrained(local_dir, torch_dtype=DTYPE)
+    return object_detector, sam_processor, sam_segmentator
 
-        # Move pipeline to device
-        pipe = pipe.to(DEVICE)
 
-        # Ensure VAE is in float32 for stability, then convert to float16
-        if hasattr(pipe, 'vae') and pipe.vae is not None:
-            print("Setting VAE to float32 for stability...")
-            pipe.vae = pipe.vae.to(torch.float32)
+def load_midi_model(device: Optional[str] = None):
+    """Load MIDI model with chunked loading; returns the pipeline"""
+    device = device or get_device()
+    if OFFLOAD_MODE == "stream" and device != "cpu":
+        return move_pipeline_to_device(load_midi_model_to_host(), device)
 
-        # Find the main model weights file
-        weight_files = []
-        for root, dirs, files in os.walk(local_dir):
-            for file in files:
-                if file.endswith('.bin') or file.endswith('.pth') or file.endswith('.pt'):
-                    weight_files.append(os.path.join(root, file))
+    print("Loading MIDI model with chunked weight loading...")
 
-        if weight_files:
-            print(f"Found {len(weight_files)} weight files")
+    local_dir = "pretrained_weights/MIDI-3D"
+    if not os.path.exists(local_dir):
+        huggingface_hub.snapshot_download(repo_id=REPO_ID, local_dir=local_dir)
 
-            # Load each weight file in chunks
-            for weight_file in weight_files:
-                print(f"Loading weights from {weight_file}...")
-                try:
-                    # Try to load chunked
-                    chunked_loader.load_model_chunked(pipe, weight_file, DEVICE, DTYPE)
-                except Exception as e:
-                    print(f"Chunked loading failed for {weight_file}: {e}")
-                    print("Falling back to normal loading...")
-                    # Fallback to normal loading
-                    state_dict = torch.load(weight_file, map_location=DEVICE)
-                    # Convert to correct dtype
-                    state_dict = {k: v.to(dtype=DTYPE) if v.is_floating_point() else v.to(DEVICE) 
-                                 for k, v in state_dict.items()}
-                    pipe.load_state_dict(state_dict, strict=False)
-                    del state_dict
-                    gc.collect()
-
-        # Initialize custom adapter
-        pipe.init_custom_adapter(
-            set_self_attn_module_names=[
-                "blocks.8",
-                "blocks.9",
-                "blocks.10",
-                "blocks.11",
-                "blocks.12",
-            ]
-        )
+    # Initialize chunked loader
+    chunked_loader = ChunkedWeightLoader(chunk_size_mb=CHUNK_SIZE_MB, quantize=WEIGHT_QUANTIZATION)
 
-        # Convert the entire pipeline to float16 except VAE
-        print("Converting pipeline to float16...")
-        pipe = pipe.to(dtype=DTYPE)
-        if hasattr(pipe, 'vae') and pipe.vae is not None:
-            # Keep VAE in float32 for numerical stability
-            pipe.vae = pipe.vae.to(torch.float32)
+    # Create pipeline without loading weights
+    print("Creating pipeline structure...")
+    pipe = pipeline_midi.MIDIPipeline.from_pretrained(local_dir, torch_dtype=get_dtype())
 
-        models_loaded["midi"] = True
+    # 量化时在CPU上先把线性层换成Int8Linear再移到设备：之后分块加载的浮点权重到达时逐层量化，
+    # 主机内存和设备上都不会同时存在完整的浮点权重
+    if chunked_loader.quantize:
+        chunked_loader.quantize_model(pipe)
 
-        print("MIDI model loaded successfully with chunked weights.")
+    # Move pipeline to device
+    pipe = pipe.to(device)
 
-def load_mv_adapter():
-    """Load MV-Adapter models on demand"""
-    global ig2mv_pipe, texture_pipe, models_loaded
+    # Ensure VAE is in float32 for stability, then convert to float16
+    if hasattr(pipe, 'vae') and pipe.vae is not None:
+        print("Setting VAE to float32 for stability...")
+        pipe.vae = pipe.vae.to(torch.float32)
 
-    if not models_loaded["mv_adapter"]:
-        print("Loading MV-Adapter models...")
+    # Find the main model weights file
+    weight_files = []
+    for root, dirs, files in os.walk(local_dir):
+        for file in files:
+            if file.endswith('.bin') or file.endswith('.pth') or file.endswith('.pt'):
+                weight_files.append(os.path.join(root, file))
 
-        ig2mv_pipe = prepare_ig2mv_pipeline(device="cuda", dtype=torch.float16)
-        texture_pipe = prepare_texture_pipeline(device="cuda", dtype=torch.float16)
-        models_loaded["mv_adapter"] = True
+    if weight_files:
+        print(f"Found {len(weight_files)} weight files")
 
-        print("MV-Adapter models loaded successfully.")
+        # Load each weight file in chunks
+        for weight_file in weight_files:
+            print(f"Loading weights from {weight_file}...")
+            try:
+                # Try to load chunked
+                chunked_loader.load_model_chunked(pipe, weight_file, device, get_dtype())
+            except Exception as e:
+                print(f"Chunked loading failed for {weight_file}: {e}")
+                print("Falling back to normal loading...")
+                # Fallback to normal loading
+                state_dict = torch.load(weight_file, map_location="cpu" if chunked_loader.quantize else device)
+                # Convert to correct dtype
+                state_dict = {k: v.to(dtype=get_dtype()) if v.is_floating_point() else v
+                             for k, v in state_dict.items()}
+                pipe.load_state_dict(state_dict, strict=False)
+                del state_dict
+                gc.collect()
+
+    # Initialize custom adapter
+    pipe.init_custom_adapter(
+        set_self_attn_module_names=[
+            "blocks.8",
+            "blocks.9",
+            "blocks.10",
+            "blocks.11",
+            "blocks.12",
+        ]
+    )
 
-def cleanup_models():
-    """Unload all models and free maximum memory"""
-    print("Starting comprehensive cleanup...")
+    # Convert the entire pipeline to the inference dtype except VAE
+    print(f"Converting pipeline to {get_dtype()}...")
+    pipe = pipe.to(dtype=get_dtype())
+    if hasattr(pipe, 'vae') and pipe.vae is not None:
+        # Keep VAE in float32 for numerical stability
+        pipe.vae = pipe.vae.to(torch.float32)
 
-    # Unload Grounding SAM
-    if models_loaded["grounding_sam"]:
-        if object_detector is not None:
-            clear_model_attributes(object_detector)
-        if sam_segmentator is not None:
-            clear_model_attributes(sam_segmentator)
+    if chunked_loader.quantize:
+        # 自定义适配器新建的线性层
+        chunked_loader.quantize_model(pipe)
 
-        object_detector = None
-        sam_processor = None
-        sam_segmentator = None
-        models_loaded["grounding_sam"] = False
+    print("MIDI model loaded successfully with chunked weights.")
 
-    # Unload MIDI
-    if models_loaded["midi"] and pipe is not None:
-        try:
-            pipe.to('cpu')
-        except:
-            pass
+    return pipe
 
-        components = ['unet', 'vae', 'text_encoder', 'tokenizer', 'scheduler', 
-                     'feature_extractor', 'image_encoder', 'safety_checker']
+def load_mv_adapter():
+    """Load MV-Adapter models; returns (ig2mv_pipe, texture_pipe)"""
+    print("Loading MV-Adapter models...")
+
+    if OFFLOAD_MODE == "stream":
+        return mv_adapter_to_device(load_mv_adapter_to_host())
+
+    ig2mv_pipe = load_ig2mv_pipeline(device=get_device())
+    texture_pipe = image_to_textured_scene.prepare_texture_pipeline(device=get_device(), dtype=get_dtype())
+
+    print("MV-Adapter models loaded successfully.")
+
+    return ig2mv_pipe, texture_pipe
+
+def load_ig2mv_pipeline(device: str):
+    """Build the multi-view pipeline, quantizing its large linear layers on the CPU first if enabled"""
+    if WEIGHT_QUANTIZATION is None:
+        return image_to_textured_scene.prepare_ig2mv_pipeline(device=device, dtype=get_dtype())
+    pipe = image_to_textured_scene.prepare_ig2mv_pipeline(device="cpu", dtype=get_dtype())
+    ChunkedWeightLoader(quantize=WEIGHT_QUANTIZATION).quantize_model(pipe)
+    return pipe.to(device)
+
+def pipeline_modules(pipeline) -> list:
+    """The torch modules of a diffusers-style pipeline"""
+    components = getattr(pipeline, "components", None) or {}
+    return [component for component in components.values() if isinstance(component, torch.nn.Module)]
+
+def pin_pipeline_memory(pipeline):
+    """Move a CPU pipeline's weights into page-locked memory so the device copy can run asynchronously"""
+    if not torch.cuda.is_available():
+        return pipeline
+    for module in pipeline_modules(pipeline):
+        for tensor in itertools.chain(module.parameters(), module.buffers()):
+            if not tensor.data.is_pinned():
+                tensor.data = tensor.data.pin_memory()
+    return pipeline
+
+def move_pipeline_to_device(pipeline, device: Optional[str] = None):
+    """Copy a pinned host pipeline to the device with non-blocking transfers
+
+    In the "stream" offload mode only the small modules are copied; the large
+    blocks stay in host memory and are streamed in by BlockStreamer.
+    """
+    device = device or get_device()
+    if OFFLOAD_MODE == "stream" and torch.device(device).type == "cuda":
+        return enable_block_streaming(pipeline, device)
+    for module in pipeline_modules(pipeline):
+        module.to(device, non_blocking=True)
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return pipeline
+
+def count_parameters(module: torch.nn.Module) -> int:
+    # 计入缓冲区，int8量化层的权重保存在缓冲区中
+    return sum(t.numel() for t in itertools.chain(module.parameters(), module.buffers()))
+
+def find_streamable_blocks(module: torch.nn.Module, min_params: int = STREAM_MIN_BLOCK_PARAMS) -> list:
+    """Large entries of the module's ModuleLists (transformer/UNet blocks), in definition order"""
+    blocks = []
+
+    def visit(parent):
+        for child in parent.children():
+            if isinstance(child, torch.nn.ModuleList):
+                for block in child:
+                    if count_parameters(block) >= min_params:
+                        blocks.append(block)
+                    else:
+                        visit(block)
+            else:
+                visit(child)
 
-        for comp in components:
-            if hasattr(pipe, comp) and getattr(pipe, comp) is not None:
-                clear_model_attributes(getattr(pipe, comp))
-                setattr(pipe, comp, None)
+    visit(module)
+    return blocks
 
-        clear_model_attributes(pipe)
-        pipe = None
-        models_loaded["midi"] = False
+def move_module_except(module: torch.nn.Module, device: str, skip: set) -> None:
+    """Move a module's own tensors to the device, leaving the submodules in skip untouched"""
+    if id(module) in skip:
+        return
+    for tensor in itertools.chain(module.parameters(recurse=False), module.buffers(recurse=False)):
+        tensor.data = tensor.data.to(device, non_blocking=True)
+    for child in module.children():
+        move_module_except(child, device, skip)
+
+class BlockStreamer:
+    """Stream a list of large blocks from pinned host memory onto the device during forward
+
+    Each block's weights live in page-locked host memory. Its forward pre-hook waits
+    for the block's copy to finish and starts copying the next block on a side CUDA
+    stream, so the transfer overlaps the current block's compute. The forward hook
+    then drops the device copy again, so at most two blocks are resident at a time.
+    Inference only: the device copies are gone by the time a backward pass would run.
+    """
 
-    # Unload MV-Adapter
-    if models_loaded["mv_adapter"]:
-        if ig2mv_pipe is not None:
-            try:
-                ig2mv_pipe.to('cpu')
-            except:
-                pass
+    def __init__(self, blocks: list, device: str):
+        self.blocks = blocks
+        self.device = torch.device(device)
+        self.copy_stream = torch.cuda.Stream(device=self.device)
+        self.ready = {}  # 块索引 -> 拷贝完成事件
+        self.host_tensors = []
+        self.handles = []
+
+        for index, block in enumerate(blocks):
+            tensors = list(itertools.chain(block.parameters(), block.buffers()))
+            for tensor in tensors:
+                host = tensor.data if tensor.data.device.type == "cpu" else tensor.data.cpu()
+                tensor.data = host if host.is_pinned() else host.pin_memory()
+            self.host_tensors.append([(tensor, tensor.data) for tensor in tensors])
+            self.handles.append(block.register_forward_pre_hook(self._make_pre_hook(index)))
+            self.handles.append(block.register_forward_hook(self._make_post_hook(index)))
+
+    def _fetch(self, index: int) -> None:
+        with torch.cuda.stream(self.copy_stream):
+            for tensor, host in self.host_tensors[index]:
+                tensor.data = host.to(self.device, non_blocking=True)
+            event = torch.cuda.Event()
+            event.record(self.copy_stream)
+        self.ready[index] = event
+
+    def _make_pre_hook(self, index: int):
+        def pre_hook(module, args):
+            if index not in self.ready:
+                self._fetch(index)
+            compute_stream = torch.cuda.current_stream(self.device)
+            compute_stream.wait_event(self.ready[index])
+            # 拷贝在副流上分配，告知分配器这些显存也被计算流使用
+            for tensor, _ in self.host_tensors[index]:
+                tensor.data.record_stream(compute_stream)
+
+            # 扩散模型每一步都会从第一个块重新开始，因此最后一块之后预取第一块
+            next_index = (index + 1) % len(self.blocks)
+            if next_index not in self.ready:
+                self._fetch(next_index)
+        return pre_hook
+
+    def _make_post_hook(self, index: int):
+        def post_hook(module, args, output):
+            for tensor, host in self.host_tensors[index]:
+                tensor.data = host
+            self.ready.pop(index, None)
+        return post_hook
+
+    def remove(self) -> None:
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+        for index in list(self.ready):
+            for tensor, host in self.host_tensors[index]:
+                tensor.data = host
+        self.ready.clear()
+
+def enable_block_streaming(pipeline, device: Optional[str] = None):
+    """Put a pipeline's small modules on the device and stream its large blocks from host memory"""
+    device = device or get_device()
+    streamers = []
+    for module in pipeline_modules(pipeline):
+        blocks = find_streamable_blocks(module)
+        move_module_except(module, device, {id(block) for block in blocks})
+        if blocks:
+            streamers.append(BlockStreamer(blocks, device))
+            print(f"Streaming {len(blocks)} blocks of {type(module).__name__} "
+                  f"({sum(count_parameters(b) for b in blocks) / 1e6:.0f}M params) from host memory")
+    torch.cuda.synchronize()
+    pipeline.block_streamers = streamers
+    return pipeline
+
+def load_midi_model_to_host(pin: bool = True):
+    """Prefetch: build the MIDI pipeline on the CPU and pin its weights"""
+    pipe = load_midi_model(device="cpu")
+    return pin_pipeline_memory(pipe) if pin else pipe
+
+def load_mv_adapter_to_host(pin: bool = True):
+    """Prefetch: build the multi-view pipeline on the CPU and pin its weights
+
+    The texture pipeline sets up its renderer on the target device when it is
+    created, so it is still built directly on the device in mv_adapter_to_device.
+    """
+    print("Loading MV-Adapter multi-view pipeline to host memory...")
+    pipe = load_ig2mv_pipeline(device="cpu")
+    return pin_pipeline_memory(pipe) if pin else pipe
 
-            components = ['unet', 'vae', 'text_encoder', 'tokenizer', 'scheduler']
-            for comp in components:
-                if hasattr(ig2mv_pipe, comp) and getattr(ig2mv_pipe, comp) is not None:
-                    clear_model_attributes(getattr(ig2mv_pipe, comp))
-                    setattr(ig2mv_pipe, comp, None)
+def clone_pipeline_to_device(pipeline, device: Optional[str] = None):
+    """Copy a host pipeline to the device without touching the host tensors
 
-            clear_model_attributes(ig2mv_pipe)
+    The pipeline is deep-copied with every parameter and buffer mapped to its
+    device copy in advance, so the host weights are only read. This keeps the
+    fork server's shared copy-on-write pages shared.
+    """
+    device = device or get_device()
+    memo = {}
+    for module in pipeline_modules(pipeline):
+        for tensor in itertools.chain(module.parameters(), module.buffers()):
+            if id(tensor) in memo:
+                continue
+            device_tensor = tensor.detach().to(device, non_blocking=True)
+            if isinstance(tensor, torch.nn.Parameter):
+                device_tensor = torch.nn.Parameter(device_tensor, requires_grad=tensor.requires_grad)
+            memo[id(tensor)] = device_tensor
+    clone = copy.deepcopy(pipeline, memo)
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return clone
 
-        if texture_pipe is not None:
-            try:
-                texture_pipe.to('cpu')
-            except:
-                pass
+def mv_adapter_to_device(ig2mv_pipe):
+    ig2mv_pipe = move_pipeline_to_device(ig2mv_pipe)
+    texture_pipe = image_to_textured_scene.prepare_texture_pipeline(device=get_device(), dtype=get_dtype())
+    return ig2mv_pipe, texture_pipe
 
-            components = ['unet', 'vae', 'text_encoder', 'tokenizer', 'scheduler']
-            for comp in components:
-                if hasattr(texture_pipe, comp) and getattr(texture_pipe, comp) is not None:
-                    clear_model_attributes(getattr(texture_pipe, comp))
-                    setattr(texture_pipe, comp, None)
+def cleanup_models():
+    """Unload all models and free maximum memory
 
-            clear_model_attributes(texture_pipe)
+    Models that are leased by a running task are unloaded as soon as their last
+    lease is released instead of being torn down underneath that task.
+    """
+    print("Starting comprehensive cleanup...")
 
-        ig2mv_pipe = None
-        texture_pipe = None
-        models_loaded["mv_adapter"] = False
+    busy = model_registry.unload_all()
+    if busy:
+        print(f"Models still in use, unloading when released: {', '.join(busy)}")
 
     # Aggressive cleanup
     aggressive_cleanup()
+    if not busy:
+        memory_sampler.record_baseline("cleanup_models")
 
-    print("All models unloaded and memory freed.")
+    print("All idle models unloaded and memory freed.")
+    return busy
 
-def update_task_status(task_id: str, status: str, message: str, progress: float = None, model_url: str = None):
-    """Update the status of a task"""
-    task_statuses[task_id] = {
+def write_shared_status(kind: str, key: str, entry: dict) -> None:
+    """Publish a status entry to the other fork_server workers"""
+    if not SHARE_STATUS_ACROSS_WORKERS:
+        return
+    os.makedirs(TASK_STATUS_DIR, exist_ok=True)
+    path = os.path.join(TASK_STATUS_DIR, f"{kind}_{key}.json")
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(entry, f, default=str)
+    os.replace(tmp_path, path)
+
+def read_shared_status(kind: str, key: str) -> Optional[dict]:
+    if not SHARE_STATUS_ACROSS_WORKERS:
+        return None
+    try:
+        with open(os.path.join(TASK_STATUS_DIR, f"{kind}_{key}.json")) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def lookup_task_status(task_id: str) -> Optional[dict]:
+    """Status of a task run by this worker or, under fork_server, by any worker"""
+    status = task_statuses.get(task_id)
+    return status if status is not None else read_shared_status("task", task_id)
+
+def lookup_batch_status(batch_id: str) -> Optional[dict]:
+    status = batch_statuses.get(batch_id)
+    return status if status is not None else read_shared_status("batch", batch_id)
+
+def update_batch_status(batch_id: str, **fields) -> None:
+    entry = batch_statuses.setdefault(batch_id, {})
+    entry.update(fields)
+    write_shared_status("batch", batch_id, entry)
+
+def update_task_status(task_id: str, status: str, message: str, progress: float = None, model_url: str = None, **extra):
+    """Update the status of a task, keeping previously reported extra fields"""
+    entry = dict(task_statuses.get(task_id, {}))
+    entry.update({
         "status": status,
         "message": message,
         "progress": progress,
         "model_url": model_url,
         "timestamp": time.time()
-    }
-
-def process_image_to_3d(
-    task_id: str, 
-    image_path: str, 
-    seg_mode: str = "box",
-    boxes: Optional[List[Any]] = None,  # Changed to Any to handle both dict and list formats
-    labels: Optional[str] = None,
-    polygon_refinement: bool = True,
-    detect_threshold: float = 0.3
-):
-    """Process an image to generate a 3D model with textures - Gradio style"""
-    global object_detector, sam_processor, sam_segmentator, pipe, ig2mv_pipe, texture_pipe, models_loaded
-    
-    def cleanup_pipeline(pipeline, components):
-        """封装的清理函数，避免重复代码"""
-        if pipeline is None:
-            return
+    })
+    entry.update(extra)
+    task_statuses[task_id] = entry
+    write_shared_status("task", task_id, entry)
+
+def inference_autocast():
+    """Autocast to the inference dtype; fp32 needs no autocast"""
+    if get_dtype() == torch.float32:
+        return nullcontext()
+    return torch.autocast(device_type=get_device(), dtype=get_dtype())
+
+def parse_cpu_list(text: str) -> list:
+    """Parse a Linux cpulist such as "0-3,8-11" """
+    cpus = []
+    for part in text.strip().split(","):
+        if not part:
+            continue
+        start, _, end = part.partition("-")
+        cpus.extend(range(int(start), int(end or start) + 1))
+    return cpus
+
+def get_numa_nodes() -> list:
+    """CPUs of each NUMA node usable by this process; one node with every CPU if unknown"""
+    allowed = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else list(range(os.cpu_count() or 1))
+    nodes = []
+    node_root = "/sys/devices/system/node"
+    if os.path.isdir(node_root):
+        for name in sorted(os.listdir(node_root)):
+            if not (name.startswith("node") and name[4:].isdigit()):
+                continue
+            try:
+                with open(os.path.join(node_root, name, "cpulist")) as f:
+                    cpus = [cpu for cpu in parse_cpu_list(f.read()) if cpu in allowed]
+            except (OSError, ValueError):
+                continue
+            if cpus:
+                nodes.append(cpus)
+    return nodes or [allowed]
+
+class NumaTaskSlots:
+    """Caps concurrent CPU tasks per NUMA node and pins each running task to its node's cores"""
+
+    def __init__(self, nodes: list, per_node: int, intra_op_threads: int):
+        self.nodes = nodes
+        self.per_node = per_node
+        self.intra_op_threads = intra_op_threads
+        self.running = [0] * len(nodes)
+        self.condition = threading.Condition()
+
+    def available(self) -> bool:
+        with self.condition:
+            return min(self.running) < self.per_node
+
+    @contextmanager
+    def slot(self):
+        with self.condition:
+            self.condition.wait_for(lambda: min(self.running) < self.per_node)
+            node = self.running.index(min(self.running))
+            self.running[node] += 1
+
+        previous_affinity = None
         try:
-            pipeline.to('cpu')
-        except:
-            pass
-        for comp in components:
-            if hasattr(pipeline, comp) and getattr(pipeline, comp) is not None:
-                clear_model_attributes(getattr(pipeline, comp))
-                setattr(pipeline, comp, None)
-        clear_model_attributes(pipeline)
-    
+            # 亲和性和OpenMP线程数都是按线程设置的，任务线程及其计算线程都留在同一NUMA节点
+            if hasattr(os, "sched_setaffinity"):
+                previous_affinity = os.sched_getaffinity(0)
+                os.sched_setaffinity(0, self.nodes[node])
+            torch.set_num_threads(self.intra_op_threads)
+            yield node
+        finally:
+            if previous_affinity is not None:
+                os.sched_setaffinity(0, previous_affinity)
+            with self.condition:
+                self.running[node] -= 1
+                self.condition.notify_all()
+
+    def stats(self) -> dict:
+        with self.condition:
+            return {
+                "numa_nodes": len(self.nodes),
+                "cpus_per_node": [len(cpus) for cpus in self.nodes],
+                "max_tasks_per_node": self.per_node,
+                "running_per_node": list(self.running),
+                "intra_op_threads": self.intra_op_threads,
+            }
+
+def configure_cpu_backend():
+    """Tune torch threading for CPU inference and create the per-NUMA-node task slots"""
+    nodes = get_numa_nodes()
+    intra_op_threads = CPU_INTRA_OP_THREADS or max(1, min(len(cpus) for cpus in nodes) // MAX_TASKS_PER_NUMA_NODE)
+    torch.set_num_threads(intra_op_threads)
     try:
-        # Update status: Starting
-        update_task_status(task_id, "processing", "Starting 3D reconstruction process...", 0.05)
+        torch.set_num_interop_threads(CPU_INTER_OP_THREADS)
+    except RuntimeError as e:
+        # 只能在首次并行计算之前设置
+        print(f"Warning: Could not set inter-op threads: {e}")
+    print(f"CPU backend: {get_dtype()}, {len(nodes)} NUMA node(s), {intra_op_threads} threads per task, "
+          f"{MAX_TASKS_PER_NUMA_NODE} task(s) per node")
+    return NumaTaskSlots(nodes, MAX_TASKS_PER_NUMA_NODE, intra_op_threads)
+
+@functools.lru_cache(maxsize=None)
+def get_cpu_task_slots() -> Optional[NumaTaskSlots]:
+    """Per-NUMA-node task slots of the CPU backend, configured on first use; None on CUDA"""
+    return configure_cpu_backend() if get_device() == "cpu" else None
+
+class Histogram:
+    """Prometheus histogram with one label, rendered in the text exposition format"""
+
+    def __init__(self, name: str, documentation: str, buckets, label: str = "stage"):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(sorted(buckets))
+        self.label = label
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, label_value: str, value: float) -> None:
+        with self.lock:
+            series = self.series.setdefault(label_value, {"counts": [0] * (len(self.buckets) + 1), "sum": 0.0})
+            series["counts"][bisect.bisect_left(self.buckets, value)] += 1
+            series["sum"] += value
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for label_value, series in sorted(self.series.items()):
+                labels = f'{self.label}="{label_value}"'
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float("inf"),), series["counts"]):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else repr(float(bound))
+                    lines.append(f'{self.name}_bucket{{{labels},le="{le}"}} {cumulative}')
+                lines.append(f"{self.name}_sum{{{labels}}} {series['sum']}")
+                lines.append(f"{self.name}_count{{{labels}}} {cumulative}")
+        return lines
+
+class Counter:
+    """Prometheus counter with one label"""
+
+    def __init__(self, name: str, documentation: str, label: str):
+        self.name = name
+        self.documentation = documentation
+        self.label = label
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, label_value: str, amount: float = 1) -> None:
+        with self.lock:
+            self.values[label_value] = self.values.get(label_value, 0) + amount
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            for label_value, value in sorted(self.values.items()):
+                lines.append(f'{self.name}{{{self.label}="{label_value}"}} {value}')
+        return lines
+
+SECONDS_BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+BYTES_BUCKETS = tuple(2 ** i for i in range(28, 37))  # 256MB - 64GB
+
+stage_wall_seconds = Histogram("midi3d_stage_wall_seconds", "Wall time of pipeline stages", SECONDS_BUCKETS)
+stage_device_seconds = Histogram("midi3d_stage_device_seconds", "CUDA time of pipeline stages on the issuing stream", SECONDS_BUCKETS)
+stage_peak_rss_bytes = Histogram("midi3d_stage_peak_rss_bytes", "Peak process RSS during pipeline stages", BYTES_BUCKETS)
+stage_peak_vram_bytes = Histogram("midi3d_stage_peak_vram_bytes", "Peak CUDA memory allocated during pipeline stages", BYTES_BUCKETS)
+tasks_finished = Counter("midi3d_tasks_total", "Finished reconstruction tasks", "status")
+
+def peak_rss_bytes() -> Optional[int]:
+    """Lifetime peak RSS of this process, if the platform reports it"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024  # Linux以KB为单位
+
+class MemorySampler:
+    """Samples RSS and CUDA memory in the background into a fixed-size ring buffer
+
+    Stages register the tasks they run for, so every sample is also attributed to
+    the stage each running task is in; this gives per-task peaks by stage. Baselines
+    taken after models are torn down are tracked to spot memory that is never freed.
+    """
 
-        # Load models as needed
-        update_task_status(task_id, "processing", "Loading segmentation models...", 0.1)
-        load_grounding_sam()
-        
-        # 关键验证：确保模型已正确加载
-        if sam_processor is None or sam_segmentator is None or object_detector is None:
-            error_msg = "Segmentation models are not properly loaded"
-            update_task_status(task_id, "error", error_msg)
-            raise RuntimeError(error_msg)
+    def __init__(self, interval: float = MEMORY_SAMPLE_INTERVAL_SECONDS, capacity: int = MEMORY_SAMPLE_CAPACITY):
+        self.interval = interval
+        self.samples = deque(maxlen=capacity)
+        self.baselines = deque(maxlen=max(MEMORY_LEAK_WINDOW * 4, 20))
+        self.running_stages = {}  # task_id -> 当前阶段
+        self.task_peaks = {}  # task_id -> {stage: {"rss": ..., "gpu_allocated": ...}}
+        self.leak_warning = None
+        self.lock = threading.Lock()
+        self.process = psutil.Process(os.getpid())
+        self.worker = None
+
+    def start(self) -> None:
+        with self.lock:
+            # fork_server的worker继承了父进程的对象，需要采样自己的进程
+            if self.process.pid != os.getpid():
+                self.process = psutil.Process(os.getpid())
+            if self.worker is None or not self.worker.is_alive():
+                self.worker = threading.Thread(target=self._run, name="memory-sampler", daemon=True)
+                self.worker.start()
+
+    def _read(self) -> dict:
+        sample = {"t": time.time(), "rss": self.process.memory_info().rss, "gpu_allocated": None, "gpu_reserved": None}
+        # 不在采样线程里触发torch导入
+        if torch.is_loaded() and torch.cuda.is_available():
+            sample["gpu_allocated"] = torch.cuda.memory_allocated()
+            sample["gpu_reserved"] = torch.cuda.memory_reserved()
+        return sample
+
+    def _run(self) -> None:
+        while True:
+            try:
+                self.sample()
+            except Exception as e:
+                print(f"Warning: Memory sampling failed: {e}")
+            time.sleep(self.interval)
+
+    def sample(self) -> dict:
+        sample = self._read()
+        with self.lock:
+            if self.running_stages:
+                sample["stages"] = dict(self.running_stages)
+                for task_id, stage in self.running_stages.items():
+                    peak = self.task_peaks.setdefault(task_id, {}).setdefault(stage, {"rss": 0, "gpu_allocated": 0})
+                    peak["rss"] = max(peak["rss"], sample["rss"])
+                    peak["gpu_allocated"] = max(peak["gpu_allocated"], sample["gpu_allocated"] or 0)
+            self.samples.append(sample)
+        return sample
+
+    def peak(self, key: str, start: float, end: float) -> Optional[int]:
+        """Largest sampled value of key (rss, gpu_allocated, ...) between two wall clock times"""
+        with self.lock:
+            values = [sample[key] for sample in self.samples if start <= sample["t"] <= end and sample[key] is not None]
+        return max(values, default=None)
+
+    @contextmanager
+    def stage(self, stage: str, task_ids):
+        """Attribute samples taken while the block runs to stage for these tasks"""
+        task_ids = list(task_ids)
+        with self.lock:
+            previous = {task_id: self.running_stages.get(task_id) for task_id in task_ids}
+            for task_id in task_ids:
+                self.running_stages[task_id] = stage
+        # 立即采样一次，短阶段也能留下记录
+        self.sample()
+        try:
+            yield
+        finally:
+            self.sample()
+            with self.lock:
+                for task_id, stage_before in previous.items():
+                    if stage_before is None:
+                        self.running_stages.pop(task_id, None)
+                    else:
+                        self.running_stages[task_id] = stage_before
+
+    def finish_task(self, task_id: str) -> Optional[dict]:
+        """Per-stage peaks of a finished task, with the stage in which its overall RSS peak occurred"""
+        with self.lock:
+            self.running_stages.pop(task_id, None)
+            peaks = self.task_peaks.pop(task_id, None)
+        if not peaks:
+            return None
+        peak_stage = max(peaks, key=lambda stage: peaks[stage]["rss"])
+        peak_gpu_stage = max(peaks, key=lambda stage: peaks[stage]["gpu_allocated"])
+        return {
+            "peak_rss_bytes": peaks[peak_stage]["rss"],
+            "peak_rss_stage": peak_stage,
+            "peak_gpu_allocated_bytes": peaks[peak_gpu_stage]["gpu_allocated"],
+            "peak_gpu_stage": peak_gpu_stage,
+            "stages": peaks,
+        }
 
-        # Load the image
-        update_task_status(task_id, "processing", "Loading image...", 0.15)
-        rgb_image = Image.open(image_path).convert("RGB")
+    def record_baseline(self, reason: str) -> Optional[str]:
+        """Record memory after models were torn down and warn if it keeps drifting upward"""
+        sample = self._read()
+        sample["reason"] = reason
+        with self.lock:
+            self.baselines.append(sample)
+            window = list(self.baselines)[-MEMORY_LEAK_WINDOW:]
+
+        warning = None
+        if len(window) == MEMORY_LEAK_WINDOW:
+            for key in ("rss", "gpu_allocated"):
+                values = [b[key] for b in window if b[key] is not None]
+                if len(values) < MEMORY_LEAK_WINDOW:
+                    continue
+                drift_mb = (values[-1] - values[0]) / 1024**2
+                rising = all(later >= earlier for earlier, later in zip(values, values[1:]))
+                if rising and drift_mb > MEMORY_LEAK_DRIFT_MB:
+                    warning = (f"Possible memory leak: {key} baseline after teardown rose {drift_mb:.0f}MB "
+                               f"over the last {MEMORY_LEAK_WINDOW} cleanups")
+        if warning:
+            print(f"Warning: {warning}")
+            self.leak_warning = {"message": warning, "timestamp": sample["t"]}
+        return warning
+
+    def snapshot(self, seconds: Optional[float] = None) -> dict:
+        with self.lock:
+            samples = list(self.samples)
+            baselines = list(self.baselines)
+            running = dict(self.running_stages)
+        if seconds is not None:
+            cutoff = time.time() - seconds
+            samples = [sample for sample in samples if sample["t"] >= cutoff]
+        return {
+            "interval_seconds": self.interval,
+            "capacity": self.samples.maxlen,
+            "running_stages": running,
+            "samples": samples,
+            "baselines": baselines,
+            "leak_warning": self.leak_warning,
+        }
 
-        # Prepare segmentation parameters - 使用Gradio的逻辑
-        segment_kwargs = {}
+memory_sampler = MemorySampler()
 
-        if seg_mode == "box":
-            # Process bounding boxes (already formatted by the API endpoint)
-            if boxes is None or len(boxes) == 0:
-                raise ValueError("No bounding boxes provided for box mode")
+class TraceExporter:
+    """Appends finished spans to a local JSON Lines file
 
-            # The 'boxes' variable is now already in the correct format from the API endpoint
-            segment_kwargs["boxes"] = [boxes]
-            update_task_status(task_id, "processing", f"Processing {len(boxes[0])} bounding boxes...", 0.2)
-        else:
-            # Process text labels
-            if labels is None or labels == "":
-                raise ValueError("No labels provided for label mode")
+    The spans sharing a trace_id form the latency waterfall of one
+    reconstruction; the Blender add-on exports its spans in the same format
+    and trace_waterfall.py merges both files.
+    """
 
-            text_labels = labels.split(",")
-            update_task_status(task_id, "processing", f"Detecting objects with labels: {', '.join(text_labels)}...", 0.2)
-            detections = detect(object_detector, rgb_image, text_labels, detect_threshold)
-            segment_kwargs["detection_results"] = detections
+    def __init__(self, path: Optional[str]):
+        self.path = path
+        self.lock = threading.Lock()
 
-        # Run the segmentation - 使用Gradio的torch.no_grad()模式
-        update_task_status(task_id, "processing", "Running segmentation...", 0.25)
-        
-        with torch.no_grad():
-            detections = segment(
-                sam_processor,
-                sam_segmentator,
-                rgb_image,
-                polygon_refinement=polygon_refinement,
-                **segment_kwargs,
-            )
-            seg_map_pil = plot_segmentation(rgb_image, detections)
+    def export(self, span: dict) -> None:
+        if self.path is None:
+            return
+        line = json.dumps(span, default=str) + "\n"
+        try:
+            with self.lock:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                # 每个span一次追加写入一行，fork_server的多个worker可以共用同一个文件
+                with open(self.path, "a") as f:
+                    f.write(line)
+        except OSError as e:
+            print(f"Warning: Could not export span {span['name']}: {e}")
+
+trace_exporter = TraceExporter(TRACE_EXPORT_PATH)
+task_traces = {}  # task_id -> (trace_id, 根span的id, 开始时间)
+
+def make_span(trace_id: str, name: str, start: float, end: float, parent_id: Optional[str] = None,
+              span_id: Optional[str] = None, **attributes) -> dict:
+    return {
+        "trace_id": trace_id,
+        "span_id": span_id or uuid.uuid4().hex[:16],
+        "parent_id": parent_id,
+        "service": "server",
+        "name": name,
+        "start": start,
+        "end": end,
+        "duration_ms": round((end - start) * 1000, 1),
+        "attributes": attributes,
+    }
 
-        # Save segmentation result temporarily
-        seg_path = os.path.join(TMP_DIR, f"{task_id}_seg.png")
-        seg_map_pil.save(seg_path)
+def start_task_trace(task_id: str, trace_id: str, started_at: float) -> None:
+    """Open the root span of a task on the server; its stage spans become children of it"""
+    task_traces[task_id] = (trace_id, uuid.uuid4().hex[:16], started_at)
 
-        # Clean up segmentation models to free memory
-        update_task_status(task_id, "processing", "Cleaning up segmentation models...", 0.25)
-        if models_loaded["grounding_sam"]:
+def record_task_span(task_id: str, name: str, start: float, end: float, **attributes) -> None:
+    """Export a span of a traced task; times are wall-clock seconds so client and server spans line up"""
+    trace = task_traces.get(task_id)
+    if trace is None:
+        return
+    trace_exporter.export(make_span(trace[0], name, start, end, parent_id=trace[1], task_id=task_id, **attributes))
+
+def finish_task_trace(task_id: str, status: str) -> None:
+    """Close the root span of a task, from the upload being received to completion or failure"""
+    trace = task_traces.pop(task_id, None)
+    if trace is None:
+        return
+    trace_id, span_id, started_at = trace
+    trace_exporter.export(make_span(trace_id, "reconstruction", started_at, time.time(), span_id=span_id, task_id=task_id, status=status))
+
+stage_metrics_lock = threading.Lock()
+stage_metrics_active = 0  # 正在测量的阶段数
+
+@contextmanager
+def stage_metrics(stage: str):
+    """Record wall time, CUDA time and peak RSS/VRAM of a stage into the /metrics histograms
+
+    The CUDA peak counter is process-wide, so it is only reset when no other stage is
+    being measured; a stage that overlaps one already running takes its peak VRAM
+    from the memory sampler instead.
+    """
+    global stage_metrics_active
+    process = psutil.Process(os.getpid())
+    rss_start = process.memory_info().rss
+    lifetime_peak_start = peak_rss_bytes()
+
+    with stage_metrics_lock:
+        exclusive = stage_metrics_active == 0
+        stage_metrics_active += 1
+
+    cuda_events = None
+    vram_start = None
+    if torch.is_loaded() and torch.cuda.is_available():
+        # 其他阶段正在测量时重置会清掉它们的峰值
+        if exclusive:
+            torch.cuda.reset_peak_memory_stats()
+        vram_start = torch.cuda.memory_allocated()
+        cuda_events = (torch.cuda.Event(enable_timing=True), torch.cuda.Event(enable_timing=True))
+        cuda_events[0].record()
+
+    wall_start = time.time()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        with stage_metrics_lock:
+            stage_metrics_active -= 1
+        stage_wall_seconds.observe(stage, time.perf_counter() - start)
+
+        # 本阶段内若进程RSS创了新高，峰值就是新的进程峰值；否则取开始和结束时的较大值
+        rss_peak = max(rss_start, process.memory_info().rss)
+        lifetime_peak_end = peak_rss_bytes()
+        if lifetime_peak_end is not None and lifetime_peak_end > lifetime_peak_start:
+            rss_peak = max(rss_peak, lifetime_peak_end)
+        stage_peak_rss_bytes.observe(stage, rss_peak)
+
+        if cuda_events is None and torch.is_loaded() and torch.cuda.is_available():
+            # 本阶段首次加载了torch，峰值从阶段开始起统计
+            stage_peak_vram_bytes.observe(stage, torch.cuda.max_memory_allocated())
+        elif cuda_events is not None:
+            cuda_events[1].record()
+            cuda_events[1].synchronize()
+            stage_device_seconds.observe(stage, cuda_events[0].elapsed_time(cuda_events[1]) / 1000)
+            if exclusive:
+                vram_peak = torch.cuda.max_memory_allocated()
+            else:
+                sampled = memory_sampler.peak("gpu_allocated", wall_start, time.time())
+                vram_peak = max(vram_start, torch.cuda.memory_allocated(), sampled or 0)
+            stage_peak_vram_bytes.observe(stage, vram_peak)
+
+@contextmanager
+def measure_stage(stage: str, task_ids=()):
+    """Feed a stage into /metrics, attribute memory samples taken meanwhile to it and trace it for these tasks"""
+    start = time.time()
+    error = None
+    try:
+        with memory_sampler.stage(stage, task_ids), stage_metrics(stage):
+            yield
+    except Exception as e:
+        error = type(e).__name__
+        raise
+    finally:
+        end = time.time()
+        for task_id in task_ids:
+            record_task_span(task_id, stage, start, end, tasks=len(task_ids), error=error)
+
+def render_metrics() -> str:
+    """All metrics in the Prometheus text exposition format"""
+    lines = []
+    for metric in (stage_wall_seconds, stage_device_seconds, stage_peak_rss_bytes, stage_peak_vram_bytes, tasks_finished):
+        lines.extend(metric.render())
+
+    lines.append("# HELP midi3d_process_resident_memory_bytes Current process RSS")
+    lines.append("# TYPE midi3d_process_resident_memory_bytes gauge")
+    lines.append(f"midi3d_process_resident_memory_bytes {psutil.Process(os.getpid()).memory_info().rss}")
+    if torch.is_loaded() and torch.cuda.is_available():
+        lines.append("# HELP midi3d_cuda_allocated_bytes Current CUDA memory allocated")
+        lines.append("# TYPE midi3d_cuda_allocated_bytes gauge")
+        lines.append(f"midi3d_cuda_allocated_bytes {torch.cuda.memory_allocated()}")
+
+    lines.append("# HELP midi3d_queue_depth Tasks queued or running")
+    lines.append("# TYPE midi3d_queue_depth gauge")
+    lines.append(f"midi3d_queue_depth {get_queue_depth()}")
+
+    lines.append("# HELP midi3d_model_loaded Whether a shared model is loaded")
+    lines.append("# TYPE midi3d_model_loaded gauge")
+    for name, stats in model_registry.stats().items():
+        lines.append(f'midi3d_model_loaded{{model="{name}"}} {int(stats["loaded"])}')
+    return "\n".join(lines) + "\n"
+
+@contextmanager
+def timed_stage(stage: str, stage_timings: dict, queue_depth: int = 0, record: bool = True, task_ids=()):
+    """Measure the wall time of a pipeline stage and feed it into the timing profile and /metrics"""
+    start = time.perf_counter()
+    with measure_stage(stage, task_ids):
+        yield
+    seconds = time.perf_counter() - start
+    stage_timings[stage] = round(stage_timings.get(stage, 0.0) + seconds, 3)
+    if record:
+        timing_profile.record(stage, seconds, queue_depth)
+
+def cleanup_pipeline(pipeline, components):
+    """封装的清理函数，避免重复代码"""
+    if pipeline is None:
+        return
+    try:
+        pipeline.to('cpu')
+    except:
+        pass
+    for comp in components:
+        if hasattr(pipeline, comp) and getattr(pipeline, comp) is not None:
+            clear_model_attributes(getattr(pipeline, comp))
+            setattr(pipeline, comp, None)
+    clear_model_attributes(pipeline)
+
+def unload_grounding_sam(models):
+    """Tear down Grounding SAM (object_detector, sam_processor, sam_segmentator)"""
+    object_detector, _, sam_segmentator = models
+    try:
+        clear_model_attributes(object_detector)
+        clear_model_attributes(sam_segmentator)
+    except Exception as e:
+        print(f"Warning: Error during cleanup: {e}")
+
+def unload_midi_model(pipe):
+    """Tear down the MIDI pipeline"""
+    cleanup_pipeline(pipe, ['unet', 'vae', 'text_encoder', 'tokenizer', 'scheduler',
+                            'feature_extractor', 'image_encoder', 'safety_checker'])
+
+def unload_mv_adapter(models):
+    """Tear down MV-Adapter (ig2mv_pipe, texture_pipe)"""
+    # 清理ig2mv_pipe和texture_pipe - 使用正确的变量引用
+    for pipeline in models:
+        cleanup_pipeline(pipeline, ['unet', 'vae', 'text_encoder', 'tokenizer', 'scheduler'])
+
+class ModelEntry:
+    """A registered model with its loader, unloader and lease count"""
+
+    def __init__(self, name: str, loader, unloader, host_loader=None, to_device=None):
+        self.name = name
+        self.loader = loader
+        self.unloader = unloader
+        self.host_loader = host_loader  # 可选：把权重读入主机内存，供预取使用
+        self.to_device = to_device  # 可选：把预取的主机副本移动到设备
+        self.prefetch_future = None
+        self.prefetch_report = None
+        self.shared_host_models = None  # fork_server在fork前加载的主机副本，各worker写时复制共享
+        self.models_shared = False
+        self.models = None
+        self.refcount = 0
+        self.unload_requested = False
+        self.load_count = 0
+        # 加载和卸载在该锁内完成，同一模型的其他申请者会等待而不是重复加载
+        self.lock = threading.RLock()
+
+class ModelRegistry:
+    """Hands out refcounted leases on shared models
+
+    Tasks lease a model for as long as they run inference on it. A model is loaded
+    by the first lease and torn down only once an unload has been requested and
+    the last lease is released, so overlapping tasks share one loaded copy and
+    never lose it in the middle of inference.
+    """
+
+    def __init__(self):
+        self.entries = {}
+        self.prefetch_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="model-prefetch")
+
+    def register(self, name: str, loader, unloader, host_loader=None, to_device=None) -> None:
+        self.entries[name] = ModelEntry(name, loader, unloader, host_loader, to_device)
+
+    def preload_shared(self, name: str) -> bool:
+        """Load an unpinned host copy to be shared copy-on-write by forked workers
+
+        Must run before any CUDA initialization, since forked children cannot use a
+        CUDA context created by their parent. Returns False if not applicable.
+        """
+        entry = self.entries[name]
+        if entry.host_loader is None:
+            return False
+        with entry.lock:
+            if entry.shared_host_models is None:
+                entry.shared_host_models = entry.host_loader(pin=False)
+        return True
+
+    def prefetch(self, name: str) -> bool:
+        """Start reading a model into host memory in the background; returns False if not applicable"""
+        entry = self.entries[name]
+        with entry.lock:
+            if (entry.host_loader is None or entry.models is not None or entry.prefetch_future is not None
+                    or entry.shared_host_models is not None):
+                return False
+            print(f"Prefetching {name} to host memory in the background...")
+            entry.prefetch_future = self.prefetch_executor.submit(self._load_to_host, entry)
+            return True
+
+    @staticmethod
+    def _load_to_host(entry: ModelEntry):
+        start = time.perf_counter()
+        host_models = entry.host_loader()
+        return host_models, time.perf_counter() - start
+
+    def take_prefetch_report(self, name: str) -> Optional[dict]:
+        """Timings of the prefetch used by the last load of this model, reported once"""
+        entry = self.entries[name]
+        with entry.lock:
+            report, entry.prefetch_report = entry.prefetch_report, None
+            return report
+
+    def _load(self, entry: ModelEntry):
+        """Load a model, finishing from the shared or prefetched host copy when there is one"""
+        if entry.shared_host_models is not None:
+            entry.models_shared = True
+            host_models = entry.shared_host_models
+            if get_device() == "cpu" and OFFLOAD_MODE != "stream":
+                # CPU推理只读权重，直接使用共享副本
+                return entry.to_device(host_models)
+            # 分块传输需要锁页内存，先复制一份主机副本；否则直接复制到设备
+            clone_device = "cpu" if OFFLOAD_MODE == "stream" else get_device()
+            return entry.to_device(clone_pipeline_to_device(host_models, clone_device))
+
+        future, entry.prefetch_future = entry.prefetch_future, None
+        if future is not None:
+            wait_start = time.perf_counter()
             try:
-                if object_detector is not None:
-                    clear_model_attributes(object_detector)
-                if sam_segmentator is not None:
-                    clear_model_attributes(sam_segmentator)
+                host_models, host_seconds = future.result()
             except Exception as e:
-                print(f"Warning: Error during cleanup: {e}")
+                print(f"Warning: Prefetch of {entry.name} failed, loading directly: {e}")
+            else:
+                waited = time.perf_counter() - wait_start
+                transfer_start = time.perf_counter()
+                models = entry.to_device(host_models)
+                transfer = time.perf_counter() - transfer_start
+                # 预取与上一阶段计算重叠的时间 = 主机加载耗时 - 本阶段实际等待的时间
+                entry.prefetch_report = {
+                    "host_load_seconds": round(host_seconds, 3),
+                    "waited_seconds": round(waited, 3),
+                    "overlap_seconds": round(max(host_seconds - waited, 0.0), 3),
+                    "transfer_seconds": round(transfer, 3),
+                }
+                return models
+        return entry.loader()
+
+    def is_loaded(self, name: str) -> bool:
+        return self.entries[name].models is not None
+
+    def acquire(self, name: str):
+        """Take a lease, loading the model if nobody holds it yet"""
+        entry = self.entries[name]
+        with entry.lock:
+            if entry.models is None:
+                entry.models = self._load(entry)
+                entry.load_count += 1
+            entry.refcount += 1
+            return entry.models
+
+    def release(self, name: str, unload: bool = False) -> bool:
+        """Return a lease; with unload=True the model is torn down once nobody holds it
+
+        Returns True if the model was unloaded by this call.
+        """
+        entry = self.entries[name]
+        with entry.lock:
+            if entry.refcount <= 0:
+                raise RuntimeError(f"Model {name} released more often than acquired")
+            entry.refcount -= 1
+            if unload:
+                entry.unload_requested = True
+            if entry.refcount == 0 and entry.unload_requested:
+                self._unload(entry)
+                return True
+            return False
+
+    @contextmanager
+    def lease(self, name: str, unload: bool = False):
+        models = self.acquire(name)
+        try:
+            yield models
+        finally:
+            self.release(name, unload=unload)
+
+    def _unload(self, entry: ModelEntry) -> None:
+        models, entry.models = entry.models, None
+        entry.unload_requested = False
+        shared, entry.models_shared = entry.models_shared, False
+        if models is not None:
+            print(f"Unloading {entry.name}...")
+            # 由共享副本得到的模型可能引用共享权重，只释放引用，不做清理
+            if not shared:
+                entry.unloader(models)
+            del models
+            aggressive_cleanup()
 
-            object_detector = None
-            sam_processor = None
-            sam_segmentator = None
-            models_loaded["grounding_sam"] = False
+    def unload_all(self) -> list:
+        """Unload every idle model now and mark leased ones for unloading; returns the busy names"""
+        busy = []
+        for entry in self.entries.values():
+            with entry.lock:
+                # 丢弃尚未使用的预取副本
+                entry.prefetch_future = None
+                if entry.refcount == 0:
+                    self._unload(entry)
+                elif entry.models is not None:
+                    entry.unload_requested = True
+                    busy.append(entry.name)
+        return busy
+
+    def stats(self) -> dict:
+        return {
+            name: {
+                "loaded": entry.models is not None,
+                "leases": entry.refcount,
+                "unload_requested": entry.unload_requested,
+                "load_count": entry.load_count,
+                "prefetching": entry.prefetch_future is not None,
+                "shared_host_copy": entry.shared_host_models is not None,
+            }
+            for name, entry in self.entries.items()
+        }
 
-            aggressive_cleanup()
+model_registry = ModelRegistry()
+model_registry.register("grounding_sam", load_grounding_sam, unload_grounding_sam)
+model_registry.register(
+    "midi", load_midi_model, unload_midi_model,
+    host_loader=load_midi_model_to_host, to_device=move_pipeline_to_device,
+)
+model_registry.register(
+    "mv_adapter", load_mv_adapter, unload_mv_adapter,
+    host_loader=load_mv_adapter_to_host, to_device=mv_adapter_to_device,
+)
 
-        # Load MIDI model
-        update_task_status(task_id, "processing", "Loading 3D generation model...", 0.3)
-        load_midi_model()
+class ReconstructionTask:
+    """Per-task state carried through the pipeline stages"""
+
+    def __init__(
+        self,
+        task_id: str,
+        rgb_image: Image.Image,
+        seg_mode: str = "box",
+        boxes: Optional[List[Any]] = None,
+        labels: Optional[str] = None,
+        polygon_refinement: bool = True,
+        detect_threshold: float = 0.3,
+        deadline_seconds: Optional[float] = None,
+        optimize_mesh: bool = False,
+        lod_ratios: tuple = (),
+        texture_export: Optional[dict] = None,
+    ):
+        self.task_id = task_id
+        self.rgb_image = rgb_image
+        self.seg_mode = seg_mode
+        self.boxes = boxes
+        self.labels = labels
+        self.polygon_refinement = polygon_refinement
+        self.detect_threshold = detect_threshold
+        self.deadline_seconds = deadline_seconds
+        self.optimize_mesh = optimize_mesh or bool(lod_ratios)
+        self.lod_ratios = tuple(lod_ratios)
+        self.texture_export = texture_export
+
+        self.submitted_at = task_statuses.get(task_id, {}).get("submitted_at", time.time())
+        self.queue_depth = 0
+        self.stage_timings = {}
+        self.num_inference_steps = DEFAULT_MIDI_STEPS
+        self.texture_preset = "full"
+        self.texture_kwargs = {}
+        self.segmentation = None
+        self.mesh_lods = None
+        self.texture_stats = None
+        self.failed = False
+
+        self.seg_path = os.path.join(TMP_DIR, f"{task_id}_seg.npz")
+        self.scene_path = os.path.join(TMP_DIR, f"{task_id}_scene.glb")
+        self.output_dir = os.path.join(TMP_DIR, f"textured_{task_id}")
+        self.final_model_path = os.path.join(self.output_dir, "textured_scene.glb")
+
+    def lod_path(self, level: int) -> str:
+        return lod_model_path(self.task_id, level)
+
+    def elapsed(self) -> float:
+        return time.time() - self.submitted_at
+
+    def remaining(self) -> float:
+        return self.deadline_seconds - self.elapsed()
+
+    def status(self, message: str, progress: float, **extra) -> None:
+        update_task_status(self.task_id, "processing", message, progress, **extra)
+
+    def fail(self, error: Exception) -> None:
+        self.failed = True
+        tasks_finished.inc("error")
+        update_task_status(
+            self.task_id, "error", f"Error during processing: {str(error)}",
+            actual_seconds=round(self.elapsed(), 1), memory_peaks=memory_sampler.finish_task(self.task_id),
+        )
+        finish_task_trace(self.task_id, "error")
+        print(f"Error processing task {self.task_id}: {str(error)}")
+        import traceback
+        traceback.print_exc()
 
-        # Generate 3D scene - 使用Gradio的torch.no_grad()和autocast
-        update_task_status(task_id, "processing", "Generating 3D scene...", 0.5)
-        
-        with torch.no_grad():
-            with torch.autocast(device_type=DEVICE, dtype=DTYPE):
-                scene = run_midi(
-                    pipe,
-                    rgb_image,
-                    seg_map_pil,
-                    seed=42,  # Fixed seed for reproducibility
-                    num_inference_steps=35,
-                    guidance_scale=7.0,
-                    do_image_padding=True,
-                )
+def active_tasks(tasks: list) -> list:
+    return [task for task in tasks if not task.failed]
 
-        # Save the 3D scene
-        scene_path = os.path.join(TMP_DIR, f"{task_id}_scene.glb")
-        scene.export(scene_path)
+def for_each_task(tasks: list, step) -> None:
+    """Run step on every task that has not failed yet; an error only fails that task"""
+    for task in active_tasks(tasks):
+        try:
+            step(task)
+        except Exception as e:
+            task.fail(e)
 
-        # Clean up MIDI model to free memory
-        update_task_status(task_id, "processing", "Cleaning up 3D generation model...", 0.6)
-        if models_loaded["midi"] and pipe is not None:
-            try:
-                pipe.to('cpu')
-            except:
-                pass
+@contextmanager
+def shared_stage(stage: str, tasks: list, record: bool = True):
+    """Time a stage shared by several tasks (model loading) and attribute it to each of them"""
+    shared = {}
+    queue_depth = max((task.queue_depth for task in tasks), default=0)
+    try:
+        with timed_stage(stage, shared, queue_depth, record=record, task_ids=[task.task_id for task in tasks]):
+            yield
+    except Exception as e:
+        for task in active_tasks(tasks):
+            task.fail(e)
+        return
+    for task in tasks:
+        task.stage_timings[stage] = round(task.stage_timings.get(stage, 0.0) + shared[stage], 3)
+
+def acquire_for_stage(name: str, tasks: list):
+    """Lease a model for a stage, timing the load and reporting prefetch overlap per task"""
+    models = None
+    with shared_stage(f"load_{name}", tasks, record=not model_registry.is_loaded(name)):
+        models = model_registry.acquire(name)
+    report = model_registry.take_prefetch_report(name)
+    if report is not None:
+        for task in tasks:
+            task.stage_timings[f"prefetch_{name}"] = report
+    return models
+
+def plan_task(task: ReconstructionTask) -> None:
+    """Validate inputs and choose quality settings, from the deadline if one was given"""
+    if task.seg_mode == "box":
+        if task.boxes is None or len(task.boxes) == 0:
+            raise ValueError("No bounding boxes provided for box mode")
+    elif task.labels is None or not normalize_labels(task.labels):
+        raise ValueError("No labels provided for label mode")
+
+    task.queue_depth = get_queue_depth(exclude_task_id=task.task_id)
+
+    # 确定推理步数和纹理预设：指定了截止时间时根据实测耗时自动选择
+    if task.deadline_seconds is not None:
+        num_objects = len(task.boxes[0]) if task.seg_mode == "box" else len(normalize_labels(task.labels))
+        plan = choose_quality_settings(task.remaining(), num_objects, task.queue_depth)
+        task.num_inference_steps = plan["num_inference_steps"]
+        task.texture_preset = plan["texture_preset"]
+        task.status(
+            "Planning quality settings for deadline...", 0.02,
+            chosen_settings=plan, predicted_seconds=round(task.elapsed() + plan["predicted_seconds"], 1),
+        )
 
-            components = ['unet', 'vae', 'text_encoder', 'tokenizer', 'scheduler', 
-                         'feature_extractor', 'image_encoder', 'safety_checker']
+    if task.texture_preset not in available_texture_presets():
+        task.texture_preset = "none"
 
-            for comp in components:
-                if hasattr(pipe, comp) and getattr(pipe, comp) is not None:
-                    clear_model_attributes(getattr(pipe, comp))
-                    setattr(pipe, comp, None)
+    # Update status: Starting
+    task.status("Starting 3D reconstruction process...", 0.05)
 
-            clear_model_attributes(pipe)
-            pipe = None
-            models_loaded["midi"] = False
+def run_segmentation_stage(tasks: list) -> None:
+    """Detect and segment every task, batching them through the segmentation batcher"""
+    tasks = active_tasks(tasks)
+    if not tasks:
+        return
 
-            aggressive_cleanup()
+    # Load models as needed
+    for task in tasks:
+        task.status("Loading segmentation models...", 0.1)
+    if acquire_for_stage("grounding_sam", tasks) is None:
+        return
 
-        # Load MV-Adapter models
-        update_task_status(task_id, "processing", "Loading texture generation models...", 0.7)
-        load_mv_adapter()
+    try:
+        # 分割期间在后台预取MIDI权重
+        if PREFETCH_NEXT_STAGE:
+            model_registry.prefetch("midi")
+
+        # 所有任务一起进入批处理队列，按批次执行检测和分割
+        def collect(task):
+            task.segmentation = futures[task.task_id].result()
+            seconds = time.perf_counter() - start
+            task.stage_timings["segment"] = round(seconds, 3)
+            timing_profile.record("segment", seconds, task.queue_depth)
+
+            # Save the compact segmentation so clients can fetch and compare it
+            task.segmentation.save(task.seg_path)
+
+        # Prepare the segmentation jobs - 使用Gradio的逻辑
+        futures = {}
+        start = time.perf_counter()
+        with measure_stage("segment", [task.task_id for task in active_tasks(tasks)]):
+            for task in active_tasks(tasks):
+                if task.seg_mode == "box":
+                    job = SegmentationJob(task.rgb_image, boxes=task.boxes[0], polygon_refinement=task.polygon_refinement)
+                    message = f"Segmenting {len(task.boxes[0])} bounding boxes..."
+                else:
+                    text_labels = normalize_labels(task.labels)
+                    job = SegmentationJob(
+                        task.rgb_image, labels=text_labels,
+                        detect_threshold=task.detect_threshold, polygon_refinement=task.polygon_refinement,
+                    )
+                    message = f"Detecting and segmenting objects with labels: {', '.join(text_labels)}..."
+                task.status(message, 0.2)
+                futures[task.task_id] = segmentation_batcher.enqueue(job)
+
+            for_each_task(tasks, collect)
+    finally:
+        # Clean up segmentation models to free memory
+        for task in active_tasks(tasks):
+            task.status("Cleaning up segmentation models...", 0.25)
+        # 有预览请求或其他任务正在排队分割时保留模型
+        keep_warm = (time.time() - last_preview_at < PREVIEW_KEEP_WARM_SECONDS
+                     or segmentation_batcher.pending() > 0)
+        with shared_stage("cleanup", tasks, record=False):
+            model_registry.release("grounding_sam", unload=not keep_warm)
+
+def run_midi_stage(tasks: list) -> None:
+    """Generate a 3D scene for every task with one MIDI load"""
+    tasks = active_tasks(tasks)
+    if not tasks:
+        return
 
-        # Apply textures - 使用Gradio的torch.no_grad()模式
-        update_task_status(task_id, "processing", "Applying textures to 3D model...", 0.8)
-        scene = trimesh.load(scene_path, process=False)
+    # Load MIDI model
+    for task in tasks:
+        task.status("Loading 3D generation model...", 0.3)
+    pipe = acquire_for_stage("midi", tasks)
+    if pipe is None:
+        return
 
-        # Create a temporary directory for textured model
-        tmp_dir = os.path.join(TMP_DIR, f"textured_{task_id}")
-        os.makedirs(tmp_dir, exist_ok=True)
+    try:
+        # 生成3D场景期间在后台预取纹理模型
+        if PREFETCH_NEXT_STAGE and any(TEXTURE_PRESETS[task.texture_preset] is not None for task in tasks):
+            model_registry.prefetch("mv_adapter")
+
+        def generate(task):
+            # Generate 3D scene - 使用Gradio的torch.no_grad()和autocast
+            task.status(f"Generating 3D scene ({task.num_inference_steps} steps)...", 0.5)
+
+            with timed_stage("midi", task.stage_timings, record=False, task_ids=[task.task_id]):
+                with torch.no_grad():
+                    with inference_autocast():
+                        scene = inference_midi.run_midi(
+                            pipe,
+                            task.rgb_image,
+                            task.segmentation.render(task.rgb_image),
+                            seed=42,  # Fixed seed for reproducibility
+                            num_inference_steps=task.num_inference_steps,
+                            guidance_scale=7.0,
+                            do_image_padding=True,
+                        )
+            timing_profile.record("midi_step", task.stage_timings["midi"] / task.num_inference_steps, task.queue_depth)
+
+            # Save the 3D scene
+            with timed_stage("midi_export", task.stage_timings, task.queue_depth, task_ids=[task.task_id]):
+                scene.export(task.scene_path)
+
+        for_each_task(tasks, generate)
+    finally:
+        # Clean up MIDI model to free memory
+        for task in active_tasks(tasks):
+            task.status("Cleaning up 3D generation model...", 0.6)
+        with shared_stage("cleanup", tasks, record=False):
+            model_registry.release("midi", unload=True)
+
+def run_texture_stage(tasks: list) -> None:
+    """Texture every task that needs it with one MV-Adapter load"""
+    tasks = active_tasks(tasks)
+
+    def choose_preset(task):
+        # 根据剩余时间和实际物体数量重新选择纹理预设
+        if task.deadline_seconds is not None:
+            task.texture_preset = choose_texture_preset(task.remaining(), len(task.segmentation), task.queue_depth)
+        os.makedirs(task.output_dir, exist_ok=True)
+
+        task.texture_kwargs = TEXTURE_PRESETS[task.texture_preset]
+        if task.texture_kwargs is None:
+            # 截止时间不足以生成纹理，直接输出未贴图的场景
+            task.status("Skipping textures to meet the deadline...", 0.9)
+            os.replace(task.scene_path, task.final_model_path)
+        else:
+            task.texture_kwargs = supported_kwargs(image_to_textured_scene.run_i2tex, task.texture_kwargs)
 
-        with torch.no_grad():
-            # Generate textured scene
-            textured_scene = run_i2tex(
-                ig2mv_pipe,
-                texture_pipe,
-                scene,
-                rgb_image,
-                seg_map_pil,
-                seed=42,  # Fixed seed for reproducibility
-                output_dir=tmp_dir,
+    for_each_task(tasks, choose_preset)
+    tasks = [task for task in active_tasks(tasks) if task.texture_kwargs is not None]
+    if not tasks:
+        return
+
+    # Load MV-Adapter models
+    for task in tasks:
+        task.status("Loading texture generation models...", 0.7)
+    models = acquire_for_stage("mv_adapter", tasks)
+    if models is None:
+        return
+    try:
+        ig2mv_pipe, texture_pipe = models
+
+        def texture(task):
+            # Apply textures - 使用Gradio的torch.no_grad()模式
+            task.status("Applying textures to 3D model...", 0.8)
+            scene = trimesh.load(task.scene_path, process=False)
+
+            with timed_stage("texture", task.stage_timings, record=False, task_ids=[task.task_id]):
+                with torch.no_grad():
+                    # Generate textured scene
+                    textured_scene = image_to_textured_scene.run_i2tex(
+                        ig2mv_pipe,
+                        texture_pipe,
+                        scene,
+                        task.rgb_image,
+                        task.segmentation.render(task.rgb_image),
+                        seed=42,  # Fixed seed for reproducibility
+                        output_dir=task.output_dir,
+                        **task.texture_kwargs,
+                    )
+            timing_profile.record(
+                f"texture_{task.texture_preset}",
+                task.stage_timings["texture"] / max(len(task.segmentation), 1), task.queue_depth,
             )
 
-        # Export the final textured model
-        final_model_path = os.path.join(tmp_dir, "textured_scene.glb")
-        textured_scene.export(final_model_path)
+            # Export the final textured model
+            with timed_stage("texture_export", task.stage_timings, record=False, task_ids=[task.task_id]):
+                textured_scene.export(task.final_model_path)
 
-        # Clean up MV-Adapter models - 修复后的部分
-        update_task_status(task_id, "processing", "Cleaning up texture generation models...", 0.9)
-        if models_loaded["mv_adapter"]:
-            # 清理ig2mv_pipe - 使用正确的变量引用
-            if ig2mv_pipe is not None:
-                cleanup_pipeline(ig2mv_pipe, ['unet', 'vae', 'text_encoder', 'tokenizer', 'scheduler'])
+        for_each_task(tasks, texture)
+    finally:
+        # Clean up MV-Adapter models
+        for task in active_tasks(tasks):
+            task.status("Cleaning up texture generation models...", 0.9)
+        with shared_stage("cleanup", tasks, record=False):
+            model_registry.release("mv_adapter", unload=True)
 
-            # 清理texture_pipe - 使用正确的变量引用
-            if texture_pipe is not None:
-                cleanup_pipeline(texture_pipe, ['unet', 'vae', 'text_encoder', 'tokenizer', 'scheduler'])
+def lod_model_path(task_id: str, level: int) -> str:
+    """LOD 0 is the final model itself; higher levels are decimated copies next to it"""
+    name = "textured_scene.glb" if level == 0 else f"textured_scene_lod{level}.glb"
+    return os.path.join(TMP_DIR, f"textured_{task_id}", name)
 
-            ig2mv_pipe = None
-            texture_pipe = None
-            models_loaded["mv_adapter"] = False
+def mesh_decimation_available() -> bool:
+    return any(importlib.util.find_spec(name) is not None for name in MESH_DECIMATION_BACKENDS)
 
-            aggressive_cleanup()
+def scene_meshes(scene) -> dict:
+    """Triangle meshes of a scene by geometry name (point clouds and paths are left alone)"""
+    return {name: geometry for name, geometry in scene.geometry.items() if isinstance(geometry, trimesh.Trimesh)}
 
-        # Final cleanup
-        update_task_status(task_id, "processing", "Finalizing model...", 0.95)
+def count_faces(scene) -> int:
+    return sum(len(mesh.faces) for mesh in scene_meshes(scene).values())
 
-        # Clean up temporary files
-        if os.path.exists(seg_path):
-            os.remove(seg_path)
-        if os.path.exists(scene_path):
-            os.remove(scene_path)
+def clean_mesh(mesh) -> None:
+    """Weld duplicate vertices and drop degenerate and duplicate faces in place
 
-        # Update status: Complete
-        update_task_status(task_id, "completed", "3D model with textures generated successfully!", 1.0, f"/download/{task_id}")
+    merge_vertices keeps vertices apart where their UVs differ, so texture seams survive.
+    """
+    mesh.merge_vertices()
+    if hasattr(mesh, "nondegenerate_faces"):
+        mesh.update_faces(mesh.nondegenerate_faces())
+    else:
+        mesh.remove_degenerate_faces()  # trimesh < 4
+    mesh.update_faces(mesh.unique_faces())
+    mesh.remove_unreferenced_vertices()
+
+def transfer_vertex_attributes(source, target) -> None:
+    """Give each vertex of a simplified mesh the UV or color of the nearest source vertex"""
+    visual = source.visual
+    if visual.kind not in ("texture", "vertex"):
+        return
+    _, nearest = source.kdtree.query(target.vertices)
+    if visual.kind == "texture":
+        if visual.uv is not None:
+            target.visual = trimesh.visual.TextureVisuals(uv=visual.uv[nearest], material=visual.material)
+    else:
+        target.visual.vertex_colors = visual.vertex_colors[nearest]
+
+def decimate_mesh(mesh, ratio: float):
+    """Quadric decimation to ratio of the faces, keeping textures by transferring vertex attributes"""
+    face_count = max(MESH_LOD_MIN_FACES, int(len(mesh.faces) * ratio))
+    if face_count >= len(mesh.faces):
+        return mesh.copy()
+    simplified = mesh.simplify_quadric_decimation(face_count=face_count)
+    transfer_vertex_attributes(mesh, simplified)
+    return simplified
+
+def decimate_scene(scene, ratio: float):
+    lod = scene.copy()
+    for name, mesh in scene_meshes(scene).items():
+        lod.geometry[name] = decimate_mesh(mesh, ratio)
+    return lod
+
+def downscale_material_textures(material, max_size: int) -> int:
+    """Shrink every texture of a material to max_size pixels on its long side, returns how many were shrunk"""
+    resized = 0
+    for slot in TEXTURE_IMAGE_SLOTS:
+        image = getattr(material, slot, None)
+        if isinstance(image, Image.Image) and max(image.size) > max_size:
+            image = image.copy()
+            image.thumbnail((max_size, max_size), Image.LANCZOS)
+            setattr(material, slot, image)
+            resized += 1
+    return resized
+
+def texture_area(mesh) -> int:
+    image = getattr(mesh.visual.material, "image", None)
+    return image.size[0] * image.size[1] if image is not None else 0
+
+def is_texture_mapped(mesh) -> bool:
+    visual = mesh.visual
+    return visual.kind == "texture" and visual.uv is not None and getattr(visual.material, "image", None) is not None
+
+def pack_texture_atlases(meshes: list, atlas_size: int = TEXTURE_ATLAS_MAX_SIZE) -> int:
+    """Repack per-mesh textures into shared atlases, grouping meshes so each atlas stays within atlas_size
+
+    Returns the number of atlases created.
+    """
+    groups, group, area = [], [], 0
+    for mesh in sorted(filter(is_texture_mapped, meshes), key=texture_area, reverse=True):
+        if group and area + texture_area(mesh) > TEXTURE_ATLAS_FILL * atlas_size ** 2:
+            groups.append(group)
+            group, area = [], 0
+        group.append(mesh)
+        area += texture_area(mesh)
+    groups.append(group)
+
+    atlases = 0
+    for group in groups:
+        if len(group) < 2:
+            continue
+        material, uv = trimesh.visual.material.pack(**supported_kwargs(trimesh.visual.material.pack, {
+            "materials": [mesh.visual.material for mesh in group],
+            "uvs": [mesh.visual.uv for mesh in group],
+            "max_tex_size_fused": atlas_size,
+        }))
+        offsets = np.cumsum([0] + [len(mesh.visual.uv) for mesh in group])
+        for mesh, begin, end in zip(group, offsets[:-1], offsets[1:]):
+            mesh.visual = trimesh.visual.TextureVisuals(uv=uv[begin:end], material=material)
+        atlases += 1
+    return atlases
+
+GLB_JSON_CHUNK = 0x4E4F534A
+GLB_BIN_CHUNK = 0x004E4942
+
+def read_glb(path: str) -> tuple:
+    """The JSON document and binary chunk of a glTF 2.0 binary file"""
+    with open(path, "rb") as f:
+        data = f.read()
+    magic, version, length = struct.unpack_from("<4sII", data, 0)
+    if magic != b"glTF" or version != 2:
+        raise ValueError(f"{path} is not a glTF 2.0 binary")
+    gltf, binary = None, b""
+    offset = 12
+    while offset < length:
+        chunk_length, chunk_type = struct.unpack_from("<II", data, offset)
+        chunk = data[offset + 8:offset + 8 + chunk_length]
+        if chunk_type == GLB_JSON_CHUNK:
+            gltf = json.loads(chunk)
+        elif chunk_type == GLB_BIN_CHUNK:
+            binary = chunk
+        offset += 8 + chunk_length
+    return gltf, binary
+
+def write_glb(path: str, gltf: dict, binary: bytes) -> None:
+    document = json.dumps(gltf, separators=(",", ":")).encode("utf-8")
+    document += b" " * (-len(document) % 4)
+    binary += b"\0" * (-len(binary) % 4)
+    length = 12 + 8 + len(document) + (8 + len(binary) if binary else 0)
+    with open(path, "wb") as f:
+        f.write(struct.pack("<4sII", b"glTF", 2, length))
+        f.write(struct.pack("<II", len(document), GLB_JSON_CHUNK))
+        f.write(document)
+        if binary:
+            f.write(struct.pack("<II", len(binary), GLB_BIN_CHUNK))
+            f.write(binary)
+
+def encode_texture(image: Image.Image, quality: int) -> tuple:
+    """JPEG-encode a texture, or optimized PNG if it uses transparency; returns (bytes, mime type)"""
+    buffer = io.BytesIO()
+    if image.mode in ("RGBA", "LA", "PA", "P") and image.convert("RGBA").getextrema()[3][0] < 255:
+        image.save(buffer, format="PNG", optimize=True)
+        return buffer.getvalue(), "image/png"
+    image.convert("RGB").save(buffer, format="JPEG", quality=quality, optimize=True)
+    return buffer.getvalue(), "image/jpeg"
+
+def compress_glb_textures(path: str, quality: int) -> dict:
+    """Re-encode the images embedded in a GLB in place, keeping an image as is when that is smaller"""
+    gltf, binary = read_glb(path)
+    views = gltf.get("bufferViews", [])
+    replaced = {}
+    for image in gltf.get("images", []):
+        index = image.get("bufferView")
+        if index is None or index in replaced or views[index].get("buffer", 0) != 0:
+            continue
+        view = views[index]
+        data = binary[view.get("byteOffset", 0):view.get("byteOffset", 0) + view["byteLength"]]
+        encoded, mime_type = encode_texture(Image.open(io.BytesIO(data)), quality)
+        if len(encoded) < len(data):
+            replaced[index] = encoded
+            image["mimeType"] = mime_type
+
+    stats = {"images": len(gltf.get("images", [])), "reencoded": len(replaced), "bytes_before": os.path.getsize(path)}
+    if replaced:
+        # 重新排列二进制块，其余bufferView按原顺序保持4字节对齐
+        parts, offset = [], 0
+        for index, view in enumerate(views):
+            if view.get("buffer", 0) != 0:
+                continue
+            data = replaced.get(index)
+            if data is None:
+                data = binary[view.get("byteOffset", 0):view.get("byteOffset", 0) + view["byteLength"]]
+            padding = -offset % 4
+            parts.append(b"\0" * padding)
+            view["byteOffset"] = offset + padding
+            view["byteLength"] = len(data)
+            parts.append(data)
+            offset += padding + len(data)
+        gltf["buffers"][0]["byteLength"] = offset
+        write_glb(path, gltf, b"".join(parts))
+    stats["bytes_after"] = os.path.getsize(path)
+    return stats
+
+def prepare_scene_textures(scene, max_size: Optional[int], atlas: bool) -> dict:
+    """Downscale and optionally atlas the textures of a scene before it is exported"""
+    meshes = list(scene_meshes(scene).values())
+    materials = {id(mesh.visual.material): mesh.visual.material for mesh in meshes if is_texture_mapped(mesh)}
+    resized = 0
+    if max_size is not None:
+        resized = sum(downscale_material_textures(material, max_size) for material in materials.values())
+    atlases = pack_texture_atlases(meshes, min(TEXTURE_ATLAS_MAX_SIZE, max_size or TEXTURE_ATLAS_MAX_SIZE)) if atlas else 0
+    return {"materials": len(materials), "resized": resized, "atlases": atlases}
+
+def run_export_stage(tasks: list) -> None:
+    """Clean meshes, write decimated LODs and compress textures for tasks that asked for it"""
+    def export(task):
+        task.status("Optimizing exported model...", 0.92)
+        with timed_stage("export_optimize", task.stage_timings, record=False, task_ids=[task.task_id]):
+            scene = trimesh.load(task.final_model_path, force="scene", process=False)
+            levels = [0]
+            if task.optimize_mesh:
+                faces_before = count_faces(scene)
+                for mesh in scene_meshes(scene).values():
+                    clean_mesh(mesh)
+                task.mesh_lods = [{"level": 0, "ratio": 1.0, "faces": count_faces(scene), "faces_before": faces_before}]
+            if task.texture_export is not None:
+                task.texture_stats = prepare_scene_textures(
+                    scene, task.texture_export["max_size"], task.texture_export["atlas"],
+                )
+            scene.export(task.final_model_path)
+
+            for level, ratio in enumerate(task.lod_ratios, start=1):
+                lod = decimate_scene(scene, ratio)
+                lod.export(task.lod_path(level))
+                task.mesh_lods.append({"level": level, "ratio": ratio, "faces": count_faces(lod)})
+                levels.append(level)
+                del lod
+            del scene
+
+            # LOD共用同一套（已缩小、合并的）贴图，每个文件都重新编码
+            if task.texture_export is not None:
+                files = [compress_glb_textures(task.lod_path(level), task.texture_export["quality"]) for level in levels]
+                task.texture_stats.update(files[0])  # 报告主模型的压缩效果
+
+        for entry in task.mesh_lods or []:
+            entry["bytes"] = os.path.getsize(task.lod_path(entry["level"]))
+            entry["url"] = f"/download/{task.task_id}" + (f"?lod={entry['level']}" if entry["level"] else "")
+
+    for_each_task([task for task in active_tasks(tasks) if task.optimize_mesh or task.texture_export], export)
+
+def finalize_task(task: ReconstructionTask) -> None:
+    """Remove intermediates and report the result with the settings that were used"""
+    if "cleanup" in task.stage_timings:
+        timing_profile.record("cleanup", task.stage_timings["cleanup"], task.queue_depth)
+
+    # Final cleanup
+    task.status("Finalizing model...", 0.95)
+
+    # Clean up temporary files (the compact segmentation is kept for /segmentation)
+    if os.path.exists(task.scene_path):
+        os.remove(task.scene_path)
+
+    # Update status: Complete
+    chosen_settings = dict(task_statuses[task.task_id].get("chosen_settings") or {})
+    chosen_settings.update({
+        "num_inference_steps": task.num_inference_steps,
+        "texture_preset": task.texture_preset,
+        "texture_kwargs": task.texture_kwargs,
+        "optimize_mesh": task.optimize_mesh,
+        "lod_ratios": list(task.lod_ratios),
+        "texture_export": dict(task.texture_export, **task.texture_stats) if task.texture_stats else task.texture_export,
+        "stage_seconds": task.stage_timings,
+    })
+    tasks_finished.inc("completed")
+    update_task_status(
+        task.task_id, "completed", "3D model with textures generated successfully!", 1.0, f"/download/{task.task_id}",
+        chosen_settings=chosen_settings, actual_seconds=round(task.elapsed(), 1),
+        memory_peaks=memory_sampler.finish_task(task.task_id), lods=task.mesh_lods,
+    )
+    finish_task_trace(task.task_id, "completed")
+
+    # 所有模型都已卸载时记录内存基线，用于发现跨任务的泄漏
+    if not any(stats["loaded"] for stats in model_registry.stats().values()):
+        memory_sampler.record_baseline(f"task {task.task_id}")
+
+def run_reconstruction(tasks: list) -> None:
+    """Run tasks through the pipeline stage by stage, loading each model once for all of them"""
+    cpu_task_slots = get_cpu_task_slots()
+    if cpu_task_slots is not None and not cpu_task_slots.available():
+        for task in tasks:
+            task.status("Waiting for a free CPU slot...", 0.01)
+
+    with cpu_task_slots.slot() if cpu_task_slots is not None else nullcontext():
+        # 排队时间：从提交到拿到CPU槽位、开始执行
+        started_at = time.time()
+        for task in tasks:
+            record_task_span(task.task_id, "queue_wait", task.submitted_at, started_at)
+
+        for_each_task(tasks, plan_task)
+        run_segmentation_stage(tasks)
+        run_midi_stage(tasks)
+        run_texture_stage(tasks)
+        run_export_stage(tasks)
+        for_each_task(tasks, finalize_task)
 
-    except Exception as e:
-        # Update status: Error
-        update_task_status(task_id, "error", f"Error during processing: {str(e)}")
-        print(f"Error processing task {task_id}: {str(e)}")
-        import traceback
-        traceback.print_exc()
+def process_image_to_3d(
+    task_id: str, 
+    rgb_image: Image.Image, 
+    seg_mode: str = "box",
+    boxes: Optional[List[Any]] = None,  # Changed to Any to handle both dict and list formats
+    labels: Optional[str] = None,
+    polygon_refinement: bool = True,
+    detect_threshold: float = 0.3,
+    deadline_seconds: Optional[float] = None,
+    optimize_mesh: bool = False,
+    lod_ratios: tuple = (),
+    texture_export: Optional[dict] = None
+):
+    """Process an image to generate a 3D model with textures - Gradio style"""
+    run_reconstruction([
+        ReconstructionTask(
+            task_id, rgb_image, seg_mode, boxes, labels,
+            polygon_refinement, detect_threshold, deadline_seconds,
+            optimize_mesh, lod_ratios, texture_export,
+        )
+    ])
+
+def process_batch_to_3d(batch_id: str, tasks: list):
+    """Process a batch of images as one unit so every model is loaded once for the whole batch"""
+    print(f"Processing batch {batch_id} with {len(tasks)} images")
+    update_batch_status(batch_id, started_at=time.time())
+    run_reconstruction(tasks)
+    update_batch_status(batch_id, finished_at=time.time())
 
 def get_memory_info_str():
     """Get comprehensive memory usage information as a string"""
     info = []
     
     # GPU Memory
-    if torch.cuda.is_available():
+    if not torch.is_loaded():
+        info.append("GPU: ML stack not loaded yet")
+    elif torch.cuda.is_available():
         allocated = torch.cuda.memory_allocated() / 1024**3  # GB
         reserved = torch.cuda.memory_reserved() / 1024**3   # GB
         info.append(f"GPU - Allocated: {allocated:.2f}GB, Reserved: {reserved:.2f}GB")
@@ -712,10 +2925,172 @@ def get_memory_info_str():
     return "\n".join(info)
 
 
+def parse_boxes_json(boxes_json: str) -> List[List[List[int]]]:
+    """Parse boxes_json into the nested [[[x1, y1, x2, y2], ...]] format used by the pipeline
+
+    Accepts [{"x1":..,"y1":..,"x2":..,"y2":..}, ...] or [[x1, y1, x2, y2], ...].
+    Raises HTTPException(400) on malformed input.
+    """
+    try:
+        parsed_boxes = json.loads(boxes_json)
+    except json.JSONDecodeError:
+        raise HTTPException(status_code=400, detail="Invalid JSON format for boxes_json")
+    return format_boxes(parsed_boxes)
+
+def format_boxes(parsed_boxes: Any) -> List[List[List[int]]]:
+    """Convert already-decoded boxes into the nested pipeline format, see parse_boxes_json"""
+    try:
+        # 验证解析后的数据不为空
+        if not parsed_boxes:
+            raise ValueError("boxes_json cannot be an empty list")
+
+        # 检查第一个元素的类型以确定格式
+        first_element = parsed_boxes[0]
+        
+        # 情况1: 字典列表格式 [{"x1":..., "y1":..., ...}, ...]
+        if isinstance(first_element, dict):
+            # 转换为坐标列表并添加三层嵌套以匹配Gradio格式
+            coordinate_list = [
+                [int(box["x1"]), int(box["y1"]), int(box["x2"]), int(box["y2"])]
+                for box in parsed_boxes
+            ]
+            # 关键修正：添加额外的嵌套层级以匹配Gradio格式
+            formatted_boxes = [coordinate_list]
+            
+        # 情况2: 列表的列表格式 [[x1, y1, x2, y2], ...]
+        elif isinstance(first_element, list):
+            # 验证每个坐标列表有4个元素
+            for box in parsed_boxes:
+                if len(box) != 4:
+                    raise ValueError("Each box must contain exactly 4 coordinates [x1, y1, x2, y2]")
+            
+            # 转换为整数并添加三层嵌套以匹配Gradio格式
+            coordinate_list = [
+                [int(coord) for coord in box]
+                for box in parsed_boxes
+            ]
+            # 关键修正：添加额外的嵌套层级以匹配Gradio格式
+            formatted_boxes = [coordinate_list]
+            
+        else:
+            # 不支持的格式
+            raise TypeError("boxes_json must be a list of objects or a list of coordinate lists")
+
+    except (KeyError, ValueError, TypeError, IndexError) as e:
+        raise HTTPException(status_code=400, detail=f"Invalid box format: {str(e)}")
+
+    return formatted_boxes
+
+def is_number(value: Any) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+def is_box(box: Any) -> bool:
+    """A box in either boxes_json format: [x1, y1, x2, y2] or {"x1": .., "y1": .., "x2": .., "y2": ..}"""
+    if isinstance(box, dict):
+        return all(is_number(box.get(key)) for key in ("x1", "y1", "x2", "y2"))
+    return isinstance(box, list) and len(box) == 4 and all(is_number(coord) for coord in box)
+
+def validate_manifest_entry(index: int, entry: dict) -> None:
+    """Check the value types of a /process_batch manifest entry so bad input is a 400 naming the entry"""
+    def invalid(message):
+        raise HTTPException(status_code=400, detail=f"Manifest entry {index}: {message}")
+
+    if not isinstance(entry.get("seg_mode", "box"), str):
+        invalid("seg_mode must be a string")
+    if entry.get("labels") is not None and not isinstance(entry["labels"], str):
+        invalid("labels must be a comma-separated string")
+    boxes = entry.get("boxes")
+    if boxes is not None and not (isinstance(boxes, list) and all(is_box(box) for box in boxes)):
+        invalid("boxes must be a list of [x1, y1, x2, y2] number lists or {x1, y1, x2, y2} objects")
+    for field in ("detect_threshold", "deadline_seconds"):
+        if entry.get(field) is not None and not is_number(entry[field]):
+            invalid(f"{field} must be a number")
+    for field in ("texture_max_size", "texture_quality"):
+        if entry.get(field) is not None and not (is_number(entry[field]) and float(entry[field]).is_integer()):
+            invalid(f"{field} must be an integer")
+    for field in ("polygon_refinement", "optimize_mesh", "compress_textures", "atlas_textures"):
+        if entry.get(field) is not None and not isinstance(entry[field], bool):
+            invalid(f"{field} must be true or false")
+    if entry.get("trace_id") is not None and not isinstance(entry["trace_id"], str):
+        invalid("trace_id must be a string")
+
+def validate_segmentation_params(seg_mode: str, has_boxes: bool, labels: Optional[str],
+                                 deadline_seconds: Optional[float] = None) -> None:
+    """Shared request validation for /process, /process_batch and /segment_preview"""
+    # Validate segmentation mode
+    if seg_mode not in ["box", "label"]:
+        raise HTTPException(status_code=400, detail="seg_mode must be either 'box' or 'label'")
+
+    # Validate boxes if box mode is selected
+    if seg_mode == "box" and not has_boxes:
+        raise HTTPException(status_code=400, detail="boxes_json is required when seg_mode is 'box'")
+
+    # Validate labels if label mode is selected
+    if seg_mode == "label" and (labels is None or not normalize_labels(labels)):
+        raise HTTPException(status_code=400, detail="labels is required when seg_mode is 'label'")
+
+    # Validate deadline if provided
+    if deadline_seconds is not None and deadline_seconds <= 0:
+        raise HTTPException(status_code=400, detail="deadline_seconds must be positive")
+
+def parse_lod_ratios(lod_ratios: Any) -> tuple:
+    """LOD face ratios from a comma-separated string or a list, highest detail first"""
+    if lod_ratios is None or lod_ratios == "":
+        return ()
+    try:
+        items = lod_ratios.split(",") if isinstance(lod_ratios, str) else list(lod_ratios)
+        ratios = sorted({float(item) for item in items}, reverse=True)
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="lod_ratios must be a comma-separated list of numbers")
+    if any(not 0 < ratio < 1 for ratio in ratios):
+        raise HTTPException(status_code=400, detail="lod_ratios must be between 0 and 1 (exclusive)")
+    if len(ratios) > MAX_MESH_LODS:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_MESH_LODS} LOD levels can be requested")
+    if not mesh_decimation_available():
+        raise HTTPException(
+            status_code=400,
+            detail=f"LOD generation needs one of {', '.join(MESH_DECIMATION_BACKENDS)} installed on the server",
+        )
+    return tuple(ratios)
+
+def parse_texture_export(compress_textures: bool, texture_max_size: Optional[int], atlas_textures: bool,
+                         texture_quality: Optional[int]) -> Optional[dict]:
+    """Texture compression settings of a request, or None when it did not ask for any"""
+    if not (compress_textures or texture_max_size is not None or atlas_textures or texture_quality is not None):
+        return None
+    if texture_max_size is not None and texture_max_size < 64:
+        raise HTTPException(status_code=400, detail="texture_max_size must be at least 64 pixels")
+    if texture_quality is not None and not 1 <= texture_quality <= 95:
+        raise HTTPException(status_code=400, detail="texture_quality must be between 1 and 95")
+    return {
+        "max_size": texture_max_size,
+        "atlas": bool(atlas_textures),
+        "quality": texture_quality if texture_quality is not None else TEXTURE_JPEG_QUALITY,
+    }
+
+def resolve_trace_id(*candidates: Optional[str]) -> str:
+    """The first trace ID sent by the client, or a new one so every task still gets a waterfall"""
+    for trace_id in candidates:
+        if trace_id:
+            if not TRACE_ID_PATTERN.match(trace_id):
+                raise HTTPException(status_code=400, detail="trace_id must be 8-64 letters, digits or dashes")
+            return trace_id
+    return uuid.uuid4().hex
+
 @app.get("/")
 async def root():
     """Root endpoint to check API status"""
-    return {"message": "MIDI-3D API is running", "status": "active"}
+    # 在ML依赖导入完成前不触发导入，保证健康检查立即返回
+    ml_stack_loaded = torch.is_loaded()
+    cpu_task_slots = get_cpu_task_slots() if ml_stack_loaded else None
+    return {
+        "message": "MIDI-3D API is running",
+        "status": "active",
+        "ml_stack_loaded": ml_stack_loaded,
+        "device": get_device() if ml_stack_loaded else None,
+        "dtype": str(get_dtype()).replace("torch.", "") if ml_stack_loaded else None,
+        "cpu_slots": cpu_task_slots.stats() if cpu_task_slots is not None else None,
+    }
 
 @app.post("/process", response_model=ProcessResponse)
 async def process_image(
@@ -725,7 +3100,17 @@ async def process_image(
     boxes_json: Optional[str] = Form(None),
     labels: Optional[str] = Form(None),
     polygon_refinement: bool = Form(True),
-    detect_threshold: float = Form(0.3)
+    detect_threshold: float = Form(0.3),
+    deadline_seconds: Optional[float] = Form(None),
+    working_max_side: Optional[int] = Form(None),
+    trace_id: Optional[str] = Form(None),
+    optimize_mesh: bool = Form(False),
+    lod_ratios: Optional[str] = Form(None),
+    compress_textures: bool = Form(False),
+    texture_max_size: Optional[int] = Form(None),
+    atlas_textures: bool = Form(False),
+    texture_quality: Optional[int] = Form(None),
+    x_trace_id: Optional[str] = Header(None)
 ):
     """Process an uploaded image to generate a 3D model with textures
 
@@ -736,147 +3121,403 @@ async def process_image(
     - labels: 文本标签，用逗号分隔，仅在seg_mode为"label"时使用
     - polygon_refinement: 是否使用多边形优化
     - detect_threshold: 检测阈值，仅在seg_mode为"label"时使用
+    - deadline_seconds: 可选的时间预算（秒），指定后服务器根据实测耗时自动选择推理步数和纹理设置
+    - working_max_side: 可选的工作分辨率（长边像素），默认为WORKING_MAX_SIDE，框坐标会按比例缩放
+    - trace_id: 可选的追踪ID，也可以用X-Trace-Id请求头传入；由Blender插件生成，服务器的span写入同一条追踪，省略时由服务器生成
+    - optimize_mesh: 是否优化最终网格（合并重复顶点、删除退化面），指定lod_ratios时自动开启
+    - lod_ratios: 可选的LOD面数比例，逗号分隔，例如 "0.5,0.1"；各级LOD通过 /download/{task_id}?lod=N 下载
+    - compress_textures: 是否把GLB中的贴图重新编码为JPEG（带透明通道的保持PNG），指定下面任一参数时自动开启
+    - texture_max_size: 可选的贴图最大边长（像素），更大的贴图按比例缩小
+    - atlas_textures: 是否把各物体的贴图合并为共享图集（每张最大TEXTURE_ATLAS_MAX_SIZE像素）
+    - texture_quality: JPEG质量（1-95），默认为TEXTURE_JPEG_QUALITY
     """
+    received_at = time.time()
+
     # Check if the uploaded file is an image
     if not file.content_type.startswith("image/"):
         raise HTTPException(status_code=400, detail="Uploaded file is not an image")
 
-    # Validate segmentation mode
-    if seg_mode not in ["box", "label"]:
-        raise HTTPException(status_code=400, detail="seg_mode must be either 'box' or 'label'")
+    validate_segmentation_params(seg_mode, boxes_json is not None, labels, deadline_seconds)
 
-    # Validate boxes if box mode is selected
-    if seg_mode == "box" and boxes_json is None:
-        raise HTTPException(status_code=400, detail="boxes_json is required when seg_mode is 'box'")
+    # Validate working resolution if provided
+    if working_max_side is not None and working_max_side < 64:
+        raise HTTPException(status_code=400, detail="working_max_side must be at least 64 pixels")
 
-    # Validate labels if label mode is selected
-    if seg_mode == "label" and (labels is None or labels == ""):
-        raise HTTPException(status_code=400, detail="labels is required when seg_mode is 'label'")
+    trace_id = resolve_trace_id(trace_id, x_trace_id)
+    parsed_lod_ratios = parse_lod_ratios(lod_ratios)
+    texture_export = parse_texture_export(compress_textures, texture_max_size, atlas_textures, texture_quality)
 
     # Generate a unique task ID
     task_id = str(uuid.uuid4())
 
-    # Save the uploaded image
-    image_path = os.path.join(TMP_DIR, f"{task_id}_input.png")
-    with open(image_path, "wb") as buffer:
-        content = await file.read()
-        buffer.write(content)
+    # Decode the uploaded image once and normalize it to the working resolution
+    content = await file.read()
+    try:
+        rgb_image, image_scale = await run_in_threadpool(ingest_image, content, working_max_side or WORKING_MAX_SIDE)
+    except (OSError, ValueError) as e:
+        raise HTTPException(status_code=400, detail=f"Could not decode image: {str(e)}")
+    del content
 
-    # Parse and format boxes if provided（修正部分）
+    # Parse and format boxes if provided
     formatted_boxes = None
     if boxes_json is not None:
-        try:
-            parsed_boxes = json.loads(boxes_json)
-            
-            # 验证解析后的数据不为空
-            if not parsed_boxes:
-                raise ValueError("boxes_json cannot be an empty list")
+        formatted_boxes = parse_boxes_json(boxes_json)
 
-            # 检查第一个元素的类型以确定格式
-            first_element = parsed_boxes[0]
-            
-            # 情况1: 字典列表格式 [{"x1":..., "y1":..., ...}, ...]
-            if isinstance(first_element, dict):
-                # 转换为坐标列表并添加三层嵌套以匹配Gradio格式
-                coordinate_list = [
-                    [int(box["x1"]), int(box["y1"]), int(box["x2"]), int(box["y2"])]
-                    for box in parsed_boxes
-                ]
-                # 关键修正：添加额外的嵌套层级以匹配Gradio格式
-                formatted_boxes = [coordinate_list]
-                
-            # 情况2: 列表的列表格式 [[x1, y1, x2, y2], ...]
-            elif isinstance(first_element, list):
-                # 验证每个坐标列表有4个元素
-                for box in parsed_boxes:
-                    if len(box) != 4:
-                        raise ValueError("Each box must contain exactly 4 coordinates [x1, y1, x2, y2]")
-                
-                # 转换为整数并添加三层嵌套以匹配Gradio格式
-                coordinate_list = [
-                    [int(coord) for coord in box]
-                    for box in parsed_boxes
-                ]
-                # 关键修正：添加额外的嵌套层级以匹配Gradio格式
-                formatted_boxes = [coordinate_list]
-                
-            else:
-                # 不支持的格式
-                raise TypeError("boxes_json must be a list of objects or a list of coordinate lists")
-
-        except json.JSONDecodeError:
-            raise HTTPException(status_code=400, detail="Invalid JSON format for boxes_json")
-        except (KeyError, ValueError, TypeError) as e:
-            raise HTTPException(status_code=400, detail=f"Invalid box format: {str(e)}")
+        # 框坐标基于上传的原图，需要缩放到工作分辨率
+        formatted_boxes = scale_boxes(formatted_boxes, image_scale, rgb_image.size)
 
     # Initialize task status
-    update_task_status(task_id, "queued", "Task queued for processing")
+    update_task_status(
+        task_id, "queued", "Task queued for processing",
+        submitted_at=time.time(), deadline_seconds=deadline_seconds, trace_id=trace_id,
+    )
+    start_task_trace(task_id, trace_id, received_at)
+    record_task_span(task_id, "ingest", received_at, time.time())
 
     # Add the processing task to background tasks（传递格式化后的boxes）
     background_tasks.add_task(
         process_image_to_3d, 
         task_id, 
-        image_path, 
+        rgb_image, 
         seg_mode, 
         formatted_boxes,  # 使用修正后的三层嵌套格式
         labels, 
         polygon_refinement, 
-        detect_threshold
+        detect_threshold,
+        deadline_seconds,
+        optimize_mesh,
+        parsed_lod_ratios,
+        texture_export
     )
 
     # Return the task ID and status URL
     return ProcessResponse(
         task_id=task_id,
-        status_url=f"/status/{task_id}"
+        status_url=f"/status/{task_id}",
+        trace_id=trace_id,
+    )
+
+@app.post("/process_batch", response_model=BatchResponse)
+async def process_batch(
+    background_tasks: BackgroundTasks,
+    files: List[UploadFile] = File(...),
+    manifest_json: str = Form(...),
+    working_max_side: Optional[int] = Form(None),
+    x_trace_id: Optional[str] = Header(None)
+):
+    """Submit several images as one batch; models are loaded once for the whole batch
+
+    Parameters:
+    - files: 上传的图片文件列表
+    - manifest_json: 每张图片一项的JSON列表，例如
+      [{"file": "a.jpg", "seg_mode": "box", "boxes": [[100,100,200,200]]},
+       {"file": 1, "seg_mode": "label", "labels": "chair,table"}]
+      "file"为上传文件名或文件序号（省略时按顺序对应），其余字段与/process的参数相同：
+      boxes（与boxes_json格式相同）、labels、polygon_refinement、detect_threshold、deadline_seconds、trace_id、
+      optimize_mesh、lod_ratios（数字列表或逗号分隔的字符串）、compress_textures、texture_max_size、atlas_textures、texture_quality
+    - working_max_side: 可选的工作分辨率（长边像素），对整个批次生效
+    - X-Trace-Id: 可选的请求头，条目未指定trace_id时整个批次共用这条追踪
+    """
+    received_at = time.time()
+    try:
+        manifest = json.loads(manifest_json)
+    except json.JSONDecodeError:
+        raise HTTPException(status_code=400, detail="Invalid JSON format for manifest_json")
+    if not isinstance(manifest, list) or not manifest:
+        raise HTTPException(status_code=400, detail="manifest_json must be a non-empty list")
+    if working_max_side is not None and working_max_side < 64:
+        raise HTTPException(status_code=400, detail="working_max_side must be at least 64 pixels")
+
+    files_by_name = {file.filename: file for file in files}
+    batch_id = str(uuid.uuid4())
+    tasks = []
+    trace_ids = []
+
+    for index, entry in enumerate(manifest):
+        if not isinstance(entry, dict):
+            raise HTTPException(status_code=400, detail=f"Manifest entry {index} must be an object")
+        # null与省略该字段相同，使用默认值
+        entry = {key: value for key, value in entry.items() if value is not None}
+        validate_manifest_entry(index, entry)
+
+        # 按文件名或序号找到对应的上传文件
+        file_ref = entry.get("file", index)
+        file = files_by_name.get(file_ref) if isinstance(file_ref, str) else None
+        if file is None and isinstance(file_ref, int) and 0 <= file_ref < len(files):
+            file = files[file_ref]
+        if file is None:
+            raise HTTPException(status_code=400, detail=f"Manifest entry {index} refers to unknown file {file_ref!r}")
+        if not file.content_type.startswith("image/"):
+            raise HTTPException(status_code=400, detail=f"File {file.filename} is not an image")
+
+        seg_mode = entry.get("seg_mode", "box")
+        labels = entry.get("labels")
+        deadline_seconds = entry.get("deadline_seconds")
+        validate_segmentation_params(seg_mode, entry.get("boxes") is not None, labels, deadline_seconds)
+        trace_ids.append(resolve_trace_id(entry.get("trace_id"), x_trace_id))
+        entry_lod_ratios = parse_lod_ratios(entry.get("lod_ratios"))
+        entry_texture_export = parse_texture_export(
+            bool(entry.get("compress_textures", False)),
+            int(entry["texture_max_size"]) if entry.get("texture_max_size") is not None else None,
+            bool(entry.get("atlas_textures", False)),
+            int(entry["texture_quality"]) if entry.get("texture_quality") is not None else None,
+        )
+
+        await file.seek(0)
+        content = await file.read()
+        try:
+            rgb_image, image_scale = await run_in_threadpool(ingest_image, content, working_max_side or WORKING_MAX_SIDE)
+        except (OSError, ValueError) as e:
+            raise HTTPException(status_code=400, detail=f"Could not decode image {file.filename}: {str(e)}")
+        del content
+
+        formatted_boxes = None
+        if seg_mode == "box":
+            formatted_boxes = scale_boxes(format_boxes(entry["boxes"]), image_scale, rgb_image.size)
+
+        tasks.append(ReconstructionTask(
+            str(uuid.uuid4()), rgb_image, seg_mode, formatted_boxes, labels,
+            bool(entry.get("polygon_refinement", True)),
+            float(entry.get("detect_threshold", 0.3)),
+            deadline_seconds,
+            bool(entry.get("optimize_mesh", False)),
+            entry_lod_ratios,
+            entry_texture_export,
+        ))
+
+    # 所有条目都验证通过后才登记任务
+    submitted_at = time.time()
+    for task, trace_id in zip(tasks, trace_ids):
+        task.submitted_at = submitted_at
+        update_task_status(
+            task.task_id, "queued", "Task queued for processing in batch",
+            submitted_at=submitted_at, deadline_seconds=task.deadline_seconds, batch_id=batch_id, trace_id=trace_id,
+        )
+        start_task_trace(task.task_id, trace_id, received_at)
+        record_task_span(task.task_id, "ingest", received_at, submitted_at, batch_id=batch_id)
+    update_batch_status(batch_id, task_ids=[task.task_id for task in tasks], submitted_at=submitted_at)
+
+    background_tasks.add_task(process_batch_to_3d, batch_id, tasks)
+
+    return BatchResponse(
+        batch_id=batch_id,
+        status_url=f"/batch_status/{batch_id}",
+        task_ids=[task.task_id for task in tasks],
     )
 
+@app.get("/batch_status/{batch_id}", response_model=BatchStatus)
+async def get_batch_status(batch_id: str):
+    """Get aggregate progress of a batch together with the status of each of its tasks"""
+    batch = lookup_batch_status(batch_id)
+    if batch is None:
+        raise HTTPException(status_code=404, detail="Batch not found")
+
+    tasks = []
+    for task_id in batch["task_ids"]:
+        status = lookup_task_status(task_id) or {}
+        tasks.append({
+            "task_id": task_id,
+            "status": status.get("status"),
+            "message": status.get("message"),
+            "progress": status.get("progress"),
+            "model_url": status.get("model_url"),
+            "lods": status.get("lods"),
+        })
+
+    completed = sum(1 for task in tasks if task["status"] == "completed")
+    failed = sum(1 for task in tasks if task["status"] == "error")
+    finished = [1.0 if task["status"] in ("completed", "error") else (task["progress"] or 0.0) for task in tasks]
+
+    if completed + failed < len(tasks):
+        status = "processing" if any(task["status"] == "processing" for task in tasks) else "queued"
+    elif failed == 0:
+        status = "completed"
+    elif completed == 0:
+        status = "error"
+    else:
+        status = "partial"
+
+    return BatchStatus(
+        batch_id=batch_id,
+        status=status,
+        progress=round(sum(finished) / len(tasks), 3),
+        total=len(tasks),
+        completed=completed,
+        failed=failed,
+        tasks=tasks,
+    )
+
+@app.post("/segment_preview")
+async def segment_preview(
+    file: UploadFile = File(...),
+    seg_mode: str = Form("box"),
+    boxes_json: Optional[str] = Form(None),
+    labels: Optional[str] = Form(None),
+    polygon_refinement: bool = Form(False),
+    detect_threshold: float = Form(0.3),
+    include_overlay: bool = Form(False)
+):
+    """Run detection and segmentation only, for live feedback while boxes are drawn
+
+    The image is normalized to PREVIEW_MAX_SIDE, Grounding SAM stays loaded between
+    calls and SAM image embeddings are cached, so redrawing boxes on the same capture
+    only costs the mask decoder. Masks are returned as column-major RLE at preview
+    resolution; divide mask and box coordinates by scale (upload to preview,
+    per axis) to map them back to the upload.
+
+    Parameters:
+    - file, seg_mode, boxes_json, labels, polygon_refinement, detect_threshold: 与/process相同
+    - include_overlay: 是否额外返回plot_segmentation渲染的PNG（base64），会增加延迟
+    """
+    if not file.content_type.startswith("image/"):
+        raise HTTPException(status_code=400, detail="Uploaded file is not an image")
+    validate_segmentation_params(seg_mode, boxes_json is not None, labels)
+
+    start = time.perf_counter()
+    content = await file.read()
+    try:
+        rgb_image, image_scale = await run_in_threadpool(ingest_image, content, PREVIEW_MAX_SIDE)
+    except (OSError, ValueError) as e:
+        raise HTTPException(status_code=400, detail=f"Could not decode image: {str(e)}")
+    del content
+
+    boxes = None
+    if seg_mode == "box":
+        boxes = scale_boxes(parse_boxes_json(boxes_json), image_scale, rgb_image.size)
+
+    try:
+        segmentation = await run_in_threadpool(
+            run_segmentation_preview, rgb_image, boxes, labels if seg_mode == "label" else None,
+            detect_threshold, polygon_refinement,
+        )
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Segmentation failed: {str(e)}")
+
+    result = segmentation.to_json()
+    result["scale"] = list(image_scale)
+
+    if include_overlay and len(segmentation):
+        overlay = segmentation.render(rgb_image)
+        buffer = io.BytesIO()
+        overlay.save(buffer, format="PNG")
+        result["overlay_png"] = base64.b64encode(buffer.getvalue()).decode("ascii")
+
+    result["latency_ms"] = round((time.perf_counter() - start) * 1000, 1)
+    return result
+
 @app.get("/status/{task_id}", response_model=ProcessStatus)
 async def get_status(task_id: str):
     """Get the status of a processing task"""
-    if task_id not in task_statuses:
+    status = lookup_task_status(task_id)
+    if status is None:
         raise HTTPException(status_code=404, detail="Task not found")
 
-    status = task_statuses[task_id]
     return ProcessStatus(
         status=status["status"],
         message=status["message"],
         progress=status.get("progress"),
-        model_url=status.get("model_url")
+        model_url=status.get("model_url"),
+        deadline_seconds=status.get("deadline_seconds"),
+        chosen_settings=status.get("chosen_settings"),
+        predicted_seconds=status.get("predicted_seconds"),
+        actual_seconds=status.get("actual_seconds"),
+        memory_peaks=status.get("memory_peaks"),
+        trace_id=status.get("trace_id"),
+        lods=status.get("lods"),
     )
 
 @app.get("/download/{task_id}")
-async def download_model(task_id: str):
-    """Download the generated 3D model"""
-    if task_id not in task_statuses:
+async def download_model(task_id: str, lod: int = 0):
+    """Download the generated 3D model, or one of its LODs if the task requested lod_ratios"""
+    status = lookup_task_status(task_id)
+    if status is None:
         raise HTTPException(status_code=404, detail="Task not found")
 
-    status = task_statuses[task_id]
 
     if status["status"] != "completed":
         raise HTTPException(status_code=400, detail="Task not completed yet")
 
-    model_path = os.path.join(TMP_DIR, f"textured_{task_id}", "textured_scene.glb")
+    if lod < 0:
+        raise HTTPException(status_code=400, detail="lod must not be negative")
+    model_path = lod_model_path(task_id, lod)
 
     if not os.path.exists(model_path):
-        raise HTTPException(status_code=404, detail="Model file not found")
+        raise HTTPException(status_code=404, detail="Model file not found" if lod == 0 else f"LOD {lod} was not generated")
 
     return FileResponse(
         model_path,
         media_type="application/octet-stream",
-        filename=f"midi3d_{task_id}.glb"
+        filename=f"midi3d_{task_id}.glb" if lod == 0 else f"midi3d_{task_id}_lod{lod}.glb"
     )
 
+@app.get("/segmentation/{task_id}")
+async def get_segmentation(task_id: str):
+    """Get the instance masks of a task as RLE, for display or comparison across reruns"""
+    if lookup_task_status(task_id) is None:
+        raise HTTPException(status_code=404, detail="Task not found")
+
+    seg_path = os.path.join(TMP_DIR, f"{task_id}_seg.npz")
+    if not os.path.exists(seg_path):
+        raise HTTPException(status_code=404, detail="Segmentation not available yet")
+
+    segmentation = CompactSegmentation.load(seg_path)
+    result = segmentation.to_json()
+    result["digests"] = segmentation.digests()
+    return result
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """Per-stage timing and memory histograms in the Prometheus text format"""
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
 @app.get("/memory")
 async def get_memory():
     """Get memory usage information"""
     return get_memory_info_str()
 
+@app.get("/memory/samples")
+async def get_memory_samples(seconds: Optional[float] = None):
+    """Recent background memory samples, teardown baselines and the leak warning, as JSON"""
+    return memory_sampler.snapshot(seconds)
+
+@app.get("/cache/stats")
+async def get_cache_stats():
+    """Get hit/miss statistics of the inference caches"""
+    return {
+        "sam_embeddings": sam_embedding_cache.stats(),
+        "detector_text_embeddings": detector_text_cache.stats(),
+    }
+
 @app.post("/cleanup")
 async def cleanup():
     """Unload all models and free memory"""
-    cleanup_models()
+    busy = cleanup_models()
+    if busy:
+        return {"message": "Idle models unloaded; models in use will unload when their tasks finish", "in_use": busy}
     return {"message": "All models unloaded and memory freed"}
 
+@app.get("/models")
+async def get_models():
+    """Get load state and lease counts of the shared models"""
+    return {"offload_mode": OFFLOAD_MODE, "models": model_registry.stats()}
+
+def warm_ml_stack():
+    """Import the ML stack in the background so the first task does not pay for it"""
+    start = time.perf_counter()
+    for module in (torch, trimesh, huggingface_hub, grounding_sam, pipeline_midi, inference_midi, image_to_textured_scene):
+        try:
+            module.import_now()
+        except Exception as e:
+            print(f"Warning: Could not import {module._name}: {e}")
+    get_cpu_task_slots()
+    print(f"ML stack imported in {time.perf_counter() - start:.1f}s (device: {get_device()}, dtype: {get_dtype()})")
+
+@app.on_event("startup")
+async def start_background_workers():
+    memory_sampler.start()
+    if WARM_ML_STACK_ON_STARTUP:
+        threading.Thread(target=warm_ml_stack, name="ml-stack-warmup", daemon=True).start()
+
 # Start the server
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,106 @@
+import os
+
+# 父进程不能初始化CUDA，否则fork出的worker无法再使用CUDA；这两项必须在导入torch之前设置
+os.environ.setdefault("PYTORCH_NVML_BASED_CUDA_CHECK", "1")
+os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")
+
+import argparse
+import gc
+import signal
+import socket
+import time
+
+import uvicorn
+
+import fastapi_server
+
+
+def preload_models(names):
+    """在父进程中把各管线加载到主机内存，fork后由所有worker写时复制共享"""
+    for name in names:
+        start = time.perf_counter()
+        if fastapi_server.model_registry.preload_shared(name):
+            print(f"Preloaded {name} to host memory in {time.perf_counter() - start:.1f}s")
+        else:
+            print(f"Skipping {name}: it has no host loader and is loaded by each worker")
+
+
+def bind_socket(host, port):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+    return sock
+
+
+def run_worker(sock, log_level):
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    config = uvicorn.Config(fastapi_server.app, log_level=log_level)
+    uvicorn.Server(config).run(sockets=[sock])
+
+
+def spawn_worker(sock, log_level):
+    pid = os.fork()
+    if pid == 0:
+        try:
+            run_worker(sock, log_level)
+        finally:
+            os._exit(0)
+    print(f"Started worker {pid}")
+    return pid
+
+
+def serve(host, port, workers, models, log_level):
+    # 多个worker各自处理请求，任务状态需要通过文件共享
+    fastapi_server.SHARE_STATUS_ACROSS_WORKERS = True
+    preload_models(models)
+    sock = bind_socket(host, port)
+
+    # 冻结父进程中的对象，避免子进程的垃圾回收触碰这些页面而触发复制
+    gc.collect()
+    gc.freeze()
+
+    children = {spawn_worker(sock, log_level) for _ in range(workers)}
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    # 监督worker：意外退出的worker立即从已加载的父进程重新fork
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        children.discard(pid)
+        if not stopping:
+            print(f"Worker {pid} exited with status {status}, restarting")
+            children.add(spawn_worker(sock, log_level))
+
+    sock.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve the MIDI-3D API from workers forked off a parent that preloads the model weights")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--models", nargs="+", default=["midi", "mv_adapter"],
+                        help="Registry models whose host copies are shared by the workers")
+    parser.add_argument("--log-level", default="info")
+    args = parser.parse_args()
+
+    serve(args.host, args.port, args.workers, args.models, args.log_level)
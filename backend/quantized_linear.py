@@ -0,0 +1,50 @@
+import torch
+
+
+class Int8Linear(torch.nn.Module):
+    """Linear layer storing its weight as int8 with a per-output-channel scale, dequantized on use"""
+
+    def __init__(self, in_features: int, out_features: int, bias: bool = True, dtype: torch.dtype = torch.float16, device=None):
+        super().__init__()
+        self.in_features = in_features
+        self.out_features = out_features
+        self.register_buffer("weight_int8", torch.zeros(out_features, in_features, dtype=torch.int8, device=device))
+        self.register_buffer("weight_scale", torch.ones(out_features, 1, dtype=dtype, device=device))
+        if bias:
+            self.bias = torch.nn.Parameter(torch.zeros(out_features, dtype=dtype, device=device), requires_grad=False)
+        else:
+            self.register_parameter("bias", None)
+
+    @classmethod
+    def from_linear(cls, linear: torch.nn.Linear) -> "Int8Linear":
+        module = cls(linear.in_features, linear.out_features, linear.bias is not None,
+                     dtype=linear.weight.dtype, device=linear.weight.device)
+        module.set_weight(linear.weight.data)
+        if linear.bias is not None:
+            module.bias.data.copy_(linear.bias.data)
+        return module
+
+    def set_weight(self, weight: torch.Tensor) -> None:
+        """Quantize a floating point weight symmetrically per output channel"""
+        weight = weight.to(device=self.weight_int8.device, dtype=torch.float32)
+        scale = weight.abs().amax(dim=1, keepdim=True).clamp(min=1e-8) / 127.0
+        self.weight_int8 = torch.round(weight / scale).clamp(-127, 127).to(torch.int8)
+        self.weight_scale = scale.to(self.weight_scale.dtype)
+
+    @property
+    def weight(self) -> torch.Tensor:
+        return self.weight_int8.to(self.weight_scale.dtype) * self.weight_scale
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        bias = self.bias.to(x.dtype) if self.bias is not None else None
+        return torch.nn.functional.linear(x, self.weight.to(x.dtype), bias)
+
+    def _load_from_state_dict(self, state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys, error_msgs):
+        # 加载普通线性层的浮点权重时直接量化，分块加载时不必在设备上保留fp16副本
+        key = prefix + "weight"
+        if key in state_dict:
+            self.set_weight(state_dict.pop(key))
+        super()._load_from_state_dict(state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys, error_msgs)
+
+    def extra_repr(self) -> str:
+        return f"in_features={self.in_features}, out_features={self.out_features}, bias={self.bias is not None}, int8"
@@ -0,0 +1,304 @@
+import argparse
+import json
+import os
+import random
+import sys
+import time
+import types
+
+import numpy as np
+import torch
+import trimesh
+from PIL import Image
+
+import fastapi_server
+
+# 各模型的模拟耗时（秒）和内存（MB）：weights_mb在加载时分配、卸载时释放，working_mb只在每次调用期间占用
+# jitter为耗时的随机浮动比例
+PROFILES = {
+    "instant": {
+        "jitter": 0.0,
+        "grounding_sam": {"load_seconds": 0.0, "weights_mb": 0, "seconds_per_image": 0.0, "working_mb": 0},
+        "midi": {"load_seconds": 0.0, "weights_mb": 0, "seconds_per_step": 0.0, "working_mb": 0},
+        "mv_adapter": {"load_seconds": 0.0, "weights_mb": 0, "seconds_per_object": 0.0, "working_mb": 0},
+    },
+    "fast": {
+        "jitter": 0.1,
+        "grounding_sam": {"load_seconds": 0.2, "weights_mb": 64, "seconds_per_image": 0.05, "working_mb": 16},
+        "midi": {"load_seconds": 0.5, "weights_mb": 256, "seconds_per_step": 0.01, "working_mb": 64},
+        "mv_adapter": {"load_seconds": 0.5, "weights_mb": 256, "seconds_per_object": 0.1, "working_mb": 64},
+    },
+    # 与RTX 4090上的实测耗时同一量级，内存按比例缩小以便在普通机器上运行
+    "realistic": {
+        "jitter": 0.1,
+        "grounding_sam": {"load_seconds": 4.0, "weights_mb": 700, "seconds_per_image": 0.5, "working_mb": 200},
+        "midi": {"load_seconds": 20.0, "weights_mb": 2048, "seconds_per_step": 1.0, "working_mb": 512},
+        "mv_adapter": {"load_seconds": 25.0, "weights_mb": 2048, "seconds_per_object": 15.0, "working_mb": 1024},
+    },
+}
+
+profile = PROFILES["fast"]
+
+
+def simulate(seconds):
+    if seconds > 0:
+        time.sleep(seconds * random.uniform(1 - profile["jitter"], 1 + profile["jitter"]))
+
+
+def allocate(mb):
+    """分配并写入内存，保证页面实际驻留，RSS能反映模拟的占用"""
+    return np.ones(int(mb * 1024 * 1024), dtype=np.uint8)
+
+
+class StubModel:
+    """Holds simulated weights; clear_model_attributes() drops them like it does real models
+
+    share is this model's part of the profile entry when several stubs make up one model.
+    """
+
+    def __init__(self, name, share=1.0):
+        self.name = name
+        self.settings = profile[name]
+        simulate(self.settings["load_seconds"] * share)
+        self.weights = allocate(self.settings["weights_mb"] * share)
+
+    def to(self, *args, **kwargs):
+        return self
+
+    def run(self, seconds):
+        working = allocate(self.settings["working_mb"])
+        simulate(seconds)
+        del working
+
+
+# --- scripts.grounding_sam ---
+
+class BoundingBox:
+    def __init__(self, xmin, ymin, xmax, ymax):
+        self.xmin, self.ymin, self.xmax, self.ymax = xmin, ymin, xmax, ymax
+
+    @property
+    def xyxy(self):
+        return [self.xmin, self.ymin, self.xmax, self.ymax]
+
+
+class DetectionResult:
+    def __init__(self, score=None, label=None, box=None, mask=None):
+        self.score = score
+        self.label = label
+        self.box = box
+        self.mask = mask
+
+    @classmethod
+    def from_dict(cls, detection_dict):
+        return cls(score=detection_dict["score"], label=detection_dict["label"], box=BoundingBox(**detection_dict["box"]))
+
+
+def get_boxes(results):
+    return [[result.box.xyxy for result in results]]
+
+
+def mask_to_polygon(mask):
+    """掩码的外接矩形，代替轮廓提取"""
+    ys, xs = np.nonzero(mask)
+    if xs.size == 0:
+        return []
+    return [[xs.min(), ys.min()], [xs.max(), ys.min()], [xs.max(), ys.max()], [xs.min(), ys.max()]]
+
+
+def polygon_to_mask(polygon, image_shape):
+    mask = np.zeros(image_shape, dtype=np.uint8)
+    if polygon:
+        (x0, y0), (x1, y1) = polygon[0], polygon[2]
+        mask[y0:y1 + 1, x0:x1 + 1] = 255
+    return mask
+
+
+def plot_segmentation(image, detections):
+    """Segmentation map with each mask in its own colour on black, which count_instances relies on"""
+    seg_map = np.zeros((image.height, image.width, 3), dtype=np.uint8)
+    for i, detection in enumerate(detections):
+        # 颜色各不相同且都不是黑色
+        color = ((i + 1) * 97 % 256, (i + 1) * 151 % 256, (i + 1) * 211 % 256)
+        seg_map[np.asarray(detection.mask) > 0] = color
+    return Image.fromarray(seg_map)
+
+
+class StubDetector(StubModel):
+    """Grounding DINO pipeline: one box per candidate label in the middle of the image"""
+
+    def __call__(self, inputs, threshold=0.3, batch_size=1):
+        self.run(self.settings["seconds_per_image"] * len(inputs))
+        outputs = []
+        for item in inputs:
+            width, height = item["image"].size
+            labels = item["candidate_labels"]
+            outputs.append([
+                {
+                    "score": 0.9,
+                    "label": label,
+                    "box": {
+                        "xmin": width * i // len(labels), "ymin": height // 4,
+                        "xmax": width * (i + 1) // len(labels) - 1, "ymax": height * 3 // 4,
+                    },
+                }
+                for i, label in enumerate(labels)
+            ])
+        return outputs
+
+
+class StubProcessorOutput(dict):
+    def to(self, *args, **kwargs):
+        return self
+
+
+class StubSamProcessor:
+    """SamProcessor: masks are the prompt boxes filled in at the original resolution"""
+
+    def __call__(self, images, input_boxes, return_tensors="pt"):
+        sizes = [(image.height, image.width) for image in images]
+        return StubProcessorOutput(
+            pixel_values=torch.zeros(len(images), 1),
+            input_boxes=torch.tensor(input_boxes, dtype=torch.float32),
+            original_sizes=sizes,
+            reshaped_input_sizes=sizes,
+        )
+
+    def post_process_masks(self, masks, original_sizes, reshaped_input_sizes):
+        results = []
+        for boxes, (height, width) in zip(masks, original_sizes):
+            image_masks = torch.zeros(len(boxes), 3, height, width, dtype=torch.bool)
+            for i, (x0, y0, x1, y1) in enumerate(boxes.int().tolist()):
+                image_masks[i, :, max(y0, 0):y1 + 1, max(x0, 0):x1 + 1] = True
+            results.append(image_masks)
+        return results
+
+
+class StubSamSegmentator(StubModel):
+    def __init__(self, name, share=1.0):
+        super().__init__(name, share)
+        self.device = torch.device("cpu")
+        self.dtype = torch.float32
+        self.config = types.SimpleNamespace(_name_or_path="stub-sam")
+
+    def get_image_embeddings(self, pixel_values):
+        self.run(self.settings["seconds_per_image"] * len(pixel_values))
+        return torch.zeros(len(pixel_values), 4)
+
+    def __call__(self, image_embeddings, input_boxes):
+        return types.SimpleNamespace(pred_masks=input_boxes)
+
+
+def prepare_model(device, detector_id=None, segmenter_id=None):
+    # 检测和分割模型各占一半的加载时间和权重
+    return StubDetector("grounding_sam", 0.5), StubSamProcessor(), StubSamSegmentator("grounding_sam", 0.5)
+
+
+# --- midi.pipelines.pipeline_midi / scripts.inference_midi ---
+
+class MIDIPipeline(StubModel):
+    vae = None
+
+    @classmethod
+    def from_pretrained(cls, path, torch_dtype=None):
+        return cls("midi")
+
+    def init_custom_adapter(self, set_self_attn_module_names=None):
+        pass
+
+
+def count_instances(seg_image):
+    """分割图中不同颜色（除背景黑色外）的数量"""
+    small = np.asarray(seg_image.convert("RGB").resize((256, 256), Image.NEAREST)).reshape(-1, 3)
+    colors = np.unique(small, axis=0)
+    return max(1, int((colors.sum(axis=1) > 0).sum()))
+
+
+def run_midi(pipe, rgb_image, seg_image, seed=42, num_inference_steps=50, guidance_scale=7.0, do_image_padding=False):
+    """Sleep for the configured time per step and return one box mesh per instance"""
+    pipe.run(pipe.settings["seconds_per_step"] * num_inference_steps)
+    scene = trimesh.Scene()
+    for i in range(count_instances(seg_image)):
+        box = trimesh.creation.box(extents=(0.2, 0.2, 0.2))
+        box.apply_translation((0.3 * i, 0.0, 0.0))
+        scene.add_geometry(box, node_name=f"object_{i}")
+    return scene
+
+
+# --- scripts.image_to_textured_scene ---
+
+class StubTexturePipeline:
+    pass
+
+
+def prepare_ig2mv_pipeline(device, dtype):
+    return StubModel("mv_adapter")
+
+
+def prepare_texture_pipeline(device, dtype):
+    return StubTexturePipeline()
+
+
+def run_i2tex(ig2mv_pipe, texture_pipe, scene, rgb_image, seg_image, seed=42, output_dir=None, **kwargs):
+    """Sleep for the configured time per object and return the scene unchanged"""
+    ig2mv_pipe.run(ig2mv_pipe.settings["seconds_per_object"] * max(len(scene.geometry), 1))
+    return scene
+
+
+def load_midi_model(device=None):
+    return MIDIPipeline.from_pretrained("stub")
+
+
+def load_midi_model_to_host(pin=True):
+    return MIDIPipeline.from_pretrained("stub")
+
+
+def install(profile_name="fast", tasks_per_node=None):
+    """Replace the ML models of fastapi_server with stubs; everything else runs unchanged
+
+    profile_name is one of PROFILES or the path of a JSON file with the same layout.
+    """
+    global profile
+    if profile_name in PROFILES:
+        profile = PROFILES[profile_name]
+    else:
+        with open(profile_name) as f:
+            profile = json.load(f)
+
+    this_module = sys.modules[__name__]
+    for proxy in (fastapi_server.grounding_sam, fastapi_server.pipeline_midi,
+                  fastapi_server.inference_midi, fastapi_server.image_to_textured_scene):
+        proxy.override(this_module)
+
+    # MIDI的加载流程会下载权重，直接注册桩模型；其余模型仍经过服务器自己的加载代码
+    fastapi_server.model_registry.register(
+        "midi", load_midi_model, fastapi_server.unload_midi_model,
+        host_loader=load_midi_model_to_host, to_device=fastapi_server.move_pipeline_to_device,
+    )
+
+    # 桩模型可以在CPU上贴图；计时写入单独的文件，不污染真实模型的耗时记录
+    fastapi_server.CPU_TEXTURING = True
+    fastapi_server.WEIGHT_QUANTIZATION = None
+    fastapi_server.OFFLOAD_MODE = "none"
+    if tasks_per_node is not None:
+        fastapi_server.MAX_TASKS_PER_NUMA_NODE = tasks_per_node
+    fastapi_server.timing_profile = fastapi_server.TimingProfile(
+        os.path.join(fastapi_server.TMP_DIR, "timing_profile_stub.json")
+    )
+    os.makedirs(fastapi_server.TMP_DIR, exist_ok=True)
+    print(f"Stub backend installed with profile {profile_name!r}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve the MIDI-3D API with stub models that only sleep and allocate memory")
+    parser.add_argument("--profile", default="fast", help=f"One of {', '.join(PROFILES)} or a JSON file with the same layout")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--tasks-per-node", type=int, help="Concurrent tasks per NUMA node (MAX_TASKS_PER_NUMA_NODE)")
+    parser.add_argument("--log-level", default="warning")
+    args = parser.parse_args()
+
+    import uvicorn
+
+    install(args.profile, args.tasks_per_node)
+    uvicorn.run(fastapi_server.app, host=args.host, port=args.port, log_level=args.log_level)
@@ -0,0 +1,84 @@
+import argparse
+import json
+import os
+import tempfile
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# 服务器（fastapi_server.TRACE_EXPORT_PATH）和Blender插件（midi3d_blender_plugin.TRACE_EXPORT_PATH）默认的导出文件
+DEFAULT_TRACE_FILES = [
+    os.path.join(BACKEND_DIR, "tmp", "traces.jsonl"),
+    os.path.join(tempfile.gettempdir(), "midi3d_traces.jsonl"),
+]
+
+
+def load_spans(paths):
+    """读取所有导出文件中的span，按trace_id分组"""
+    traces = {}
+    for path in paths:
+        if not os.path.exists(path):
+            continue
+        with open(path) as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    span = json.loads(line)
+                except ValueError:
+                    continue  # 进程中途退出时可能留下半行
+                traces.setdefault(span["trace_id"], []).append(span)
+    return traces
+
+
+def span_depth(span, spans_by_id):
+    depth = 0
+    while span.get("parent_id") in spans_by_id and depth < 10:
+        span = spans_by_id[span["parent_id"]]
+        depth += 1
+    return depth
+
+
+def print_waterfall(trace_id, spans, width):
+    spans = sorted(spans, key=lambda span: (span["start"], -span["end"]))
+    spans_by_id = {span["span_id"]: span for span in spans}
+    origin = spans[0]["start"]
+    total = max(span["end"] for span in spans) - origin
+
+    print(f"Trace {trace_id}: {len(spans)} spans, {total:.2f}s end to end")
+    for span in spans:
+        offset = span["start"] - origin
+        duration = span["end"] - span["start"]
+        begin = int(offset / total * width) if total > 0 else 0
+        length = max(1, int(duration / total * width)) if total > 0 else 1
+        bar = " " * begin + "#" * min(length, width - begin)
+        name = "  " * span_depth(span, spans_by_id) + span["name"]
+        error = span.get("attributes", {}).get("error")
+        mark = f" ! {error}" if error else ""
+        print(f"  {span['service']:<8} {name:<28} {offset:8.2f}s {duration:8.2f}s |{bar:<{width}}|{mark}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Print the end-to-end latency waterfall of a traced reconstruction")
+    parser.add_argument("trace_ids", nargs="*", help="Trace IDs to print; defaults to the most recent trace")
+    parser.add_argument("--files", nargs="+", default=DEFAULT_TRACE_FILES, help="Span files exported by the server and the add-on")
+    parser.add_argument("--width", type=int, default=60, help="Width of the timeline bars in characters")
+    parser.add_argument("--list", action="store_true", help="List the traces found instead of printing waterfalls")
+    args = parser.parse_args()
+
+    traces = load_spans(args.files)
+    if not traces:
+        raise SystemExit(f"No spans found in {', '.join(args.files)}")
+
+    by_recency = sorted(traces, key=lambda trace_id: max(span["end"] for span in traces[trace_id]), reverse=True)
+    if args.list:
+        for trace_id in by_recency:
+            spans = traces[trace_id]
+            total = max(span["end"] for span in spans) - min(span["start"] for span in spans)
+            print(f"{trace_id}  {len(spans):3d} spans  {total:8.2f}s")
+    else:
+        for trace_id in args.trace_ids or by_recency[:1]:
+            if trace_id not in traces:
+                print(f"Trace {trace_id} not found")
+                continue
+            print_waterfall(trace_id, traces[trace_id], args.width)
@@ -9,7 +9,8 @@ import re
 import requests
 import tempfile
 import shutil
-from bpy.props import StringProperty, BoolProperty, FloatProperty
+import uuid
+from bpy.props import StringProperty, BoolProperty, FloatProperty, EnumProperty, IntProperty
 from bpy.types import Operator, Panel, Header
 
 bl_info = {
@@ -23,7 +24,84 @@ bl_info = {
 }
 
 # 全局变量存储任务状态
-task_status = {"checking": False, "task_id": None}
+task_status = {"checking": False, "task_id": None, "trace_id": None, "trace_span_id": None, "trace_started_at": None}
+
+# 追踪span的本地导出文件（每行一个JSON），与服务器的 backend/tmp/traces.jsonl 格式相同，用 backend/trace_waterfall.py 查看
+TRACE_EXPORT_PATH = os.path.join(tempfile.gettempdir(), "midi3d_traces.jsonl")
+
+
+def write_span(span):
+    """把一个span追加写入本地追踪文件"""
+    try:
+        with open(TRACE_EXPORT_PATH, "a", encoding="utf-8") as f:
+            f.write(json.dumps(span) + "\n")
+    except OSError as e:
+        print(f"Failed to export span {span['name']}: {e}")
+
+
+def make_span(name, start, end, service, span_id, parent_id, attributes):
+    return {
+        "trace_id": task_status["trace_id"],
+        "span_id": span_id,
+        "parent_id": parent_id,
+        "service": service,
+        "name": name,
+        "start": start,
+        "end": end,
+        "duration_ms": round((end - start) * 1000, 1),
+        "attributes": attributes,
+    }
+
+
+def export_span(name, start, end, service="blender", **attributes):
+    """记录当前追踪下的一个span，时间为墙钟秒数，便于和服务器的span对齐"""
+    if not task_status.get("trace_id"):
+        return
+    write_span(make_span(name, start, end, service, uuid.uuid4().hex[:16], task_status["trace_span_id"], attributes))
+
+
+def export_span_line(line):
+    """记录选框程序通过 MIDI3D_SPAN: 输出的span（上传、轮询、下载）"""
+    try:
+        span = json.loads(line)
+        export_span(span["name"], float(span["start"]), float(span["end"]),
+                    service=span.get("service", "selector"), **span.get("attributes", {}))
+    except (ValueError, KeyError, TypeError, AttributeError):
+        print(f"Ignoring malformed span: {line}")
+
+
+def start_trace():
+    """为一次重建生成新的trace ID，之后的span都记录在这条追踪下"""
+    task_status["trace_id"] = uuid.uuid4().hex
+    task_status["trace_span_id"] = uuid.uuid4().hex[:16]
+    task_status["trace_started_at"] = time.time()
+    return task_status["trace_id"]
+
+
+def save_settings(targets):
+    """记录 (对象, 属性名) 的当前值，返回值交给restore_settings恢复；当前Blender版本没有的属性跳过"""
+    return [(obj, attr, getattr(obj, attr)) for obj, attr in targets if hasattr(obj, attr)]
+
+
+def restore_settings(saved):
+    """按记录的顺序恢复，有依赖的属性要排在后面（color_mode的可选值取决于file_format）"""
+    for obj, attr, value in saved:
+        try:
+            setattr(obj, attr, value)
+        except (TypeError, ValueError, AttributeError) as e:
+            # 一项恢复失败不影响其余设置
+            print(f"Could not restore {attr}: {e}")
+
+
+def finish_trace(status):
+    """记录整个重建过程的根span并结束追踪"""
+    if not task_status.get("trace_id"):
+        return
+    write_span(make_span("reconstruction", task_status["trace_started_at"], time.time(), "blender",
+                         task_status["trace_span_id"], None, {"status": status}))
+    print(f"MIDI3D trace {task_status['trace_id']} ({status}) written to {TRACE_EXPORT_PATH}")
+    task_status["trace_id"] = None
+
 
 # --- 新增代码：创建侧边栏面板 ---
 class MIDI3D_PT_Panel(Panel):
@@ -46,6 +124,19 @@ class MIDI3D_PT_Panel(Panel):
         row = layout.row()
         row.scale_y = 1.2
         op = row.operator("midi3d.execute_without_camera", text="Open MIDI3D without Camera", icon='FILE_IMAGE')
+
+        # 截图设置
+        scene = context.scene
+        box = layout.box()
+        box.label(text="Capture:", icon='CAMERA_DATA')
+        box.prop(scene, "midi3d_capture_mode", text="")
+        row = box.row(align=True)
+        row.prop(scene, "midi3d_capture_width", text="W")
+        row.prop(scene, "midi3d_capture_height", text="H")
+        row = box.row(align=True)
+        row.prop(scene, "midi3d_capture_format", text="")
+        if scene.midi3d_capture_format == 'JPEG':
+            row.prop(scene, "midi3d_capture_quality", text="Quality")
         
         # 添加状态显示
         if task_status.get("checking", False):
@@ -98,6 +189,7 @@ class MIDI3D_OT_ExecuteWithoutCamera(Operator):
 
     def execute(self, context):
         # 启动MIDI3D程序，但不传递图像路径
+        start_trace()
         self.start_midi3d_process(context, None)
         return {'FINISHED'}
 
@@ -118,6 +210,9 @@ class MIDI3D_OT_ExecuteWithoutCamera(Operator):
         # 只有当image_path不为None时才添加到命令行参数
         if image_path:
             cmd.append(image_path)
+        # 把trace ID传给选框程序，由它随请求发给服务器
+        if task_status.get("trace_id"):
+            cmd.extend(["--trace-id", task_status["trace_id"]])
 
         try:
             # 启动MIDI3D程序
@@ -149,6 +244,12 @@ class MIDI3D_OT_ExecuteWithoutCamera(Operator):
         for line in process.stdout:
             print(f"MIDI3D Output: {line.strip()}")
             
+            # 选框程序记录的span（上传、轮询、下载）
+            span_match = re.search(r'MIDI3D_SPAN:(.*)', line.strip())
+            if span_match:
+                export_span_line(span_match.group(1))
+                continue
+
             # 检查是否有任务ID
             task_id_match = re.search(r'MIDI3D_TASK_ID:(.*)', line.strip())
             if task_id_match:
@@ -184,6 +285,7 @@ class MIDI3D_OT_ExecuteWithoutCamera(Operator):
             def report_failure():
                 self.report({'ERROR'}, f"MIDI3D task failed: {failure_reason}")
                 task_status["checking"] = False
+                finish_trace("failed")
             bpy.app.timers.register(report_failure)
         elif task_id and task_id != "CANCELLED":
             # 如果没有模型路径但有任务ID，则回退到旧的轮询方式
@@ -194,13 +296,16 @@ class MIDI3D_OT_ExecuteWithoutCamera(Operator):
             def report_cancelled():
                 self.report({'INFO'}, "Task was cancelled by user")
                 task_status["checking"] = False
+                finish_trace("cancelled")
             bpy.app.timers.register(report_cancelled)
         else:
             # 其他情况
             task_status["checking"] = False
+            finish_trace("no_result")
 
     def import_model_directly(self, model_path, context):
         """直接导入模型到Blender"""
+        trace_status = "failed"
         try:
             print(f"Attempting to import model from: {model_path}")
             if not os.path.exists(model_path):
@@ -209,9 +314,12 @@ class MIDI3D_OT_ExecuteWithoutCamera(Operator):
                 return
                 
             # 导入GLB模型到Blender
+            import_start = time.time()
             result = bpy.ops.import_scene.gltf(filepath=model_path)
+            export_span("gltf_import", import_start, time.time(), file_size=os.path.getsize(model_path))
             if 'FINISHED' in result:
                 self.report({'INFO'}, f"Model imported successfully from {model_path}")
+                trace_status = "completed"
             else:
                 self.report({'ERROR'}, f"Failed to import model: {result}")
         except Exception as e:
@@ -221,6 +329,7 @@ class MIDI3D_OT_ExecuteWithoutCamera(Operator):
         finally:
             # 清理任务状态
             task_status["checking"] = False
+            finish_trace(trace_status)
 
 
 class MIDI3D_OT_Execute(Operator):
@@ -245,7 +354,13 @@ class MIDI3D_OT_Execute(Operator):
         context.scene.camera = camera
 
         # 捕获场景图像
+        start_trace()
+        scene = context.scene
+        capture_start = time.time()
         image_path = self.capture_scene(context)
+        export_span("capture", capture_start, time.time(), mode=scene.midi3d_capture_mode,
+                    resolution=f"{scene.midi3d_capture_width}x{scene.midi3d_capture_height}",
+                    file_format=scene.midi3d_capture_format, file_size=os.path.getsize(image_path))
 
         # 启动MIDI3D程序
         self.start_midi3d_process(context, image_path)
@@ -284,35 +399,55 @@ class MIDI3D_OT_Execute(Operator):
         return camera, was_created
 
     def capture_scene(self, context):
-        """使用当前摄像机捕获场景图像"""
-        # 获取临时文件路径
-        temp_dir = tempfile.mkdtemp()
-        filename = f"midi3d_capture_{int(time.time())}.png"
-        filepath = os.path.join(temp_dir, filename)
+        """使用当前摄像机捕获场景图像，完成后恢复所有修改过的渲染设置
 
-        # 保存原始渲染设置
-        render = context.scene.render
+        VIEWPORT模式用OpenGL快速绘制摄像机视图（Workbench着色，显示贴图），RENDER模式用场景的渲染引擎完整渲染。
+        """
+        scene = context.scene
+        render = scene.render
         image_settings = render.image_settings
-        original_file_format = image_settings.file_format
-        original_filepath = render.filepath
+        shading = scene.display.shading
 
-        # 设置渲染参数
-        image_settings.file_format = 'PNG'
-        render.filepath = filepath
-        render.resolution_x = 1920
-        render.resolution_y = 1080
-        render.film_transparent = False
-
-        # 确保使用材质和纹理
-        context.scene.eevee.use_ssr = True
-        context.scene.eevee.use_ssr_refraction = True
+        # 获取临时文件路径
+        temp_dir = tempfile.mkdtemp()
+        extension = "jpg" if scene.midi3d_capture_format == 'JPEG' else "png"
+        filepath = os.path.join(temp_dir, f"midi3d_capture_{int(time.time())}.{extension}")
 
-        # 渲染图像
-        bpy.ops.render.render(write_still=True)
+        # 保存原始渲染设置
+        saved = save_settings([
+            (image_settings, "file_format"), (image_settings, "color_mode"), (image_settings, "color_depth"),
+            (image_settings, "quality"),
+            (render, "filepath"), (render, "resolution_x"), (render, "resolution_y"),
+            (render, "resolution_percentage"), (render, "film_transparent"),
+            (scene.eevee, "use_ssr"), (scene.eevee, "use_ssr_refraction"),
+            (shading, "color_type"),
+        ])
 
-        # 恢复原始设置
-        image_settings.file_format = original_file_format
-        render.filepath = original_filepath
+        try:
+            # 设置渲染参数
+            image_settings.file_format = scene.midi3d_capture_format
+            image_settings.color_mode = 'RGB'
+            if scene.midi3d_capture_format == 'JPEG':
+                image_settings.quality = scene.midi3d_capture_quality
+            render.filepath = filepath
+            render.resolution_x = scene.midi3d_capture_width
+            render.resolution_y = scene.midi3d_capture_height
+            render.resolution_percentage = 100
+            render.film_transparent = False
+
+            if scene.midi3d_capture_mode == 'VIEWPORT':
+                # 实体着色下显示图像纹理，分割模型需要看到物体的外观
+                shading.color_type = 'TEXTURE'
+                bpy.ops.render.opengl(write_still=True, view_context=False)
+            else:
+                # 确保使用材质和纹理（EEVEE Next没有这两个选项）
+                if hasattr(scene.eevee, "use_ssr"):
+                    scene.eevee.use_ssr = True
+                    scene.eevee.use_ssr_refraction = True
+                bpy.ops.render.render(write_still=True)
+        finally:
+            # 恢复原始设置
+            restore_settings(saved)
 
         return filepath
 
@@ -330,6 +465,9 @@ class MIDI3D_OT_Execute(Operator):
 
         # 构建命令
         cmd = [exe_path, image_path]
+        # 把trace ID传给选框程序，由它随请求发给服务器
+        if task_status.get("trace_id"):
+            cmd.extend(["--trace-id", task_status["trace_id"]])
 
         try:
             # 启动MIDI3D程序
@@ -361,6 +499,12 @@ class MIDI3D_OT_Execute(Operator):
         for line in process.stdout:
             print(f"MIDI3D Output: {line.strip()}")
             
+            # 选框程序记录的span（上传、轮询、下载）
+            span_match = re.search(r'MIDI3D_SPAN:(.*)', line.strip())
+            if span_match:
+                export_span_line(span_match.group(1))
+                continue
+
             # 检查是否有任务ID
             task_id_match = re.search(r'MIDI3D_TASK_ID:(.*)', line.strip())
             if task_id_match:
@@ -397,6 +541,7 @@ class MIDI3D_OT_Execute(Operator):
             def report_failure():
                 self.report({'ERROR'}, f"MIDI3D task failed: {failure_reason}")
                 task_status["checking"] = False
+                finish_trace("failed")
             bpy.app.timers.register(report_failure)
         elif task_id and task_id != "CANCELLED":
             # 如果没有模型路径但有任务ID，则回退到旧的轮询方式
@@ -407,13 +552,16 @@ class MIDI3D_OT_Execute(Operator):
             def report_cancelled():
                 self.report({'INFO'}, "Task was cancelled by user")
                 task_status["checking"] = False
+                finish_trace("cancelled")
             bpy.app.timers.register(report_cancelled)
         else:
             # 其他情况
             task_status["checking"] = False
+            finish_trace("no_result")
 
     def import_model_directly(self, model_path, context):
         """直接导入模型到Blender"""
+        trace_status = "failed"
         try:
             print(f"Attempting to import model from: {model_path}")
             if not os.path.exists(model_path):
@@ -422,9 +570,12 @@ class MIDI3D_OT_Execute(Operator):
                 return
                 
             # 导入GLB模型到Blender
+            import_start = time.time()
             result = bpy.ops.import_scene.gltf(filepath=model_path)
+            export_span("gltf_import", import_start, time.time(), file_size=os.path.getsize(model_path))
             if 'FINISHED' in result:
                 self.report({'INFO'}, f"Model imported successfully from {model_path}")
+                trace_status = "completed"
             else:
                 self.report({'ERROR'}, f"Failed to import model: {result}")
         except Exception as e:
@@ -434,6 +585,7 @@ class MIDI3D_OT_Execute(Operator):
         finally:
             # 清理任务状态
             task_status["checking"] = False
+            finish_trace(trace_status)
 
 
 class MIDI3D_OT_CheckTaskStatus(Operator):
@@ -467,24 +619,28 @@ class MIDI3D_OT_CheckTaskStatus(Operator):
 
         max_attempts = 30  # 最多尝试30次
         attempt = 0
+        headers = {"X-Trace-Id": task_status["trace_id"]} if task_status.get("trace_id") else {}
+        poll_start = time.time()
+        imported = False
 
         while attempt < max_attempts and task_status.get("checking", False):
             try:
                 # 请求任务状态
-                response = requests.get(f"{api_url}/status/{task_id}")
+                response = requests.get(f"{api_url}/status/{task_id}", headers=headers)
 
                 if response.status_code == 200:
                     result = response.json()
                     status = result.get("status", "")
 
                     if status == "completed":
+                        export_span("poll_status", poll_start, time.time(), attempts=attempt + 1)
                         # 下载并导入模型
                         # 根据API定义，model_url在status响应中
                         model_url = result.get("model_url", "")
                         if model_url:
                             # 构建完整的模型下载URL
                             full_model_url = f"{api_url}{model_url}"
-                            self.download_and_import_model(full_model_url, context)
+                            imported = self.download_and_import_model(full_model_url, context)
                         else:
                             self.report({'ERROR'}, "Task completed but no model URL provided")
                         break
@@ -503,12 +659,15 @@ class MIDI3D_OT_CheckTaskStatus(Operator):
                 break
 
         task_status["checking"] = False
+        finish_trace("completed" if imported else "failed")
 
     def download_and_import_model(self, model_url, context):
         """下载并导入模型到Blender"""
         try:
             # 下载模型文件
-            response = requests.get(model_url, stream=True)
+            download_start = time.time()
+            headers = {"X-Trace-Id": task_status["trace_id"]} if task_status.get("trace_id") else {}
+            response = requests.get(model_url, stream=True, headers=headers)
 
             if response.status_code == 200:
                 # 创建临时文件
@@ -520,19 +679,24 @@ class MIDI3D_OT_CheckTaskStatus(Operator):
                 with open(filepath, 'wb') as f:
                     for chunk in response.iter_content(1024):
                         f.write(chunk)
+                export_span("download", download_start, time.time(), file_size=os.path.getsize(filepath))
 
                 # 导入模型到Blender
+                import_start = time.time()
                 bpy.ops.import_scene.gltf(filepath=filepath)
+                export_span("gltf_import", import_start, time.time())
 
                 # 清理临时文件
                 shutil.rmtree(temp_dir)
 
                 self.report({'INFO'}, "Model imported successfully")
+                return True
             else:
                 self.report({'ERROR'}, f"Failed to download model: {response.status_code}")
 
         except Exception as e:
             self.report({'ERROR'}, f"Error downloading/importing model: {str(e)}")
+        return False
 
 # --- 修改：保留Header，但主要功能已移至Panel ---
 class MIDI3D_HT_Header(Header):
@@ -565,11 +729,38 @@ classes = (
 )
 # --- 修改结束 ---
 
+# 截图设置保存在场景中，随.blend文件保存
+scene_properties = {
+    "midi3d_capture_mode": EnumProperty(
+        name="Capture Mode",
+        items=[
+            ('VIEWPORT', "Viewport (fast)", "OpenGL capture of the camera view, takes well under a second"),
+            ('RENDER', "Full Render", "Render with the scene's render engine, slow on heavy scenes"),
+        ],
+        default='VIEWPORT',
+    ),
+    "midi3d_capture_width": IntProperty(name="Width", default=1920, min=256, max=8192),
+    "midi3d_capture_height": IntProperty(name="Height", default=1080, min=256, max=8192),
+    "midi3d_capture_format": EnumProperty(
+        name="Format",
+        items=[
+            ('JPEG', "JPEG", "Smaller file, faster to write and upload"),
+            ('PNG', "PNG", "Lossless"),
+        ],
+        default='JPEG',
+    ),
+    "midi3d_capture_quality": IntProperty(name="Quality", default=90, min=50, max=100, subtype='PERCENTAGE'),
+}
+
 def register():
     for cls in classes:
         bpy.utils.register_class(cls)
+    for name, prop in scene_properties.items():
+        setattr(bpy.types.Scene, name, prop)
 
 def unregister():
+    for name in scene_properties:
+        delattr(bpy.types.Scene, name)
     for cls in reversed(classes):
         bpy.utils.unregister_class(cls)
 